@@ -7,7 +7,7 @@ import sys
 import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from pythales.hsm import HSM
+from pythales.hsm import HSM, HSMWorkers, LOG_LEVELS, LOG_FULL
 
 def show_help(name):
     """
@@ -20,6 +20,10 @@ def show_help(name):
     print('  -d, --debug\t\t\tEnable debug mode (show CVV/PVV mismatch etc)')
     print('  -s, --skip-parity\t\t\tSkip key parity checks')
     print('  -a, --approve-all\t\t\tApprove all requests')
+    print('  -e, --engine=[ENGINE]\t\tServer engine: threads (default) or async')
+    print('  -o, --out-of-order\t\tSend responses as soon as they are ready')
+    print('  -l, --log-level=[LEVEL]\t\tLog level: off, summary or full (default)')
+    print('  -w, --workers=[N]\t\tRun N worker processes sharing the port')
 
 
 if __name__ == '__main__':
@@ -29,8 +33,12 @@ if __name__ == '__main__':
     debug = False
     skip_parity = None
     approve_all = None
+    engine = 'threads'
+    workers = 0
+    out_of_order = None
+    log_level = LOG_FULL
 
-    optlist, args = getopt.getopt(sys.argv[1:], 'h:p:k:dsa', ['header=', 'port=', 'key=', 'debug', 'skip-parity', 'approve-all', 'help'])
+    optlist, args = getopt.getopt(sys.argv[1:], 'h:p:k:dsae:w:ol:', ['header=', 'port=', 'key=', 'debug', 'skip-parity', 'approve-all', 'engine=', 'workers=', 'out-of-order', 'log-level=', 'help'])
     for opt, arg in optlist:
         if opt in ('-p', '--port'):
             try:
@@ -46,13 +54,39 @@ if __name__ == '__main__':
             skip_parity = True
         elif opt in ('-a', '--approve-all'):
             approve_all = True
+        elif opt in ('-e', '--engine'):
+            if arg not in ('threads', 'async'):
+                print('Invalid server engine: {}'.format(arg))
+                sys.exit()
+            engine = arg
+        elif opt in ('-o', '--out-of-order'):
+            out_of_order = True
+        elif opt in ('-l', '--log-level'):
+            if arg not in LOG_LEVELS:
+                print('Invalid log level: {}'.format(arg))
+                sys.exit()
+            log_level = LOG_LEVELS[arg]
+        elif opt in ('-w', '--workers'):
+            try:
+                workers = int(arg)
+            except ValueError:
+                print('Invalid number of workers: {}'.format(arg))
+                sys.exit()
         elif opt in ( '--help'):
             show_help(sys.argv[0])
             sys.exit()
 
-    hsm = HSM(port=port, key=key, debug=debug, skip_parity=skip_parity, approve_all=approve_all)
+    hsm_kwargs = dict(port=port, key=key, debug=debug, skip_parity=skip_parity, approve_all=approve_all, out_of_order=out_of_order, log_level=log_level)
+    if workers:
+        HSMWorkers(workers=workers, engine=engine, **hsm_kwargs).run()
+        sys.exit(0)
+
+    hsm = HSM(**hsm_kwargs)
     try:
-        hsm.run()
+        if engine == 'async':
+            hsm.run_async()
+        else:
+            hsm.run()
     except KeyboardInterrupt:
         print("\nServer shutdown requested, exiting...")
         sys.exit(0)
@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+
+"""
+Offline batch computations for the card issuance and migration files.
+
+The records are read from a CSV file as a generator, the working key is
+decrypted under the LMK once, and the records are processed in chunks by a
+pool of worker processes. Only a bounded number of chunks is in flight at a
+time, so the memory use does not depend on the file size.
+
+    python -m pythales.batch cvv cards.csv cvv.csv --cvk U613D213826396ED1C184D7DC81E484F7
+
+The input records are PAN,expiry (YYMM),service code; the output adds CVV,
+CVV2 (service code 000) and iCVV (service code 999) to every record. As the
+CW and CY commands of the simulator, the CVVs are computed with the CVK as it
+is given (encrypted under the LMK), the same as the PVK pair of the PVVs.
+
+    python -m pythales.batch pvv pins.csv pvv.csv --pvk 1234567890ABCDEF1234567890ABCDEF
+
+The input records are PAN,PVKI,PIN and optionally the PVV to verify; the
+output adds the computed PVV (and whether it matches). The PVVs are computed
+in bulk, with NumPy if it is installed.
+
+    python -m pythales.batch encrypt track.dat track.enc --data-key U613D213826396ED1C184D7DC81E484F7
+
+Files of any size are encrypted (or decrypted) under a ZEK/DEK with 3DES
+CBC or ECB and PKCS#7 padding, in fixed-size chunks through reused buffers,
+so the memory use is constant.
+"""
+
+import os
+import sys
+import csv
+import time
+from binascii import hexlify, unhexlify
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from Crypto.Cipher import DES, DES3
+from Crypto.Util.Padding import pad, unpad
+from pynblock.tools import check_key_parity
+
+from pythales.hsm import DEFAULT_LMK
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_CHUNK_SIZE = 1000
+# Bytes read, encrypted and written at a time by the data streams
+DEFAULT_STREAM_CHUNK_SIZE = 65536
+
+CVV_COLUMNS = ('PAN', 'Expiry', 'Service Code', 'CVV', 'CVV2', 'iCVV')
+PVV_COLUMNS = ('PAN', 'PVKI', 'PIN', 'PVV', 'Match')
+
+# str.translate() tables for the decimalisation of the hex ciphertext
+_HEX_LETTERS = 'abcdef'
+_DROP_LETTERS = str.maketrans('', '', _HEX_LETTERS)
+_LETTERS_TO_DIGITS = str.maketrans(_HEX_LETTERS, '012345', '0123456789')
+
+
+def key_under_lmk(key):
+    """
+    Binary working key encrypted under the LMK (hex, optionally prefixed with the key scheme 'U')
+    """
+    if isinstance(key, bytes):
+        key = key.decode('ascii')
+    if key[0:1] in ('U', 'u'):
+        key = key[1:]
+    if len(key) != 32:
+        raise ValueError('Double length key expected: {}'.format(key))
+    return unhexlify(key)
+
+
+def decrypt_key(key, lmk=None, skip_parity=False):
+    """
+    Decrypt the working key (hex, optionally prefixed with the key scheme 'U') under the LMK
+    """
+    clear_key = DES3.new(unhexlify(lmk if lmk else DEFAULT_LMK), DES3.MODE_ECB).decrypt(key_under_lmk(key))
+    if not skip_parity and not check_key_parity(clear_key):
+        raise ValueError('Key parity error')
+    return clear_key
+
+
+def decimalise(ciphertext, length):
+    """
+    Select the decimal digits of the hex ciphertext from left to right, then, if there
+    are not enough of them, the non-decimal digits converted by subtracting 10
+    (the same as pynblock get_digits_from_string(), which PVV and CVV use)
+    """
+    ciphertext = ciphertext.lower()
+    digits = ciphertext.translate(_DROP_LETTERS)
+    if len(digits) < length:
+        digits += ciphertext.translate(_LETTERS_TO_DIGITS)
+    return digits[:length]
+
+
+def decimalise_blocks(ciphertext, length):
+    """
+    Decimalise every 8-byte block of the ciphertext, return the list of the digit strings (as bytes)
+    """
+    if numpy is None:
+        text = hexlify(ciphertext).decode('ascii')
+        return [decimalise(text[i:i + 16], length).encode('ascii') for i in range(0, len(text), 16)]
+
+    blocks = numpy.frombuffer(ciphertext, dtype=numpy.uint8).reshape(-1, 8)
+    nibbles = numpy.empty((len(blocks), 16), dtype=numpy.uint8)
+    nibbles[:, 0::2] = blocks >> 4
+    nibbles[:, 1::2] = blocks & 0x0F
+    # The decimal digits go first, then the non-decimal ones, each in the order of the scan
+    order = numpy.argsort(numpy.arange(16) + 16 * (nibbles > 9), axis=1)[:, :length]
+    digits = numpy.take_along_axis(nibbles, order, axis=1)
+    digits = numpy.where(digits > 9, digits - 10, digits) + ord('0')
+    data = digits.astype(numpy.uint8).tobytes()
+    return [data[i:i + length] for i in range(0, len(data), length)]
+
+
+class CVVGenerator():
+    """
+    Visa CVV with the double length CVK (binary), the ciphers are built once
+    """
+    def __init__(self, cvk):
+        self._des = DES.new(cvk[:8], DES.MODE_ECB)
+        self._des3 = DES3.new(cvk, DES3.MODE_ECB)
+
+    def cvv(self, pan, expiry, service_code):
+        data = (pan + expiry + service_code).ljust(32, '0')
+        block = int.from_bytes(self._des.encrypt(unhexlify(data[:16])), 'big') ^ int(data[16:32], 16)
+        return decimalise(hexlify(self._des3.encrypt(block.to_bytes(8, 'big'))).decode('ascii'), 3)
+
+    def cvvs(self, pan, expiry, service_code):
+        """
+        CVV, CVV2 and iCVV of the card
+        """
+        return self.cvv(pan, expiry, service_code), self.cvv(pan, expiry, '000'), self.cvv(pan, expiry, '999')
+
+
+class PVVGenerator():
+    """
+    Visa PVV computed for many TSPs at once: all the TSP blocks go through each cipher
+    in one ECB call, and the decimalisation is done in bulk. The results are the same
+    as of pynblock get_visa_pvv() with the same PVK pair (the key halves are used
+    as get_visa_pvv() uses them, as the DES3 keys)
+    """
+    def __init__(self, pvk):
+        if isinstance(pvk, str):
+            pvk = pvk.encode('ascii')
+        if len(pvk) != 32:
+            raise ValueError('Incorrect key length')
+        self._left = DES3.new(pvk[:16], DES3.MODE_ECB)
+        self._right = DES3.new(pvk[16:], DES3.MODE_ECB)
+
+    def pvvs(self, account_numbers, key_indexes, pins):
+        """
+        PVVs (bytes) for the sequences of account numbers, PVK indexes and PINs (bytes)
+        """
+        tsps = unhexlify(b''.join([account_number[-12:-1] + key_index + pin[:4]
+                                   for account_number, key_index, pin in zip(account_numbers, key_indexes, pins)]))
+        if len(tsps) != 8 * len(account_numbers):
+            raise ValueError('Invalid TSP: 11 digits of the account number, PVKI and 4 PIN digits expected')
+        return decimalise_blocks(self._left.encrypt(self._right.decrypt(self._left.encrypt(tsps))), 4)
+
+    def verify(self, account_numbers, key_indexes, pins, pvvs):
+        """
+        Whether the PVVs match
+        """
+        return [computed == pvv for computed, pvv in zip(self.pvvs(account_numbers, key_indexes, pins), pvvs)]
+
+
+def read_cvv_records(lines):
+    """
+    Generate (PAN, expiry, service code) records from the CSV lines, a header line is skipped
+    """
+    for number, row in enumerate(csv.reader(lines), 1):
+        if not row or (number == 1 and not row[0].strip().isdigit()):
+            continue
+        if len(row) < 3:
+            raise ValueError('Line {}: PAN, expiry and service code expected'.format(number))
+        pan, expiry, service_code = (value.strip() for value in row[:3])
+        if not (pan.isdigit() and 12 <= len(pan) <= 19 and expiry.isdigit() and len(expiry) == 4 and service_code.isdigit() and len(service_code) == 3):
+            raise ValueError('Line {}: invalid record {}'.format(number, ','.join(row)))
+        yield pan, expiry, service_code
+
+
+def read_pvv_records(lines):
+    """
+    Generate (PAN, PVKI, PIN, PVV or None) records from the CSV lines, a header line is skipped
+    """
+    for number, row in enumerate(csv.reader(lines), 1):
+        if not row or (number == 1 and not row[0].strip().isdigit()):
+            continue
+        if len(row) < 3:
+            raise ValueError('Line {}: PAN, PVKI and PIN expected'.format(number))
+        pan, pvki, pin = (value.strip() for value in row[:3])
+        pvv = row[3].strip() if len(row) > 3 and row[3].strip() else None
+        if not (pan.isdigit() and len(pan) >= 12 and pvki.isdigit() and len(pvki) == 1 and pin.isdigit() and len(pin) >= 4
+                and (pvv is None or (pvv.isdigit() and len(pvv) == 4))):
+            raise ValueError('Line {}: invalid record {}'.format(number, ','.join(row)))
+        yield pan, pvki, pin, pvv
+
+
+def chunks(records, size):
+    """
+    Split the records into lists of the given size
+    """
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Worker process state, set by the pool initializer
+_generator = None
+
+
+def _init_cvv_worker(cvk):
+    global _generator
+    _generator = CVVGenerator(cvk)
+
+
+def _cvv_chunk(records):
+    return [record + _generator.cvvs(*record) for record in records]
+
+
+def _init_pvv_worker(pvk):
+    global _generator
+    _generator = PVVGenerator(pvk)
+
+
+def _pvv_chunk(records):
+    pans, pvkis, pins, expected = zip(*records)
+    pvvs = _generator.pvvs([pan.encode('ascii') for pan in pans], [pvki.encode('ascii') for pvki in pvkis], [pin.encode('ascii') for pin in pins])
+    return [(pan, pvki, pin, pvv.decode('ascii'), '' if expected_pvv is None else 'Y' if pvv.decode('ascii') == expected_pvv else 'N')
+            for pan, pvki, pin, pvv, expected_pvv in zip(pans, pvkis, pins, pvvs, expected)]
+
+
+def _map_chunks(function, initializer, initargs, records, workers, chunk_size):
+    """
+    Apply the function to the chunks of records in the worker processes, yielding the results in order.
+    At most two chunks per worker are queued, so the input is read only as fast as it is processed
+    """
+    if workers == 0:
+        initializer(*initargs)
+        for chunk in chunks(records, chunk_size):
+            yield from function(chunk)
+        return
+
+    workers = workers if workers else os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as pool:
+        pending = deque()
+        for chunk in chunks(records, chunk_size):
+            pending.append(pool.submit(function, chunk))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def generate_cvvs(records, cvk, lmk=None, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, skip_parity=False):
+    """
+    Generate (PAN, expiry, service code, CVV, CVV2, iCVV) for the (PAN, expiry, service code) records.
+    cvk is encrypted under the LMK; workers=None uses all the CPUs, workers=0 computes in the calling process.
+    The CVVs are computed with the CVK as CW and CY take it (the key under the LMK), so that they verify
+    with the simulator; the LMK is only used for the parity check
+    """
+    decrypt_key(cvk, lmk, skip_parity)
+    return _map_chunks(_cvv_chunk, _init_cvv_worker, (key_under_lmk(cvk),), records, workers, chunk_size)
+
+
+def generate_pvvs(records, pvk, workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Generate (PAN, PVKI, PIN, PVV, match) for the (PAN, PVKI, PIN, expected PVV or None) records,
+    match is 'Y', 'N' or '' if there is no PVV to verify. pvk is the PVK pair as EC and DC take it
+    """
+    PVVGenerator(pvk)  # validate the key before starting the workers
+    return _map_chunks(_pvv_chunk, _init_pvv_worker, (pvk,), records, workers, chunk_size)
+
+
+def benchmark_pvv(count=100000, pvk='1234567890ABCDEF1234567890ABCDEF'):
+    """
+    Compare the bulk PVV computation with the get_visa_pvv() loop, return the records per second of both
+    """
+    from pynblock.tools import get_visa_pvv
+
+    accounts = [b'%016d' % (4000000000000000 + i * 7919) for i in range(count)]
+    key_indexes = [b'1'] * count
+    pins = [b'%04d' % (i % 10000) for i in range(count)]
+    pvk = pvk.encode('ascii')
+
+    started = time.perf_counter()
+    expected = [get_visa_pvv(account, key_index, pin, pvk) for account, key_index, pin in zip(accounts, key_indexes, pins)]
+    loop = time.perf_counter() - started
+
+    started = time.perf_counter()
+    pvvs = PVVGenerator(pvk).pvvs(accounts, key_indexes, pins)
+    bulk = time.perf_counter() - started
+
+    if pvvs != expected:
+        raise AssertionError('Bulk PVVs differ from get_visa_pvv()')
+    return {'records': count, 'numpy': numpy is not None, 'loop': count / loop, 'bulk': count / bulk}
+
+
+def _data_cipher(clear_key, mode, iv):
+    if mode == 'ecb':
+        return DES3.new(clear_key, DES3.MODE_ECB)
+    if mode == 'cbc':
+        return DES3.new(clear_key, DES3.MODE_CBC, iv if iv is not None else bytes(8))
+    raise ValueError('Unsupported cipher mode: {}'.format(mode))
+
+
+def _read_chunk(stream, view):
+    """
+    Fill the buffer from the stream, return the number of bytes read (less than the buffer size only at the end)
+    """
+    filled = 0
+    while filled < len(view):
+        received = stream.readinto(view[filled:])
+        if not received:
+            break
+        filled += received
+    return filled
+
+
+def _stream_buffer(chunk_size):
+    chunk_size -= chunk_size % DES3.block_size
+    if chunk_size <= 0:
+        raise ValueError('Chunk size must be at least {} bytes'.format(DES3.block_size))
+    return memoryview(bytearray(chunk_size))
+
+
+def encrypt_stream(instream, outstream, clear_key, mode='cbc', iv=None, chunk_size=DEFAULT_STREAM_CHUNK_SIZE):
+    """
+    Encrypt the binary stream with the clear 3DES key, padding the end with PKCS#7.
+    The chunks are encrypted in place in one reused buffer. Returns the number of bytes read
+    """
+    cipher = _data_cipher(clear_key, mode, iv)
+    view = _stream_buffer(chunk_size)
+    total = 0
+    while True:
+        size = _read_chunk(instream, view)
+        total += size
+        if size < len(view):
+            outstream.write(cipher.encrypt(pad(view[:size].tobytes(), DES3.block_size)))
+            return total
+        cipher.encrypt(view, output=view)
+        outstream.write(view)
+
+
+def decrypt_stream(instream, outstream, clear_key, mode='cbc', iv=None, chunk_size=DEFAULT_STREAM_CHUNK_SIZE):
+    """
+    Decrypt the binary stream encrypted by encrypt_stream(). The next chunk is read
+    before the current one is written, to find the last chunk to unpad.
+    Returns the number of bytes written
+    """
+    cipher = _data_cipher(clear_key, mode, iv)
+    current, following = _stream_buffer(chunk_size), _stream_buffer(chunk_size)
+    size = _read_chunk(instream, current)
+    if not size or size % DES3.block_size:
+        raise ValueError('Encrypted data length {} is not a positive multiple of {}'.format(size, DES3.block_size))
+    total = 0
+    while True:
+        following_size = _read_chunk(instream, following) if size == len(current) else 0
+        if following_size % DES3.block_size:
+            raise ValueError('Encrypted data length is not a multiple of {}'.format(DES3.block_size))
+        chunk = current[:size]
+        cipher.decrypt(chunk, output=chunk)
+        if not following_size:
+            data = unpad(chunk.tobytes(), DES3.block_size)
+            outstream.write(data)
+            return total + len(data)
+        outstream.write(chunk)
+        total += size
+        current, following, size = following, current, following_size
+
+
+def _open(name, mode):
+    if name == '-':
+        return open((sys.stdin if 'r' in mode else sys.stdout).fileno(), mode, newline='', closefd=False)
+    return open(name, mode, newline='')
+
+
+def cvv_file(input_name, output_name, cvk, lmk=None, workers=None, chunk_size=DEFAULT_CHUNK_SIZE, skip_parity=False):
+    """
+    Compute the CVVs for the CSV file, return the number of records
+    """
+    count = 0
+    with _open(input_name, 'r') as infile:
+        rows = generate_cvvs(read_cvv_records(infile), cvk, lmk, workers, chunk_size, skip_parity)
+        with _open(output_name, 'w') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(CVV_COLUMNS)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+    return count
+
+
+def _open_binary(name, mode):
+    if name == '-':
+        return open((sys.stdin if 'r' in mode else sys.stdout).fileno(), mode, closefd=False)
+    return open(name, mode)
+
+
+def crypt_file(input_name, output_name, key, decrypt=False, lmk=None, mode='cbc', iv=None, chunk_size=DEFAULT_STREAM_CHUNK_SIZE, skip_parity=False):
+    """
+    Encrypt (or decrypt) the file with the ZEK/DEK encrypted under the LMK, return the number of plaintext bytes
+    """
+    clear_key = decrypt_key(key, lmk, skip_parity)
+    if isinstance(iv, str):
+        iv = unhexlify(iv)
+    with _open_binary(input_name, 'rb') as infile:
+        with _open_binary(output_name, 'wb') as outfile:
+            return (decrypt_stream if decrypt else encrypt_stream)(infile, outfile, clear_key, mode, iv, chunk_size)
+
+
+def pvv_file(input_name, output_name, pvk, workers=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Compute (and verify) the PVVs for the CSV file, return the number of records
+    """
+    count = 0
+    with _open(input_name, 'r') as infile:
+        rows = generate_pvvs(read_pvv_records(infile), pvk, workers, chunk_size)
+        with _open(output_name, 'w') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(PVV_COLUMNS)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+    return count
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Offline batch computations for the card files')
+    parser.add_argument('-k', '--key', type=str, default=None,
+                        help='LMK key in hex')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Number of worker processes, 0 to compute in this process, default number of CPUs')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='Records per chunk sent to a worker, default {}'.format(DEFAULT_CHUNK_SIZE))
+    parser.add_argument('-s', '--skip-parity', action='store_true',
+                        help='Skip key parity checks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cvv_parser = commands.add_parser('cvv', help='Generate CVV, CVV2 and iCVV: PAN,expiry,service code records')
+    cvv_parser.add_argument('input', help='Input CSV file, - for stdin')
+    cvv_parser.add_argument('output', help='Output CSV file, - for stdout')
+    cvv_parser.add_argument('--cvk', type=str, required=True,
+                            help='CVK encrypted under the LMK')
+
+    pvv_parser = commands.add_parser('pvv', help='Generate or verify PVV: PAN,PVKI,PIN[,PVV] records')
+    pvv_parser.add_argument('input', help='Input CSV file, - for stdin')
+    pvv_parser.add_argument('output', help='Output CSV file, - for stdout')
+    pvv_parser.add_argument('--pvk', type=str, required=True,
+                            help='PVK pair, 32 hex digits')
+
+    benchmark_parser = commands.add_parser('pvv-benchmark', help='Compare the bulk PVV computation with the per-record loop')
+    benchmark_parser.add_argument('-n', '--records', type=int, default=100000,
+                                  help='Number of records, default 100000')
+
+    for name, description in (('encrypt', 'Encrypt a file with a ZEK/DEK'), ('decrypt', 'Decrypt a file encrypted with a ZEK/DEK')):
+        data_parser = commands.add_parser(name, help=description)
+        data_parser.add_argument('input', help='Input file, - for stdin')
+        data_parser.add_argument('output', help='Output file, - for stdout')
+        data_parser.add_argument('--data-key', type=str, required=True,
+                                 help='ZEK or DEK encrypted under the LMK')
+        data_parser.add_argument('--mode', choices=('cbc', 'ecb'), default='cbc',
+                                 help='Cipher mode, default cbc')
+        data_parser.add_argument('--iv', type=str, default=None,
+                                 help='CBC initialization vector in hex, default zeros')
+        data_parser.add_argument('--buffer-size', type=int, default=DEFAULT_STREAM_CHUNK_SIZE,
+                                 help='Bytes processed at a time, default {}'.format(DEFAULT_STREAM_CHUNK_SIZE))
+
+    args = parser.parse_args()
+    try:
+        if args.command in ('encrypt', 'decrypt'):
+            size = crypt_file(args.input, args.output, args.data_key, args.command == 'decrypt', args.key, args.mode, args.iv,
+                              args.buffer_size, args.skip_parity)
+            print('{} bytes processed'.format(size), file=sys.stderr)
+            sys.exit()
+        if args.command == 'cvv':
+            count = cvv_file(args.input, args.output, args.cvk, args.key, args.workers, args.chunk_size, args.skip_parity)
+        elif args.command == 'pvv':
+            count = pvv_file(args.input, args.output, args.pvk, args.workers, args.chunk_size)
+        else:
+            result = benchmark_pvv(args.records)
+            print('{} records, NumPy {}'.format(result['records'], 'used' if result['numpy'] else 'not installed'))
+            print('get_visa_pvv() loop: {:.0f} records/sec'.format(result['loop']))
+            print('Bulk computation:    {:.0f} records/sec ({:.1f}x)'.format(result['bulk'], result['bulk'] / result['loop']))
+            sys.exit()
+    except (ValueError, OSError) as e:
+        print('Error: {}'.format(e), file=sys.stderr)
+        sys.exit(1)
+
+    print('{} records processed'.format(count), file=sys.stderr)
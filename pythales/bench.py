@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+"""
+Load generator for the HSM simulator (or any device speaking the length-prefixed Thales framing).
+
+Opens a number of connections and drives a mix of commands, either as fast as
+possible with a fixed number of outstanding requests per connection (pipeline
+depth) or at a target rate. Reports the throughput and the latency percentiles,
+overall and per command, and optionally writes them as JSON to compare the runs.
+
+    python -m pythales.bench --port 1500 --connections 10 --depth 4 --duration 10 --mix EC=4,CA=4,NC=1,BU=1 --json run.json
+"""
+
+import sys
+import math
+import json
+import time
+import random
+import struct
+import asyncio
+
+# Sample command data, the keys are encrypted under the default LMK. Every sample is
+# processed successfully (error code 00): the PIN blocks carry the PIN 1234 under the
+# TPK/ZPK U613D..., and the PVV and the CVV are the ones of that PIN and card
+COMMANDS = {
+    b'A0': b'1002U;1U613D213826396ED1C184D7DC81E484F7',
+    b'BU': b'021UA97831862E31CCC36E854FE184EE6453',
+    b'CA': b'U613D213826396ED1C184D7DC81E484F7UDD0212CA505034DADF6A534DE1E06385126261A0F748F863FD0101552000000012',
+    b'CC': b'U613D213826396ED1C184D7DC81E484F7UDD0212CA505034DADF6A534DE1E0638512C4BE14B669F2854B0101552000000012',
+    b'CW': b'U613D213826396ED1C184D7DC81E484F74575272222567122;2010000',
+    b'CY': b'U613D213826396ED1C184D7DC81E484F71694575272222567122;2010000',
+    b'EC': b'U613D213826396ED1C184D7DC81E484F77336D50C47128D710DF450BCB2C6461B538903E691F0CF770140700000001013843',
+    b'KQ': (b'10U613D213826396ED1C184D7DC81E484F7' + bytes.fromhex('4575272222567101002A9BADBCAB') + b'23' +
+            bytes.fromhex('0000000010000000000000000826000000000008261711010034BA5A2A5C00002A0300') + b';' +
+            bytes.fromhex('6673B0E6C8F91952') + b'00'),
+    b'M0': b'0001' + b'00AU613D213826396ED1C184D7DC81E484F7' + b'0010' + b'4575272222567122',
+    b'M2': b'0000' + b'00AU613D213826396ED1C184D7DC81E484F7' + b'0010' + bytes.fromhex('D5E3FD3F0D5C2B89A8E2D5C00F1C6F4D'),
+    b'NC': b'',
+}
+
+DEFAULT_MIX = 'EC=4,CA=4,NC=1,BU=1'
+
+PERCENTILES = (('p50', 50), ('p90', 90), ('p99', 99), ('p99.9', 99.9))
+
+# The 4-byte message header carries the request number, so the responses are matched even if they come out of order
+MAX_DEPTH = 10000
+
+
+def parse_mix(mix):
+    """
+    Parse the command mix, e.g. 'EC=4,CA=4,NC=1' -> {b'EC': 4, b'CA': 4, b'NC': 1}
+    """
+    weights = {}
+    for item in mix.split(','):
+        command, _, weight = item.strip().partition('=')
+        command = command.strip().upper().encode()
+        if command not in COMMANDS:
+            raise ValueError('Unsupported command in the mix: {}'.format(command.decode()))
+        weights[command] = float(weight) if weight else 1.0
+    return weights
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of the sorted values
+    """
+    if not values:
+        return None
+    rank = math.ceil(round(p * len(values) / 100.0, 9)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def latency_summary(latencies):
+    """
+    Latency percentiles in milliseconds
+    """
+    values = sorted(latencies)
+    summary = {name: percentile(values, p) * 1000 if values else None for name, p in PERCENTILES}
+    summary['mean'] = sum(values) / len(values) * 1000 if values else None
+    summary['max'] = values[-1] * 1000 if values else None
+    return summary
+
+
+class _Stats():
+    def __init__(self, commands):
+        self.sent = 0
+        self.errors = 0
+        self.latencies = {command: [] for command in commands}
+        self.command_errors = {command: 0 for command in commands}
+
+
+async def _run_connection(host, port, commands, weights, depth, interval, deadline, requests, stats, timeout):
+    reader, writer = await asyncio.open_connection(host, port)
+    inflight = {}
+    slots = asyncio.Semaphore(depth)
+    done = asyncio.Event()
+
+    async def receive():
+        while True:
+            length = struct.unpack('!H', await reader.readexactly(2))[0]
+            body = await reader.readexactly(length)
+            received = time.perf_counter()
+            request = inflight.pop(body[:4], None)
+            if request is None:
+                continue
+            sent, command = request
+            stats.latencies[command].append(received - sent)
+            if body[6:8] != b'00':
+                stats.errors += 1
+                stats.command_errors[command] += 1
+            slots.release()
+            if done.is_set() and not inflight:
+                return
+
+    receiver = asyncio.ensure_future(receive())
+    seq = 0
+    next_send = time.perf_counter()
+    try:
+        while time.perf_counter() < deadline and (requests is None or stats.sent < requests):
+            try:
+                await asyncio.wait_for(slots.acquire(), timeout)
+            except asyncio.TimeoutError:
+                # No responses to the outstanding requests
+                break
+            if interval:
+                next_send += interval
+                delay = next_send - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if receiver.done() or (requests is not None and stats.sent >= requests):
+                break
+            command = random.choices(commands, weights)[0]
+            header = b'%04d' % seq
+            seq = (seq + 1) % MAX_DEPTH
+            data = header + command + COMMANDS[command]
+            inflight[header] = (time.perf_counter(), command)
+            stats.sent += 1
+            writer.write(struct.pack('!H', len(data)) + data)
+            await writer.drain()
+
+        done.set()
+        if inflight and not receiver.done():
+            await asyncio.wait_for(asyncio.shield(receiver), timeout)
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        receiver.cancel()
+        writer.close()
+    return len(inflight)
+
+
+async def benchmark(host='127.0.0.1', port=1500, connections=1, depth=1, rate=None, duration=10.0, requests=None, mix=DEFAULT_MIX, timeout=5.0):
+    """
+    Run the benchmark and return the report. rate is the total target rate in requests per second
+    (None - as fast as the pipeline depth allows), requests limits the total number of requests
+    """
+    if not 1 <= depth <= MAX_DEPTH:
+        raise ValueError('Pipeline depth must be between 1 and {}'.format(MAX_DEPTH))
+    weights = parse_mix(mix) if isinstance(mix, str) else mix
+    commands = list(weights)
+    stats = _Stats(commands)
+    interval = connections / rate if rate else None
+
+    started = time.perf_counter()
+    deadline = started + duration if duration else float('inf')
+    timeouts = await asyncio.gather(*[_run_connection(host, port, commands, [weights[c] for c in commands], depth, interval, deadline, requests, stats, timeout)
+                                      for _ in range(connections)])
+    elapsed = time.perf_counter() - started
+
+    all_latencies = [latency for latencies in stats.latencies.values() for latency in latencies]
+    return {
+        'config': {'host': host, 'port': port, 'connections': connections, 'depth': depth, 'rate': rate,
+                   'duration': duration, 'requests': requests, 'mix': {c.decode(): w for c, w in weights.items()}},
+        'elapsed': elapsed,
+        'sent': stats.sent,
+        'responses': len(all_latencies),
+        'errors': stats.errors,
+        'timeouts': sum(timeouts),
+        'throughput': len(all_latencies) / elapsed if elapsed else 0.0,
+        'latency_ms': latency_summary(all_latencies),
+        'commands': {command.decode(): {'responses': len(stats.latencies[command]),
+                                        'errors': stats.command_errors[command],
+                                        'latency_ms': latency_summary(stats.latencies[command])}
+                     for command in commands},
+    }
+
+
+def kq_cache_benchmark(requests=20000, cards=100):
+    """
+    In-process KQ throughput with and without the derived card key cache,
+    the requests are spread over the number of distinct cards
+    """
+    from pythales.hsm import HSM, LOG_OFF, derive_card_key, retail_mac
+
+    if cards < 1:
+        raise ValueError('The number of cards must be positive')
+    mk = b'U613D213826396ED1C184D7DC81E484F7'
+    data = bytes.fromhex('0000000010000000000000000826000000000008261711010034BA5A2A5C00002A0300')
+    hsm = HSM(log_level=LOG_OFF)
+    messages = []
+    for card in range(cards):
+        pan_psn = bytes.fromhex('45752722%08d' % card)
+        arqc = retail_mac(derive_card_key(hsm._working_key(mk).get_cipher(), pan_psn), data)
+        body = b'SSSSKQ10' + mk + pan_psn + b'\x00\x2a\x9b\xad\xbc\xab' + b'%02X' % len(data) + data + b';' + arqc + b'00'
+        messages.append(struct.pack('!H', len(body)) + body)
+
+    report = {'requests': requests, 'cards': cards}
+    for name, cache_size in (('uncached', 0), ('cached', max(cards, 1))):
+        hsm = HSM(log_level=LOG_OFF, card_key_cache_size=cache_size)
+        started = time.perf_counter()
+        for i in range(requests):
+            response = hsm._process_message(messages[i % cards])
+            if response.fields['Error Code'] != b'00':
+                raise ValueError('KQ failed with error {}'.format(response.fields['Error Code'].decode()))
+        elapsed = time.perf_counter() - started
+        report[name] = {'elapsed': elapsed, 'throughput': requests / elapsed if elapsed else 0.0}
+    return report
+
+
+def format_report(report):
+    """
+    Human-readable benchmark report
+    """
+    def latencies(summary):
+        return '  '.join('{} {}'.format(name, '{:.3f}'.format(summary[name]) if summary[name] is not None else '-')
+                         for name in [p[0] for p in PERCENTILES] + ['max'])
+
+    dump = ''
+    dump += 'Requests sent: {}, responses: {}, errors: {}, timeouts: {}\n'.format(report['sent'], report['responses'], report['errors'], report['timeouts'])
+    dump += 'Throughput: {:.1f} requests/sec in {:.2f} sec\n'.format(report['throughput'], report['elapsed'])
+    dump += 'Latency, ms: {}\n'.format(latencies(report['latency_ms']))
+    for command, result in report['commands'].items():
+        dump += '\t[{}] {:>8} responses {:>6} errors  {}\n'.format(command, result['responses'], result['errors'], latencies(result['latency_ms']))
+    return dump
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Thales HSM load generator')
+    parser.add_argument('-H', '--host', type=str, default='127.0.0.1',
+                        help='HSM host, default 127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=1500,
+                        help='HSM TCP port, default 1500')
+    parser.add_argument('-c', '--connections', type=int, default=1,
+                        help='Number of connections, default 1')
+    parser.add_argument('-d', '--depth', type=int, default=1,
+                        help='Outstanding requests per connection, default 1')
+    parser.add_argument('-r', '--rate', type=float, default=None,
+                        help='Total target rate in requests per second, default unlimited')
+    parser.add_argument('-t', '--duration', type=float, default=10.0,
+                        help='Test duration in seconds, default 10')
+    parser.add_argument('-n', '--requests', type=int, default=None,
+                        help='Total number of requests, default unlimited')
+    parser.add_argument('-m', '--mix', type=str, default=DEFAULT_MIX,
+                        help='Command mix with weights, default {} (supported: {})'.format(DEFAULT_MIX, ', '.join(c.decode() for c in COMMANDS)))
+    parser.add_argument('--timeout', type=float, default=5.0,
+                        help='Seconds to wait for the outstanding responses at the end, default 5')
+    parser.add_argument('-j', '--json', type=str, default=None,
+                        help='Write the report as JSON to the file')
+    parser.add_argument('--kq-cache-benchmark', type=int, default=None, metavar='CARDS',
+                        help='Compare the in-process KQ throughput with and without the card key cache for the number of cards, '
+                             'the number of requests is taken from --requests (default 20000)')
+
+    args = parser.parse_args()
+    if args.kq_cache_benchmark is not None:
+        report = kq_cache_benchmark(requests=args.requests or 20000, cards=args.kq_cache_benchmark)
+        for name in ('uncached', 'cached'):
+            print('{:>8}: {:.1f} requests/sec in {:.2f} sec'.format(name, report[name]['throughput'], report[name]['elapsed']))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+        sys.exit(0)
+    try:
+        report = asyncio.run(benchmark(host=args.host, port=args.port, connections=args.connections, depth=args.depth,
+                                       rate=args.rate, duration=args.duration, requests=args.requests, mix=args.mix,
+                                       timeout=args.timeout))
+    except (ValueError, OSError) as e:
+        print('Error: {}'.format(e))
+        sys.exit(1)
+
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -3,21 +3,222 @@ import socket
 import struct
 import os
 import threading
+import queue
+import weakref
+import types
+import asyncio
+import time
+import heapq
+import itertools
+import multiprocessing
+from array import array
 from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import cpu_count
 
-from tracetools.tracetools import trace
-from collections import OrderedDict
+from datetime import datetime
+from tracetools.tracetools import dump
+from collections import OrderedDict, deque
 from Crypto.Cipher import DES, DES3
 from binascii import hexlify, unhexlify
+from pythales.metrics import MetricsRegistry, MetricsServer, Counter, Histogram
+from pythales.simulation import SimulationProfile, ResponseTimer
 from pynblock.tools import str2bytes, raw2str, raw2B, B2raw, xor, get_visa_pvv, get_visa_cvv, get_digits_from_string, key_CV, get_clear_pin, check_key_parity, modify_key_parity
 
 
+class Field():
+    """
+    Fixed length field
+    """
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+
+class KeyField():
+    """
+    Key field: the key is 33 characters long if it starts with one of the
+    key scheme tags (e.g. b'U'). Otherwise it is 'default' characters long,
+    or absent if no default is given
+    """
+    def __init__(self, name, schemes=b'U', default=None, size=33):
+        self.name = name
+        self.schemes = tuple(bytes([scheme]) for scheme in schemes)
+        self.default = default
+        self.size = size
+
+
+class Delimited():
+    """
+    Variable length field terminated by the delimiter (or by the end of data)
+    """
+    def __init__(self, name, delimiter=b';'):
+        self.name = name
+        self.delimiter = delimiter
+
+
+class Prefixed():
+    """
+    Variable length field preceded by its length (size characters, hex by default).
+    The field is empty if the data ends before the length. The length is stored
+    as length_name, if given. With view=True the field is
+    a memoryview of the request data instead of a copy
+    """
+    def __init__(self, name, size=2, base=16, length_name=None, view=False):
+        self.name = name
+        self.size = size
+        self.base = base
+        self.length_name = length_name
+        self.view = view
+
+
+class Skip():
+    """
+    Unnamed data (e.g. a mandatory delimiter) that is not stored
+    """
+    def __init__(self, size):
+        self.size = size
+
+
+class Marker():
+    """
+    Optional group of fields, present only if the data continues with the marker
+    """
+    def __init__(self, marker, *fields):
+        self.marker = marker
+        self.fields = fields
+
+
+class When():
+    """
+    Fields depending on the value of a field parsed before
+    """
+    def __init__(self, field, values, fields, otherwise=()):
+        self.field = field
+        self.values = tuple(values)
+        self.fields = fields
+        self.otherwise = otherwise
+
+
+class _FieldsCompiler():
+    """
+    Generate the source of a parser function for the field specification.
+    The offsets of consecutive fixed length fields are folded into constants,
+    the running offset variable is only updated after variable length fields
+    """
+    def __init__(self):
+        self.lines = []
+
+
+    @staticmethod
+    def _position(delta):
+        return 'o + {}'.format(delta) if delta else 'o'
+
+
+    def _advance(self, indent, delta):
+        if delta:
+            self.lines.append('{}o += {}'.format(indent, delta))
+
+
+    def _branch(self, indent, condition, delta, fields, otherwise):
+        for keyword, branch in (('if {}:'.format(condition), fields), ('else:', otherwise)):
+            self.lines.append(indent + keyword)
+            size = len(self.lines)
+            self._advance(indent + '    ', self.emit(branch, indent + '    ', delta))
+            if len(self.lines) == size:
+                self.lines.append(indent + '    pass')
+
+
+    def emit(self, fields, indent, delta=0):
+        """
+        Emit the code for the fields, return the offset delta not yet added to the running offset
+        """
+        for field in fields:
+            if isinstance(field, Field):
+                self.lines.append('{}fields[{!r}] = data[{}:{}]'.format(indent, field.name, self._position(delta), self._position(delta + field.size)))
+                delta += field.size
+
+            elif isinstance(field, Skip):
+                delta += field.size
+
+            elif isinstance(field, KeyField):
+                condition = 'data[{}:{}] in {!r}'.format(self._position(delta), self._position(delta + 1), field.schemes)
+                self._branch(indent, condition, delta,
+                             (Field(field.name, field.size),),
+                             (Field(field.name, field.default),) if field.default else ())
+                delta = 0
+
+            elif isinstance(field, Prefixed):
+                start = self._position(delta + field.size)
+                if field.length_name:
+                    self.lines.append('{}fields[{!r}] = data[{}:{}]'.format(indent, field.length_name, self._position(delta), start))
+                # A missing or truncated length is an empty field, as a missing fixed length field
+                self.lines.append('{}n = data[{}:{}]'.format(indent, self._position(delta), start))
+                self.lines.append('{}n = int(n, {}) if len(n) == {} else 0'.format(indent, field.base, field.size))
+                self.lines.append('{}fields[{!r}] = {}[{}:{} + n]'.format(indent, field.name, 'memoryview(data)' if field.view else 'data', start, start))
+                self.lines.append('{}o = {} + n'.format(indent, start))
+                delta = 0
+
+            elif isinstance(field, Delimited):
+                self.lines.append('{}i = data.find({!r}, {})'.format(indent, field.delimiter, self._position(delta)))
+                self.lines.append('{}if i < 0:'.format(indent))
+                self.lines.append('{}    i = len(data)'.format(indent))
+                self.lines.append('{}fields[{!r}] = data[{}:i]'.format(indent, field.name, self._position(delta)))
+                self.lines.append('{}o = i + {}'.format(indent, len(field.delimiter)))
+                delta = 0
+
+            elif isinstance(field, Marker):
+                condition = 'data[{}:{}] == {!r}'.format(self._position(delta), self._position(delta + len(field.marker)), field.marker)
+                self._branch(indent, condition, delta, (Skip(len(field.marker)),) + tuple(field.fields), ())
+                delta = 0
+
+            elif isinstance(field, When):
+                condition = 'fields.get({!r}) in {!r}'.format(field.field, field.values)
+                self._branch(indent, condition, delta, field.fields, field.otherwise)
+                delta = 0
+
+            else:
+                raise TypeError('Unknown field specification: {!r}'.format(field))
+
+        return delta
+
+
+def compile_fields(fields, name='parse'):
+    """
+    Compile the field specification into a function parsing the command data into a dict of fields
+    """
+    compiler = _FieldsCompiler()
+    compiler.emit(fields, '    ')
+    source = 'def {}(data):\n    fields = {{}}\n    o = 0\n{}\n    return fields\n'.format(name, '\n'.join(compiler.lines))
+    namespace = {}
+    exec(compile(source, '<fields {}>'.format(name), 'exec'), namespace)
+    parse = namespace[name]
+    parse.source = source
+    return parse
+
+
 class DummyMessage():
+    """
+    Parsed request. The instances keep nothing but the dict of the parsed fields
+    (no per-instance __dict__, no copy of the payload): the subclasses declare
+    empty __slots__ as well
+    """
+    __slots__ = ('fields',)
+
+    command_code = None
+    response_code = None
+    description = None
+    # Field specification of the command data, compiled into cls._parse when the class is created
+    FIELDS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'FIELDS' in cls.__dict__:
+            cls._parse = staticmethod(compile_fields(cls.FIELDS, '_parse_' + cls.__name__))
+
     def __init__(self, data):
-        self.command_code = None
-        self.description = None
-        self.fields = OrderedDict()
+        self.fields = self._parse(data)
+
+    _parse = staticmethod(compile_fields((), '_parse_DummyMessage'))
 
     def get(self, field):
         """
@@ -54,528 +255,1591 @@ class DummyMessage():
         if self.description:
             dump = dump + '\t[' + 'Command Description'.ljust(width, ' ') + ']: [' + self.description + ']\n'
         for key, value in self.fields.items():
-            dump = dump + '\t[' + key.ljust(width, ' ') + ']: [' + value.decode('utf-8') + ']\n'
+            if isinstance(value, memoryview):
+                value = value.tobytes()
+            try:
+                value = value.decode('utf-8')
+            except UnicodeDecodeError:
+                # binary field
+                value = value.hex().upper()
+            dump = dump + '\t[' + key.ljust(width, ' ') + ']: [' + value + ']\n'
         return dump
 
 
 class A0(DummyMessage):
-    def __init__(self, data):
-        self.data = data
-        self.command_code = b'A0'
-        self.description = 'Generate a Key'
-        self.fields = OrderedDict()
-
-        # Mode - Indicates the operation of the function
-        field_size = 1
-        self.fields['Mode'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
-
-        # Key type
-        field_size = 3
-        self.fields['Key Type'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
-
-        # Key scheme
-        field_size = 1
-        self.fields['Key Scheme'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
-
-        if self.fields['Mode'] == b'1':
-            # Delimiter
-            field_size = 1
-            if self.data[0:field_size] == b';':
-                self.data = self.data[field_size:]
-
-                field_size = 1
-                self.fields['ZMK/TMK Flag'] = self.data[0:field_size]
-                self.data = self.data[field_size:]
-
-            # ZMK (or TMK)
-            if self.data[0:1] in [b'U']:
-                field_size = 33
-                self.fields['ZMK/TMK'] = self.data[0:field_size]
-                self.data = self.data[field_size:]
+    __slots__ = ()
+    command_code = b'A0'
+    response_code = b'A1'
+    description = 'Generate a Key'
+    FIELDS = (
+        Field('Mode', 1),                       # Mode - Indicates the operation of the function
+        Field('Key Type', 3),
+        Field('Key Scheme', 1),
+        When('Mode', [b'1'], (
+            Marker(b';', Field('ZMK/TMK Flag', 1)),
+            KeyField('ZMK/TMK', b'U'),          # ZMK (or TMK)
+        )),
+    )
 
 
 class BU(DummyMessage):
-    def __init__(self, data):
-        self.data = data
-        self.command_code = b'BU'
-        self.description = 'Generate a Key check value'
-        self.fields = OrderedDict()
+    __slots__ = ()
+    command_code = b'BU'
+    response_code = b'BV'
+    description = 'Generate a Key check value'
+    FIELDS = (
+        Field('Key Type Code', 2),
+        Field('Key Length Flag', 1),
+        KeyField('Key', b'U'),
+    )
 
-        # Key type code 
-        field_size = 2
-        self.fields['Key Type Code'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
 
-        # Key length flag
-        field_size = 1
-        self.fields['Key Length Flag'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+class DC(DummyMessage):
+    __slots__ = ()
+    command_code = b'DC'
+    response_code = b'DD'
+    description = 'Verify PIN'
+    FIELDS = (
+        KeyField('TPK', b'UTS'),
+        KeyField('PVK Pair', b'U', default=32),
+        Field('PIN block', 16),
+        Field('PIN block format code', 2),
+        Field('Account Number', 12),
+        Field('PVKI', 1),
+        Field('PVV', 4),
+    )
 
-        # Key
-        if self.data[0:1] in [b'U']:
-            field_size = 33
-            self.fields['Key'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
 
+class CA(DummyMessage):
+    __slots__ = ()
+    command_code = b'CA'
+    response_code = b'CB'
+    description = 'Translate PIN from TPK to ZPK'
+    FIELDS = (
+        KeyField('TPK', b'UTS'),
+        KeyField('Destination Key', b'UTS'),
+        Field('Maximum PIN Length', 2),
+        Field('Source PIN block', 16),
+        Field('Source PIN block format', 2),
+        Field('Destination PIN block format', 2),
+        Field('Account Number', 12),
+    )
+
+
+class CC(DummyMessage):
+    __slots__ = ()
+    command_code = b'CC'
+    response_code = b'CD'
+    description = 'Translate PIN from ZPK to ZPK'
+    FIELDS = (
+        KeyField('Source ZPK', b'UTX'),
+        KeyField('Destination ZPK', b'UTX'),
+        Field('Maximum PIN Length', 2),
+        Field('Source PIN block', 16),
+        Field('Source PIN block format', 2),
+        Field('Destination PIN block format', 2),
+        Field('Account Number', 12),
+    )
+
+
+class CW(DummyMessage):
+    __slots__ = ()
+    command_code = b'CW'
+    response_code = b'CX'
+    description = 'Generate a Card Verification Code'
+    FIELDS = (
+        KeyField('CVK', b'UTS'),
+        Delimited('Primary Account Number', b';'),
+        Field('Expiration Date', 4),
+        Field('Service Code', 3),
+    )
 
-class DC(DummyMessage):
-    def __init__(self, data):
-        self.data = data
-        self.command_code = b'DC'
-        self.description = 'Verify PIN'
-        self.fields = OrderedDict()
-
-        # TPK
-        if self.data[0:1] in [b'U', b'T', b'S']:
-            field_size = 33            
-            self.fields['TPK'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
-
-        # PVK
-        field_size = 33 if self.data[0:1] in [b'U'] else 32
-            
-        self.fields['PVK Pair'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
 
-        # PIN block
-        field_size = 16
-        self.fields['PIN block'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+class CY(DummyMessage):
+    __slots__ = ()
+    command_code = b'CY'
+    response_code = b'CZ'
+    description = 'Verify CVV/CSC'
+    FIELDS = (
+        KeyField('CVK', b'UTS'),
+        Field('CVV', 3),
+        Delimited('Primary Account Number', b';'),
+        Field('Expiration Date', 4),
+        Field('Service Code', 3),
+    )
 
-        # PIN block format code
-        field_size = 2
-        self.fields['PIN block format code'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
 
-        # Account Number
-        field_size = 12
-        self.fields['Account Number'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+class EC(DummyMessage):
+    __slots__ = ()
+    command_code = b'EC'
+    response_code = b'ED'
+    description = 'Verify an Interchange PIN using ABA PVV method'
+    FIELDS = (
+        KeyField('ZPK', b'U', default=32),
+        KeyField('PVK Pair', b'U', default=32),
+        Field('PIN block', 16),
+        Field('PIN block format code', 2),
+        When('PIN block format code', [b'04'], (
+            Field('Token', 18),
+        ), otherwise=(
+            Field('Account Number', 12),
+        )),
+        Field('PVKI', 1),
+        Field('PVV', 4),
+    )
 
-        # PVKI
-        field_size = 1
-        self.fields['PVKI'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
 
-        # PVV
-        field_size = 4
-        self.fields['PVV'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+class FA(DummyMessage):
+    __slots__ = ()
+    command_code = b'FA'
+    response_code = b'FB'
+    description = 'Translate a ZPK from ZMK to LMK'
+    FIELDS = (
+        KeyField('ZMK', b'UT'),
+        KeyField('ZPK', b'UTX'),
+    )
 
 
-class CA(DummyMessage):
-    def __init__(self, data):
-        self.data = data
-        self.command_code = b'CA'
-        self.description = 'Translate PIN from TPK to ZPK'
-        self.fields = OrderedDict()
-
-        # TPK
-        if self.data[0:1] in [b'U', b'T', b'S']:
-            field_size = 33
-            self.fields['TPK'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
-
-        # Destination Key
-        if self.data[0:1] in [b'U', b'T', b'S']:
-            field_size = 33
-            self.fields['Destination Key'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
-
-        # Maximum PIN Length
-        field_size = 2
-        self.fields['Maximum PIN Length'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
-
-        # Source PIN block
-        field_size = 16
-        self.fields['Source PIN block'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
-
-        # Source PIN block format
-        field_size = 2
-        self.fields['Source PIN block format'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
-
-        # Destination PIN block format
-        field_size = 2
-        self.fields['Destination PIN block format'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
-
-        # Account Number
-        field_size = 12
-        self.fields['Account Number'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+class HC(DummyMessage):
+    """
+    Generate a TMK, TPK or PVK
+    """
+    __slots__ = ()
+    command_code = b'HC'
+    response_code = b'HD'
+    description = 'Generate a TMK, TPK or PVK'
+    FIELDS = (
+        KeyField('Current Key', b'U', default=16),
+        Skip(1),                                # ; delimiter
+        Field('Key Scheme (TMK)', 1),
+        Field('Key Scheme (LMK)', 1),
+    )
+
+
+class KQ(DummyMessage):
+    __slots__ = ()
+    command_code = b'KQ'
+    response_code = b'KR'
+    description = 'ARQC Verification and/or ARPC Generation'
+    FIELDS = (
+        Field('Mode Flag', 1),                  # 0 - verify ARQC, 1 - verify ARQC and generate ARPC, 2 - generate ARPC
+        Field('Scheme ID', 1),                  # 0 - Visa (the card key is the session key), 1 - EMV common session key
+        KeyField('MK-AC', b'U', default=32),
+        Field('PAN/PAN Sequence Number', 8),    # binary
+        Field('ATC', 2),                        # binary
+        Field('Unpredictable Number', 4),       # binary
+        Prefixed('Transaction Data', 2, length_name='Transaction Data Length'),
+        Skip(1),                                # ; delimiter
+        Field('ARQC', 8),                       # binary
+        When('Mode Flag', (b'1', b'2'), (
+            Field('ARC', 2),
+        )),
+    )
+
+
+class M0(DummyMessage):
+    """
+    Encrypt data block. The message is a memoryview of the request data
+    """
+    __slots__ = ()
+    command_code = b'M0'
+    response_code = b'M1'
+    description = 'Encrypt Data Block'
+    FIELDS = (
+        Field('Mode Flag', 2),                  # 00 - ECB, 01 - CBC
+        Field('Input Format Flag', 1),          # 0 - binary, 1 - hex-encoded binary
+        Field('Output Format Flag', 1),         # 0 - binary, 1 - hex-encoded binary
+        Field('Key Type', 3),                   # 00A - ZEK, 00B - DEK
+        KeyField('Key', b'U', default=32),
+        When('Mode Flag', (b'01',), (
+            Field('IV', 16),
+        )),
+        # Length of the message as sent (hex characters for the hex-encoded input)
+        Prefixed('Message', 4, length_name='Message Length', view=True),
+    )
+
+
+class M2(M0):
+    """
+    Decrypt data block, the same fields as M0
+    """
+    __slots__ = ()
+    command_code = b'M2'
+    response_code = b'M3'
+    description = 'Decrypt Data Block'
 
 
-class CW(DummyMessage):
-    def __init__(self, data):
-        self.data = data
-        self.command_code = b'CW'
-        self.description = 'Generate a Card Verification Code'
-        self.fields = OrderedDict()
-
-        # CVK
-        if self.data[0:1] in [b'U', b'T', b'S']:
-            field_size = 33
-            self.fields['CVK'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
-
-        # Primary Account Number
-        delimiter_index = 0
-        for byte in self.data:
-            if byte == 59:  # b';'
-                break
-            delimiter_index += 1
+class NC(DummyMessage):
+    """
+    Diagnostics data
+    """
+    __slots__ = ()
+    command_code = b'NC'
+    response_code = b'ND'
+    description = 'Diagnostics data'
+    FIELDS = ()
 
-        self.fields['Primary Account Number'] = self.data[0:delimiter_index]
-        self.data = self.data[delimiter_index + 1:]
 
-        # Expiration Date
-        field_size = 4
-        self.fields['Expiration Date'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+LENGTH_PREFIX = struct.Struct("!H")
 
-        # Service Code
-        field_size = 3
-        self.fields['Service Code'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+# M0/M2 cipher modes and key types (ZEK, DEK)
+DATA_CIPHER_MODES = {b'00': DES3.MODE_ECB, b'01': DES3.MODE_CBC}
+DATA_KEY_TYPES = (b'00A', b'00B')
+# The longest M1/M3 output that fits into a frame together with the header and the other response fields
+MAX_DATA_LENGTH = 0xFFFF - 64
 
 
-class CY(DummyMessage):
-    def __init__(self, data):
-        self.data = data
-        self.command_code = b'CY'
-        self.description = 'Verify CVV/CSC'
-        self.fields = OrderedDict()
-
-        # CVK
-        if self.data[0:1] in [b'U', b'T', b'S']:
-            field_size = 33
-            self.fields['CVK'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
-
-        # CVV
-        field_size = 3
-        self.fields['CVV'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
-
-        # Primary Account Number
-        delimiter_index = 0
-        for byte in self.data:
-            if byte == 59:  # b';'
+class OutgoingMessage(DummyMessage):
+    """
+    The response codes and error codes are expected as bytes (the str values are still
+    accepted and encoded), so the handlers pass the pre-encoded constants, e.g. the
+    response_code of the request class
+    """
+    __slots__ = ('_header', 'command_code')
+
+    def __init__(self, data=None, header=None, response_code=None):
+        self._header = header
+        self.command_code = response_code
+        self.fields = {}
+        if response_code is not None:
+            self.fields['Response Code'] = response_code
+
+    def set_response_code(self, response_code):
+        """
+        """
+        if not isinstance(response_code, bytes):
+            response_code = str2bytes(response_code)
+        self.command_code = response_code
+        self.fields['Response Code'] = response_code
+
+
+    def set_error_code(self, error_code):
+        """
+        """
+        self.fields['Error Code'] = error_code if isinstance(error_code, bytes) else str2bytes(error_code)
+
+
+    def buffers(self):
+        """
+        The outgoing message as a list of scatter buffers: length prefix, header and field values
+        """
+        values = list(self.fields.values())
+        if self._header:
+            return [LENGTH_PREFIX.pack(len(self._header) + sum(map(len, values))), self._header] + values
+        return [LENGTH_PREFIX.pack(sum(map(len, values)))] + values
+
+
+    def build(self):
+        """
+        Build the outgoing message using the stored header
+        """
+        return b''.join(self.buffers())
+
+
+def get_iov_max(default=1024):
+    """
+    Maximum number of buffers in one sendmsg() call, the default if the system does not tell
+    (sysconf() returns -1 if there is no definite limit)
+    """
+    try:
+        iov_max = os.sysconf('SC_IOV_MAX')
+    except (AttributeError, ValueError, OSError):
+        return default
+    return iov_max if iov_max > 0 else default
+
+
+IOV_MAX = get_iov_max()
+
+
+def send_buffers(conn, buffers):
+    """
+    Write all the buffers to the socket with a single sendmsg() (writev) call if possible,
+    instead of concatenating them or sending them one by one
+    """
+    if not hasattr(conn, 'sendmsg'):
+        conn.sendall(b''.join(buffers))
+        return
+
+    buffers = [memoryview(buffer) for buffer in buffers if buffer]
+    position = 0
+    while position < len(buffers):
+        sent = conn.sendmsg(buffers[position:position + IOV_MAX])
+        # Skip the buffers sent completely, and the sent part of the next one
+        while position < len(buffers) and sent >= len(buffers[position]):
+            sent -= len(buffers[position])
+            position += 1
+        if sent:
+            buffers[position] = buffers[position][sent:]
+
+
+def parse_message(data=None):
+    """
+    Parse the incoming message, extract a 4-byte header, and return tuple (header_bytes, command code, command data)
+    """
+    if not data:
+        return None
+    length = struct.unpack_from("!H", data[:2])[0]
+    if length != len(data) - 2:
+        raise ValueError(f'Expected message of length {length} but actual received message length is {len(data) - 2}')
+    # Dynamic 4-byte header following the length
+    header_len = 4
+    header_bytes = data[2:2 + header_len]
+    # Command code is next 2 bytes
+    command_code = data[2 + header_len:2 + header_len + 2]
+    # Remaining is command-specific data
+    command_data = data[2 + header_len + 2:]
+    return (header_bytes, command_code, command_data)
+
+
+# Log levels
+LOG_OFF = 0
+LOG_SUMMARY = 1
+LOG_FULL = 2
+LOG_LEVELS = {'off': LOG_OFF, 'summary': LOG_SUMMARY, 'full': LOG_FULL}
+
+
+class TraceLog():
+    """
+    Non-blocking log: the records are put to a bounded queue and formatted and
+    written by a background thread. The records above the log level are
+    discarded before any formatting, the records that do not fit into the
+    queue are dropped (and counted) instead of blocking the request processing.
+    With queue_size=0 the records are written synchronously
+    """
+    def __init__(self, level=LOG_FULL, queue_size=10000, writer=None):
+        self.level = level
+        self.dropped = 0
+        self._writer = writer if writer else print
+        self._queue = None
+        if queue_size:
+            self._queue = queue.Queue(maxsize=queue_size)
+            threading.Thread(target=self._write_records, daemon=True, name='HSM-log').start()
+
+
+    def log(self, level, message, *args):
+        """
+        Log the message, which is either a format string for the args or a callable returning the text
+        """
+        if level > self.level:
+            return
+        if self._queue is None:
+            self._write(message, args)
+            return
+        try:
+            self._queue.put_nowait((message, args))
+        except queue.Full:
+            self.dropped += 1
+
+
+    def summary(self, message, *args):
+        self.log(LOG_SUMMARY, message, *args)
+
+
+    def full(self, message, *args):
+        self.log(LOG_FULL, message, *args)
+
+
+    def trace(self, data, title, *args):
+        """
+        Hex dump of the data at the full level, only the title at the summary level
+        """
+        if self.level >= LOG_FULL:
+            self.log(LOG_FULL, self._format_trace, datetime.now(), data, title, args)
+        elif self.level >= LOG_SUMMARY:
+            self.log(LOG_SUMMARY, title, *args)
+
+
+    @staticmethod
+    def _format_trace(timestamp, data, title, args):
+        return '{} {}\n{}'.format(timestamp.strftime("%H:%M:%S.%f"), title.format(*args), dump(bytes(data)))
+
+
+    def flush(self, timeout=None):
+        """
+        Wait until the queued records are written
+        """
+        if self._queue is None:
+            return
+        deadline = time.monotonic() + timeout if timeout else None
+        while self._queue.unfinished_tasks:
+            if deadline and time.monotonic() > deadline:
                 break
-            delimiter_index += 1
+            time.sleep(0.01)
 
-        self.fields['Primary Account Number'] = self.data[0:delimiter_index]
-        self.data = self.data[delimiter_index + 1:]
 
-        # Expiration Date
-        field_size = 4
-        self.fields['Expiration Date'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+    def _write(self, message, args):
+        try:
+            self._writer(message(*args) if callable(message) else message.format(*args))
+        except Exception:
+            pass
 
-        # Service Code
-        field_size = 3
-        self.fields['Service Code'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
 
+    def _write_records(self):
+        while True:
+            message, args = self._queue.get()
+            self._write(message, args)
+            self._queue.task_done()
 
-class EC(DummyMessage):
-    def __init__(self, data):
-        self.data = data
-        self.command_code = b'EC'
-        self.description = 'Verify an Interchange PIN using ABA PVV method'
-        self.fields = OrderedDict()
-
-        # ZPK
-        field_size = 33 if self.data[0:1] == b'U' else 32
-        self.fields['ZPK'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
-
-        # PVK Pair
-        field_size = 33 if self.data[0:1] in [b'U'] else 32
-        self.fields['PVK Pair'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
-
-        # PIN block
-        field_size = 16
-        self.fields['PIN block'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
-
-        # PIN block format code
-        field_size = 2
-        self.fields['PIN block format code'] = self.data[0:field_size]
-        self.data = self.data[field_size:]        
-
-        if self.fields['PIN block format code'] != b'04':
-            # Account Number
-            field_size = 12
-            self.fields['Account Number'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
+
+# Synchronous log of the connection events, for the connections created without a log
+DEFAULT_LOG = TraceLog(level=LOG_SUMMARY, queue_size=0)
+
+
+class FrameReader():
+    """
+    Buffered reader of the length-prefixed frames. The socket is read in big
+    chunks into a reusable buffer (recv_into), and all the complete frames
+    found in the buffer are split out, so a pipelined burst of requests costs
+    a single system call. The buffer grows if a frame does not fit into it
+    """
+    def __init__(self, conn, buffer_size=16384):
+        self.conn = conn
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self._frames = deque()
+
+
+    def _fill(self):
+        """
+        Read the socket once, return the number of bytes received (0 if the connection is closed)
+        """
+        pending = self._end - self._start
+        if not pending:
+            self._start = self._end = 0
         else:
-            # Token
-            field_size = 18
-            self.fields['Token'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
+            needed = 2 + ((self._buffer[self._start] << 8) | self._buffer[self._start + 1]) if pending >= 2 else 2
+            if self._start + needed > len(self._buffer):
+                # Move the incomplete frame to the beginning of the buffer, or to a bigger buffer
+                if needed > len(self._buffer):
+                    buffer = bytearray(max(needed, 2 * len(self._buffer)))
+                    buffer[0:pending] = self._view[self._start:self._end]
+                    self._view.release()
+                    self._buffer = buffer
+                    self._view = memoryview(buffer)
+                else:
+                    self._view[0:pending] = self._view[self._start:self._end]
+                self._start = 0
+                self._end = pending
+
+        received = self.conn.recv_into(self._view[self._end:])
+        self._end += received
+        return received
+
+
+    def _split(self):
+        buffer = self._buffer
+        start = self._start
+        end = self._end
+        while end - start >= 2:
+            size = 2 + ((buffer[start] << 8) | buffer[start + 1])
+            if end - start < size:
+                break
+            self._frames.append(bytes(self._view[start:start + size]))
+            start += size
+        self._start = start
 
-        # PVKI
-        field_size = 1
-        self.fields['PVKI'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
 
-        # PVV
-        field_size = 4
-        self.fields['PVV'] = self.data[0:field_size]
-        self.data = self.data[field_size:] 
+    def read_frames(self):
+        """
+        Get all the buffered complete frames, reading the socket only if there are none.
+        Returns an empty list if the connection is closed
+        """
+        while not self._frames:
+            if not self._fill():
+                return []
+            self._split()
+        frames = list(self._frames)
+        self._frames.clear()
+        return frames
 
 
-class FA(DummyMessage):
-    def __init__(self, data):
-        self.data = data
-        self.command_code = b'FA'
-        self.description = 'Translate a ZPK from ZMK to LMK'
-        self.fields = OrderedDict()
-
-        # ZMK
-        if self.data[0:1] in [b'U', b'T']:
-            field_size = 33            
-            self.fields['ZMK'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
-
-        # ZPK
-        if self.data[0:1] in [b'U', b'T', b'X']:
-            field_size = 33            
-            self.fields['ZPK'] = self.data[0:field_size]
-            self.data = self.data[field_size:]
-            
+    def read_frame(self):
+        """
+        Get the next frame, None if the connection is closed
+        """
+        while not self._frames:
+            if not self._fill():
+                return None
+            self._split()
+        return self._frames.popleft()
 
-class HC(DummyMessage):
+
+    def read_available(self):
+        """
+        Get the raw data: everything buffered, or the result of a single read
+        """
+        if not self._frames and self._start == self._end:
+            self._fill()
+        data = b''.join(self._frames) + bytes(self._view[self._start:self._end])
+        self._frames.clear()
+        self._start = self._end = 0
+        return data
+
+
+class ClientConnection():
     """
-    Generate a TMK, TPK or PVK
+    Outbound side of a client connection. Responses produced by the pool workers
+    are queued here and written to the socket by a single writer thread, so that
+    concurrent writes never interleave. With ordered=True the responses are sent
+    in the order of the requests, otherwise as soon as they are ready (the client
+    matches them by the message header). If send_many is given, all the responses
+    ready at the moment are written with one send_many(conn, responses, client_name) call
     """
-    def __init__(self, data):
-        self.data = data
-        self.command_code = b'HC'
-        self.description = 'Generate a TMK, TPK or PVK'
-        self.fields = OrderedDict()
+    def __init__(self, conn, client_name, send, ordered=True, log=None, send_many=None):
+        self.conn = conn
+        self.log = log if log else DEFAULT_LOG
+        self.client_name = client_name
+        self.ordered = ordered
+        # Requests admitted and not yet answered, maintained by AdmissionControl
+        self.in_flight = 0
+        self._send = send
+        self._send_many = send_many
+        self._queue = queue.Queue()
+        self._submitted = 0
+        self._broken = False
+        self._writer_thread = threading.Thread(target=self._writer,
+                                               daemon=True,
+                                               name=f"HSM-writer-{client_name}")
+        self._writer_thread.start()
+
+
+    def register(self):
+        """
+        Reserve the sequence number for the next request. Called by the reader only
+        """
+        seq = self._submitted
+        self._submitted += 1
+        return seq
 
-        # Current Key
-        field_size = 33 if self.data[0:1] in [b'U'] else 16
-        self.fields['Current Key'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
 
-        # ; delimiter
-        field_size = 1
-        self.data = self.data[field_size:]
+    def put(self, seq, response, written=None):
+        """
+        Queue the response to the request with the given sequence number.
+        None is queued for the requests without a response, to keep the sequence.
+        written(connection) is called once the response is sent
+        """
+        self._queue.put((seq, response, written))
 
-        # Key Scheme (TMK)
-        field_size = 1
-        self.fields['Key Scheme (TMK)'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
 
-        # Key Scheme (LMK)
-        field_size = 1
-        self.fields['Key Scheme (LMK)'] = self.data[0:field_size]
-        self.data = self.data[field_size:]
+    def close(self):
+        """
+        No more requests: the writer closes the socket once all the pending responses are sent
+        """
+        self._queue.put(None)
 
 
-class NC(DummyMessage):
+    def join(self, timeout=None):
+        self._writer_thread.join(timeout)
+
+
+    def _write(self, responses):
+        responses = [response for response in responses if response is not None]
+        if not responses or self._broken:
+            return
+        try:
+            if self._send_many:
+                self._send_many(self.conn, responses, self.client_name)
+            else:
+                for response in responses:
+                    self._send(self.conn, response, self.client_name)
+        except OSError as e:
+            self._broken = True
+            self.log.summary("Error sending response to {}: {}", self.client_name, e)
+
+
+    def _writer(self):
+        pending = {}
+        expected = 0
+        written = 0
+        closing = False
+        while not closing or written < self._submitted:
+            items = [self._queue.get()]
+            # Coalesce everything that is ready into one write
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            ready = []
+            for item in items:
+                if item is None:
+                    closing = True
+                    continue
+
+                seq, response, callback = item
+                if not self.ordered:
+                    ready.append((response, callback))
+                    written += 1
+                    continue
+
+                pending[seq] = (response, callback)
+                while expected in pending:
+                    ready.append(pending.pop(expected))
+                    expected += 1
+                    written += 1
+            self._write([response for response, _ in ready])
+            for _, callback in ready:
+                if callback is not None:
+                    callback(self)
+
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+        self.log.summary("Closed connection: {}", self.client_name)
+
+
+def _set_result(future, result):
     """
-    Diagnostics data
+    Complete the future from the event loop, unless it is cancelled
     """
-    def __init__(self, data):
-        self.data = data
-        self.command_code = b'NC'
-        self.description = 'Diagnostics data'
-        self.fields = OrderedDict()
+    if not future.done():
+        future.set_result(result)
 
 
-class OutgoingMessage(DummyMessage):
-    def __init__(self, data=None, header=None):
-        self._header = header
-        self.description = None
-        self.fields = OrderedDict()
+class AsyncConnection():
+    """
+    Connection served on the event loop. The reader queues the future of the response
+    to every request, in the order of the requests, with the callback to call once
+    the response is written; None when the connection is done
+    """
+    __slots__ = ('client_name', 'in_flight', 'responses', '__weakref__')
 
-    def set_response_code(self, response_code):
+    def __init__(self, client_name):
+        self.client_name = client_name
+        # Requests admitted and not yet answered, maintained by AdmissionControl
+        self.in_flight = 0
+        self.responses = asyncio.Queue()
+
+
+class AdmissionControl():
+    """
+    Limits of the requests in flight (received and not yet answered), in total and per
+    connection, None meaning unlimited. acquire() either waits for a free slot, so the
+    reader stops reading the socket and TCP flow control pushes back on the client,
+    or fails at once and the caller replies with the busy error
+    """
+    def __init__(self, max_in_flight=None, max_per_connection=None):
+        self.max_in_flight = max_in_flight
+        self.max_per_connection = max_per_connection
+        self.enabled = bool(max_in_flight or max_per_connection)
+        self.in_flight = 0
+        self.rejected = 0
+        self.waits = 0
+        self._condition = threading.Condition()
+
+
+    def _available(self, connection):
+        return ((not self.max_in_flight or self.in_flight < self.max_in_flight) and
+                (not self.max_per_connection or connection.in_flight < self.max_per_connection))
+
+
+    def acquire(self, connection, block=True):
         """
+        Admit a request from the connection, return False if it is rejected (block=False only)
         """
-        self.command_code = response_code
-        self.fields['Response Code'] = str2bytes(response_code)
+        if not self.enabled:
+            return True
+        with self._condition:
+            if not self._available(connection):
+                if not block:
+                    self.rejected += 1
+                    return False
+                self.waits += 1
+                self._condition.wait_for(lambda: self._available(connection))
+            self.in_flight += 1
+            connection.in_flight += 1
+            return True
 
 
-    def set_error_code(self, error_code):
+    def try_acquire(self, connection):
         """
+        Admit a request from the connection if there is a free slot, without waiting or counting a rejection
         """
-        self.fields['Error Code'] = str2bytes(error_code)
+        if not self.enabled:
+            return True
+        with self._condition:
+            if not self._available(connection):
+                return False
+            self.in_flight += 1
+            connection.in_flight += 1
+            return True
 
 
-    def build(self):
+    def release(self, connection):
         """
-        Build the outgoing message using the stored header
+        The request admitted with acquire() is answered
         """
-        data = b''
-        for key, value in self.fields.items():
-            data += value
+        if not self.enabled:
+            return
+        with self._condition:
+            self.in_flight -= 1
+            connection.in_flight -= 1
+            self._condition.notify_all()
+
+
+# Priority classes of the commands, highest first. The commands not listed are in the 'default' class
+DEFAULT_CLASS = 'default'
+DEFAULT_PRIORITY_CLASSES = (
+    ('pin', (b'CA', b'CC', b'DC', b'EC')),
+    (DEFAULT_CLASS, ()),
+    ('keys', (b'A0', b'HC')),
+)
+
+
+def parse_priority_classes(specs):
+    """
+    Parse the priority classes, highest first, e.g. ['pin=EC,DC', 'keys=A0,HC'] ->
+    (('pin', (b'EC', b'DC')), ('keys', (b'A0', b'HC')), ('default', ())).
+    The default class is the lowest one, unless it is listed
+    """
+    classes = []
+    for spec in specs:
+        name, _, commands = spec.partition('=')
+        name = name.strip()
+        if not name or name in [c[0] for c in classes]:
+            raise ValueError('Invalid or duplicate priority class: {}'.format(spec))
+        classes.append((name, tuple(command.strip().upper().encode() for command in commands.split(',') if command.strip())))
+    if DEFAULT_CLASS not in [c[0] for c in classes]:
+        classes.append((DEFAULT_CLASS, ()))
+    return tuple(classes)
+
+
+def parse_connection_weights(specs):
+    """
+    Parse the client weights, e.g. ['10.0.0.1=4'] -> {'10.0.0.1': 4.0}
+    """
+    weights = {}
+    for spec in specs:
+        host, _, weight = spec.partition('=')
+        try:
+            weights[host.strip()] = float(weight)
+        except ValueError:
+            raise ValueError('Invalid connection weight: {}'.format(spec))
+        if weights[host.strip()] <= 0:
+            raise ValueError('Connection weight must be positive: {}'.format(spec))
+    return weights
+
+
+class FairScheduler():
+    """
+    Orders the requests waiting for a pool worker: strict priority between the
+    command classes, and weighted fair queuing between the connections within
+    a class (self-clocked: a request is stamped with the finish tag of the
+    connection's previous one, or the class virtual time if later, plus 1/weight,
+    and the lowest tag runs first). Every submitted request queues one pool task,
+    which runs the first request in this order, not necessarily its own
+    """
+    def __init__(self, executor, classes=DEFAULT_PRIORITY_CLASSES, wait_histograms=None):
+        self.executor = executor
+        self.classes = [name for name, _ in classes]
+        if DEFAULT_CLASS not in self.classes:
+            raise ValueError('The {} priority class is missing'.format(DEFAULT_CLASS))
+        self._default = self.classes.index(DEFAULT_CLASS)
+        self._class_of = {}
+        for index, (name, commands) in enumerate(classes):
+            for command_code in commands:
+                self._class_of.setdefault(command_code, index)
+        # Queue wait time per class
+        self.wait_histograms = wait_histograms if wait_histograms else [Histogram() for _ in self.classes]
+        self._queues = [[] for _ in self.classes]
+        self._virtual_time = [0.0] * len(self.classes)
+        # Finish tags of the last requests of the connections, per class
+        self._finish = weakref.WeakKeyDictionary()
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+
+    def class_of(self, command_code):
+        """
+        Index of the priority class of the command
+        """
+        return self._class_of.get(command_code, self._default)
+
+
+    def queued(self, index):
+        return len(self._queues[index])
+
+
+    def __len__(self):
+        return sum(map(len, self._queues))
+
+
+    def submit(self, connection, weight, command_code, function, *args):
+        """
+        Queue function(*args) for the request of the connection
+        """
+        index = self.class_of(command_code)
+        with self._lock:
+            finish = self._finish.get(connection)
+            if finish is None:
+                finish = self._finish[connection] = [0.0] * len(self.classes)
+            tag = finish[index] = max(finish[index], self._virtual_time[index]) + 1.0 / weight
+            heapq.heappush(self._queues[index], (tag, next(self._order), time.perf_counter(), function, args))
+        self.executor.submit(self._run_next)
+
+
+    def _run_next(self):
+        with self._lock:
+            for index, queue in enumerate(self._queues):
+                if queue:
+                    tag, _, queued, function, args = heapq.heappop(queue)
+                    self._virtual_time[index] = tag
+                    break
+            else:
+                return
+        self.wait_histograms[index].record(time.perf_counter() - queued)
+        function(*args)
+
+
+class WorkingKey():
+    """
+    Working key (ZPK, TPK, CVK etc) decrypted under the LMK.
+    The DES3 cipher objects are not shared between threads: every thread gets
+    its own cipher, built on the first use
+    """
+    __slots__ = ('clear_key', 'parity', '_local')
+
+    def __init__(self, clear_key):
+        self.clear_key = clear_key
+        self.parity = check_key_parity(clear_key)
+        # Dropped with the thread, so the connection threads leave nothing behind
+        self._local = threading.local()
+
+    def get_cipher(self):
+        """
+        DES3 ECB cipher built with the clear key, for the calling thread
+        """
+        try:
+            return self._local.cipher
+        except AttributeError:
+            cipher = self._local.cipher = DES3.new(self.clear_key, DES3.MODE_ECB)
+            return cipher
+
+
+class KeyCache():
+    """
+    Bounded thread-safe LRU cache of the working keys, keyed by the LMK-encrypted key
+    (also used for the responses to the deterministic commands).
+    Entries older than ttl seconds are reloaded, size=0 disables the cache
+    """
+    def __init__(self, size=1024, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Incremented by clear(): a value loaded before is not cached
+        self._generation = 0
+
+
+    def get(self, key, load):
+        """
+        Get the cached value, or load(key) it and cache the result
+        """
+        generation = self.generation
+        value = self.lookup(key)
+        if value is None:
+            value = load(key)
+            self.put(key, value, generation)
+        return value
+
+
+    @property
+    def generation(self):
+        """
+        Pass to put() to drop a value loaded before a clear()
+        """
+        return self._generation
+
+
+    def lookup(self, key):
+        """
+        Get the cached value, None if it is not cached or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        return None
+
+
+    def put(self, key, value, generation=None):
+        """
+        Cache the value, unless the cache was cleared since the given generation
+        """
+        if not self.size:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl if self.ttl else None, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+# Odd parity version of every byte value, the same as modify_key_parity() gives
+PARITY_TABLE = bytes(modify_key_parity(bytes([byte]))[0] for byte in range(256))
+
+
+class GeneratedKey():
+    """
+    Random double length key with odd parity, encrypted under the LMK
+    """
+    __slots__ = ('clear_key', 'under_lmk', 'check_value')
+
+    def __init__(self, clear_key, under_lmk, check_value):
+        self.clear_key = clear_key
+        self.under_lmk = under_lmk
+        self.check_value = check_value
+
+
+class KeyPool():
+    """
+    Bounded pool of pre-generated keys. A background thread refills the pool to its size
+    once it drops below the low-water mark, so a burst of key generation requests is
+    served from memory; the keys are generated inline only if the pool runs dry.
+    generate(count) returns a list of new keys; size=0 disables the pool
+    """
+    # Keys generated at a time by the refill thread
+    REFILL_BATCH = 64
+
+    def __init__(self, generate, size=1024, low_water=None):
+        self.size = size
+        self.low_water = low_water if low_water is not None else size // 4
+        self.hits = 0
+        self.misses = 0
+        self._generate = generate
+        self._keys = deque()
+        self._lock = threading.Lock()
+        self._refill = threading.Event()
+        self._epoch = 0
+        self._thread = None
+
+
+    def start(self):
+        """
+        Start the refill thread and fill the pool
+        """
+        with self._lock:
+            if not self.size or self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._refiller, daemon=True, name='HSM-key-pool')
+        self._thread.start()
+        self._refill.set()
+
+
+    def get(self):
+        with self._lock:
+            key = self._keys.popleft() if self._keys else None
+            if key is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            low = len(self._keys) < self.low_water
+        if low and self.size:
+            if self._thread is None:
+                self.start()
+            self._refill.set()
+
+        while key is None:
+            keys = self._generate(1)
+            key = keys[0] if keys else None
+        return key
+
+
+    def clear(self):
+        """
+        Drop the pooled keys, e.g. encrypted under the previous LMK
+        """
+        with self._lock:
+            self._epoch += 1
+            self._keys.clear()
+        self._refill.set()
+
+
+    def __len__(self):
+        return len(self._keys)
+
+
+    def _refiller(self):
+        while True:
+            self._refill.wait()
+            self._refill.clear()
+            while len(self._keys) < self.size:
+                epoch = self._epoch
+                keys = self._generate(min(self.REFILL_BATCH, self.size - len(self._keys)))
+                with self._lock:
+                    if epoch == self._epoch:
+                        self._keys.extend(keys)
+
+
+def derive_card_key(cipher, pan_psn):
+    """
+    EMV Option A derivation of the card master key (e.g. MK-AC) from the 8-byte
+    PAN/PAN sequence number block, cipher is the issuer master key DES3 cipher
+    """
+    inverted = bytes(byte ^ 0xFF for byte in pan_psn)
+    return cipher.encrypt(pan_psn + inverted).translate(PARITY_TABLE)
+
+
+def derive_session_key(cipher, atc):
+    """
+    EMV common session key derivation from the ATC, cipher is the card master key DES3 cipher
+    """
+    return cipher.encrypt(atc + b'\xF0\x00\x00\x00\x00\x00' + atc + b'\x0F\x00\x00\x00\x00\x00').translate(PARITY_TABLE)
+
+
+def retail_mac(key, data, padding=1):
+    """
+    ISO 9797-1 MAC algorithm 3 with the double length key, padding method 1 (zeros) or 2 (0x80 and zeros)
+    """
+    if padding == 2:
+        data = data + b'\x80'
+    if len(data) % 8 or not data:
+        data = data + bytes(8 - len(data) % 8)
+    chained = DES.new(key[:8], DES.MODE_CBC, iv=bytes(8)).encrypt(data[:-8])[-8:] if len(data) > 8 else bytes(8)
+    last = bytes(a ^ b for a, b in zip(chained, data[-8:]))
+    # Final block: encrypt with the left key, decrypt with the right one, encrypt with the left one
+    return DES3.new(key, DES3.MODE_ECB).encrypt(last)
+
+
+def generate_arpc(cipher, arqc, arc):
+    """
+    ARPC method 1: the ARQC XOR the authorisation response code, encrypted with the session key
+    """
+    return cipher.encrypt(bytes(a ^ b for a, b in zip(arqc, arc.ljust(8, b'\x00'))))
+
+
+# LMK used if none is configured
+DEFAULT_LMK = 'deafbeedeafbeedeafbeedeafbeedeaf'
+
+
+# Command registry: command code -> parser class, command code -> handler(hsm, request, header)
+COMMAND_CLASSES = {}
+COMMAND_HANDLERS = {}
+
+# Entry point group of the modules registering additional commands
+PLUGINS_GROUP = 'pythales.commands'
+_plugins_loaded = False
+
+
+def register_command(command_code, handler, parser=None, response_code=None):
+    """
+    Register the handler of the command. parser is a DummyMessage subclass or a FIELDS
+    specification to build one (no fields if None); response_code defaults to the one
+    of the parser class
+    """
+    if parser is None or isinstance(parser, (tuple, list)):
+        parser = type(command_code.decode('ascii'), (DummyMessage,), {
+            '__slots__': (),
+            'command_code': command_code,
+            'description': handler.__doc__.strip().splitlines()[0] if handler.__doc__ else None,
+            'FIELDS': tuple(parser or ()),
+        })
+    if response_code is not None and response_code != parser.response_code:
+        # The parser class may be shared with other commands: never change it in place
+        parser = type(parser.__name__, (parser,), {'__slots__': (), 'response_code': response_code})
+    if not parser.response_code:
+        raise ValueError('No response code for command {}'.format(command_code))
+    COMMAND_CLASSES[command_code] = parser
+    COMMAND_HANDLERS[command_code] = handler
+
+
+def hsm_command(command_code, parser=None, response_code=None):
+    """
+    Decorator registering the function as the handler of the command. The handler is called
+    as handler(hsm, request, header): it may be an HSM method, or a function in a plugin module
 
-        return struct.pack("!H", len(self._header) + len(data)) + self._header + data if self._header else struct.pack("!H", len(data)) + data
+        @hsm_command(b'CC', parser=CC, response_code=b'CD')
+        def translate_pinblock_zpk(hsm, request, header):
+            ...
+    """
+    def register(handler):
+        register_command(command_code, handler, parser, response_code)
+        return handler
+    return register
 
 
-def parse_message(data=None):
+def load_plugins(group=PLUGINS_GROUP):
     """
-    Parse the incoming message, extract a 4-byte header, and return tuple (header_bytes, command code, command data)
+    Import the modules listed in the entry point group, once: the modules register their commands with @hsm_command
     """
-    if not data:
-        return None
-    length = struct.unpack_from("!H", data[:2])[0]
-    if length != len(data) - 2:
-        raise ValueError(f'Expected message of length {length} but actual received message length is {len(data) - 2}')
-    # Dynamic 4-byte header following the length
-    header_len = 4
-    header_bytes = data[2:2 + header_len]
-    # Command code is next 2 bytes
-    command_code = data[2 + header_len:2 + header_len + 2]
-    # Remaining is command-specific data
-    command_data = data[2 + header_len + 2:]
-    return (header_bytes, command_code, command_data)
+    global _plugins_loaded
+    if _plugins_loaded:
+        return
+    _plugins_loaded = True
+
+    from importlib.metadata import entry_points
+    try:
+        plugins = entry_points(group=group)
+    except TypeError:
+        plugins = entry_points().get(group, [])
+    for plugin in plugins:
+        try:
+            plugin.load()
+        except Exception as e:
+            print('Error loading commands plugin {}: {}'.format(plugin.name, e), file=sys.stderr)
+
+
+# Indexes of the request counters in HSM.stats
+STAT_REQUESTS = 0
+STAT_ERRORS = 1
+STATS_SIZE = 2
 
 
 class HSM():
-    # Map command codes to parser classes to avoid long if/elif chains
-    COMMAND_CLASSES = {
-        b'A0': A0,
-        b'BU': BU,
-        b'CA': CA,
-        b'CW': CW,
-        b'CY': CY,
-        b'DC': DC,
-        b'EC': EC,
-        b'FA': FA,
-        b'HC': HC,
-        b'NC': NC,
-    }
-    # Map command codes to handler methods for response generation
-    RESPONSE_HANDLERS = {
-        b'A0': lambda self, request, header: self.generate_key_a0(request, header),
-        b'BU': lambda self, request, header: self.get_key_check_value(request, header),
-        b'CA': lambda self, request, header: self.translate_pinblock(request, header),
-        b'CW': lambda self, request, header: self.generate_cvv(request, header),
-        b'CY': lambda self, request, header: self.verify_cvv(request, header),
-        b'DC': lambda self, request, header: self.verify_pin(request, header),
-        b'EC': lambda self, request, header: self.verify_pin(request, header),
-        b'FA': lambda self, request, header: self.translate_zpk(request, header),
-        b'HC': lambda self, request, header: self.generate_key(request, header),
-        b'NC': lambda self, request, header: self.get_diagnostics_data(header),
-    }
-
-    def __init__(self, key=None, debug=None, skip_parity=None, port=None, approve_all=None):
+    # Parser classes and handlers of the commands, filled by @hsm_command
+    COMMAND_CLASSES = COMMAND_CLASSES
+    COMMAND_HANDLERS = COMMAND_HANDLERS
+    # Read-only view of the registered handlers under the former name: handler(hsm, request, header)
+    RESPONSE_HANDLERS = types.MappingProxyType(COMMAND_HANDLERS)
+    # Commands always giving the same response to the same data, which may be cached.
+    # Never add the commands using random values (A0, HC)
+    CACHEABLE_COMMANDS = frozenset((b'BU', b'CW', b'CY', b'NC'))
+
+    def __init__(self, key=None, debug=None, skip_parity=None, port=None, approve_all=None, reuse_port=None, stats=None, out_of_order=None, key_cache_size=1024, key_cache_ttl=None, log_level=LOG_FULL, log_queue_size=10000, metrics_port=None, nodelay=None, sndbuf=None, rcvbuf=None, backlog=128, key_pool_size=1024, key_pool_low_water=None, response_cache_size=0, response_cache_ttl=None, card_key_cache_size=1024, max_in_flight=None, max_in_flight_per_connection=None, busy_error_code=None, priority_classes=None, connection_weights=None, simulation_profile=None):
         self.firmware_version = '0007-E000'        
-        self.LMK = unhexlify(key) if key else unhexlify('deafbeedeafbeedeafbeedeafbeedeaf')
-        self.cipher = DES3.new(self.LMK, DES3.MODE_ECB)
+        self.log = TraceLog(level=log_level, queue_size=log_queue_size)
+        # Buffered readers of the connections served with recv_message() and recv()
+        self._readers = weakref.WeakKeyDictionary()
+        self.key_cache = KeyCache(size=key_cache_size, ttl=key_cache_ttl)
+        self.key_pool = KeyPool(self._generate_keys, size=key_pool_size, low_water=key_pool_low_water)
+        # Response fields of the CACHEABLE_COMMANDS, keyed by the command code and data
+        self.response_cache = KeyCache(size=response_cache_size, ttl=response_cache_ttl)
+        # Card master keys derived from the issuer master keys, keyed by (issuer key, PAN/PSN)
+        self.card_key_cache = KeyCache(size=card_key_cache_size)
+        self.LMK = unhexlify(key) if key else unhexlify(DEFAULT_LMK)
         self.debug = debug
         self.skip_parity_check = skip_parity
         self.port = port if port else 1500
         self.approve_all = approve_all
+        self.reuse_port = reuse_port
+        self.out_of_order = out_of_order
+        # Socket options, None keeps the system default
+        self.nodelay = nodelay
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.backlog = backlog
+        # Request counters, indexed by STAT_* constants. In the multi-process mode
+        # this is a view on the worker's slot in the memory shared with the supervisor
+        self.stats = stats if stats is not None else array('Q', bytes(8 * STATS_SIZE))
+        # The pool threads update the counters concurrently
+        self._stats_lock = threading.Lock()
         self.thread_pool = ThreadPoolExecutor(max_workers=cpu_count())
+        # Bounds the requests queued to the thread pool. Over the limit the client reader waits
+        # (TCP backpressure), or, if the busy error code is given, the request is rejected with it
+        self.admission = AdmissionControl(max_in_flight, max_in_flight_per_connection)
+        self.busy_error_code = str2bytes(busy_error_code) if isinstance(busy_error_code, str) else busy_error_code
+        if self.busy_error_code is not None and len(self.busy_error_code) != 2:
+            raise ValueError('Busy error code must be 2 characters long')
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self._init_metrics()
+        # Requests from the client readers go to the pool through the scheduler, so a batch of
+        # low priority commands or one busy client does not delay everything queued after it
+        priority_classes = priority_classes if priority_classes else DEFAULT_PRIORITY_CLASSES
+        self.scheduler = FairScheduler(self.thread_pool, priority_classes,
+                                       [self.metrics.histogram('hsm_queue_wait_seconds', 'Time waited for a pool worker by priority class', **{'class': name})
+                                        for name, _ in priority_classes])
+        for index, name in enumerate(self.scheduler.classes):
+            self.metrics.gauge('hsm_scheduler_queued', lambda index=index: self.scheduler.queued(index), 'Requests waiting for a pool worker by priority class', **{'class': name})
+        # Scheduling weights of the clients by host, 1 by default
+        self.connection_weights = connection_weights if connection_weights else {}
+        # Service times, licensed throughput and injected errors of a real HSM (SimulationProfile or file name).
+        # The delayed responses are held by one timer thread, not by the workers
+        self.profile = SimulationProfile.load(simulation_profile) if isinstance(simulation_profile, str) else simulation_profile
+        self.response_timer = ResponseTimer()
+        self.metrics.gauge('hsm_delayed_responses', lambda: len(self.response_timer), 'Responses held back by the simulation profile')
+        load_plugins()
+        self._resolve_commands()
         if self.approve_all:
             print('\n\n\tHSM is forced to approve all the requests!\n')
 
 
+    def _resolve_commands(self):
+        """
+        Bind the registered handlers to this instance, once: command code -> (parser class, bound handler).
+        The handlers defined in the body of an HSM class are looked up by name, so the overrides
+        in the subclasses apply; any other registered function is bound as it is
+        """
+        self._commands = {}
+        classes = type(self).__mro__
+        for command_code, handler in COMMAND_HANDLERS.items():
+            if any(vars(cls).get(handler.__name__) is handler for cls in classes):
+                bound = getattr(self, handler.__name__)
+            else:
+                bound = types.MethodType(handler, self)
+            self._commands[command_code] = (COMMAND_CLASSES[command_code], bound)
+
+
+    @property
+    def LMK(self):
+        return self._LMK
+
+    @LMK.setter
+    def LMK(self, value):
+        """
+        Changing the LMK invalidates all the cached working keys
+        """
+        DES3.new(value, DES3.MODE_ECB)  # validate the key
+        self._LMK = value
+        self._lmk_check_value = key_CV(raw2B(value), 16)
+        self._local = threading.local()
+        self.key_cache.clear()
+        self.card_key_cache.clear()
+        self.key_pool.clear()
+        self.response_cache.clear()
+
+    @property
+    def cipher(self):
+        """
+        LMK cipher of the calling thread. The cipher objects are never used
+        by several threads concurrently, so the pool workers need no lock
+        """
+        try:
+            return self._local.cipher
+        except AttributeError:
+            cipher = self._local.cipher = DES3.new(self._LMK, DES3.MODE_ECB)
+            return cipher
+
+
     def init_connection(self):
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.bind(('', self.port))   
-            self.sock.listen(5)
+            self.sock = self._listen()
             print('Listening on port {}'.format(self.port))
         except OSError as msg:
             print('Error starting server: {}'.format(msg))
             sys.exit()
 
 
-    def _recv_exact(self, conn, size, client_name=None):
-        buf = b''
-        while len(buf) < size:
-            chunk = conn.recv(size - len(buf))
-            if not chunk:
-                try:
-                    conn.shutdown(socket.SHUT_RDWR)
-                except OSError:
-                    pass
-                print(f"Client disconnected during recv: {client_name}")
-                raise IOError("Connection closed while reading")
-            buf += chunk
-        return buf
+    def _listen(self, reuse_address=False):
+        """
+        Listening socket, configured before listen()
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if reuse_address:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                # Several worker processes listen on the same port, the kernel shards the connections
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self._set_buffer_sizes(sock)
+            sock.bind(('', self.port))
+            sock.listen(self.backlog)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+
+    def _set_buffer_sizes(self, sock):
+        """
+        Set on the listening socket, so that the accepted connections inherit them
+        (and the TCP window scale is negotiated for the receive buffer size)
+        """
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+
+    def _configure_client_socket(self, conn):
+        if self.nodelay is not None:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if self.nodelay else 0)
+
+
+    def _get_reader(self, conn):
+        reader = self._readers.get(conn)
+        if reader is None:
+            reader = self._readers[conn] = FrameReader(conn)
+        return reader
+
+
+    def _disconnected(self, conn, client_name):
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.log.summary("Client disconnected during recv: {}", client_name)
+        raise IOError("Connection closed while reading")
+
+
+    def _read_frames(self, reader, client_name=None):
+        """
+        Get all the complete frames received from the client
+        """
+        frames = reader.read_frames()
+        if not frames:
+            self._disconnected(reader.conn, client_name)
+        for data in frames:
+            self.log.trace(data, '<< {} bytes received from {}: ', len(data), client_name)
+        return frames
+
 
     def recv_message(self, conn, client_name=None):
         # frame-based read: length prefix + body
-        length_bytes = self._recv_exact(conn, 2, client_name)
-        length = struct.unpack("!H", length_bytes)[0]
-        body = self._recv_exact(conn, length, client_name)
-        data = length_bytes + body
-        trace(data, f'<< {len(data)} bytes received from {client_name}: ')
+        data = self._get_reader(conn).read_frame()
+        if data is None:
+            self._disconnected(conn, client_name)
+        self.log.trace(data, '<< {} bytes received from {}: ', len(data), client_name)
         return data
 
     def recv(self, conn, client_name=None):
         """
-        Receive data from client connection and ensure it's in bytes format
+        Receive data from client connection (whatever is available, not split into frames)
         """
-        data = conn.recv(4096)
+        data = self._get_reader(conn).read_available()
         if len(data):
-            # Ensure data is bytes type before passing to trace
-            if isinstance(data, str):
-                data = data.encode('utf-8')
-            # Always make sure we're passing bytes to tracetools.trace()
-            if not isinstance(data, bytes):
-                data = bytes(data)
-            trace(data, '<< {} bytes received from {}: '.format(len(data), client_name))
+            self.log.trace(data, '<< {} bytes received from {}: ', len(data), client_name)
             return data
         else:
             try:
                 conn.shutdown(socket.SHUT_RDWR)
             except OSError:
                 pass
-            print ('Client disconnected: {}'.format(client_name))
+            self.log.summary('Client disconnected: {}', client_name)
             raise IOError
 
 
     def send(self, conn, response, client_name=None):
+        self.send_many(conn, [response], client_name)
+
+    def send_many(self, conn, responses, client_name=None):
+        """
+        Send the responses with one gathered write: the length prefixes, headers and
+        fields are passed to sendmsg() as separate buffers, without concatenating them
+        """
+        buffers = [response.buffers() for response in responses]
+        send_buffers(conn, [buffer for response_buffers in buffers for buffer in response_buffers])
+        if self.log.level < LOG_SUMMARY:
+            return
         # include thread name and active count in logs
         thread_name = threading.current_thread().name
-        response_data = response.build()
-        conn.send(response_data)
-        trace(response_data, f'>> [{thread_name}] {len(response_data)} bytes sent to {client_name}:')
-        print(f"[{thread_name}] Active threads: {threading.active_count()}")
-        print(response.trace())
+        for response, response_buffers in zip(responses, buffers):
+            response_data = b''.join(response_buffers) if self.log.level >= LOG_FULL else response_buffers
+            self.log.trace(response_data, '>> [{}] {} bytes sent to {}:', thread_name, sum(map(len, response_buffers)), client_name)
+            self.log.full(response.trace)
+        self.log.full("[{}] Active threads: {}", thread_name, threading.active_count())
+
+    def _init_metrics(self):
+        self.metrics = MetricsRegistry()
+        self._parse_failures = self.metrics.counter('hsm_parse_failures_total', 'Frames that could not be parsed')
+        self._unsupported_commands = self.metrics.counter('hsm_unsupported_commands_total', 'Requests with unsupported command codes')
+        self._in_flight = Counter()
+        self.metrics.gauge('hsm_requests_in_flight', self._in_flight.get, 'Requests received and not yet answered')
+        self.metrics.gauge('hsm_queue_depth', lambda: len(self.scheduler), 'Requests waiting for a pool worker')
+        self.metrics.gauge('hsm_admission_rejected_total', lambda: self.admission.rejected, 'Requests rejected with the busy error over the in-flight limit', kind='counter')
+        self.metrics.gauge('hsm_admission_waits_total', lambda: self.admission.waits, 'Times a client reader waited for a free in-flight slot', kind='counter')
+        self.metrics.gauge('hsm_key_cache_hits_total', lambda: self.key_cache.hits, 'Working key cache hits', kind='counter')
+        self.metrics.gauge('hsm_key_cache_misses_total', lambda: self.key_cache.misses, 'Working key cache misses', kind='counter')
+        self.metrics.gauge('hsm_key_pool_size', lambda: len(self.key_pool), 'Pre-generated keys available')
+        self.metrics.gauge('hsm_key_pool_hits_total', lambda: self.key_pool.hits, 'Keys served from the pool', kind='counter')
+        self.metrics.gauge('hsm_key_pool_misses_total', lambda: self.key_pool.misses, 'Keys generated inline, the pool being empty', kind='counter')
+        self.metrics.gauge('hsm_log_dropped_total', lambda: self.log.dropped, 'Log records dropped on overload', kind='counter')
+        self.metrics.gauge('hsm_card_key_cache_hits_total', lambda: self.card_key_cache.hits, 'Derived card key cache hits', kind='counter')
+        self.metrics.gauge('hsm_card_key_cache_misses_total', lambda: self.card_key_cache.misses, 'Derived card key cache misses', kind='counter')
+        self.metrics.gauge('hsm_response_cache_size', lambda: self.response_cache.get_stats()['size'], 'Cached responses')
+        self.metrics.gauge('hsm_response_cache_misses_total', lambda: self.response_cache.misses, 'Cacheable requests not found in the response cache', kind='counter')
+        # Metrics per command code and per (command code, error code), resolved once
+        self._command_metrics = {}
+        self._response_counters = {}
+        self._cache_hit_counters = {}
+
+
+    def _get_command_metrics(self, command_code):
+        metrics = self._command_metrics.get(command_code)
+        if metrics is None:
+            command = command_code.decode('utf-8', 'replace')
+            metrics = self._command_metrics[command_code] = (
+                self.metrics.counter('hsm_requests_total', 'Requests by command code', command=command),
+                self.metrics.histogram('hsm_request_duration_seconds', 'Request processing time by command code', command=command))
+        return metrics
+
+
+    def _cached_response(self, command_code, data, header):
+        """
+        The response to the request from the response cache, or None
+        """
+        if command_code not in self.CACHEABLE_COMMANDS or not self.response_cache.size:
+            return None
+        fields = self.response_cache.lookup(data[6:])
+        if fields is None:
+            return None
 
-    def _handle_message(self, conn, data, client_name):
-        thread_name = threading.current_thread().name
-        print(f"[{thread_name}] Handling message from {client_name}")
+        counter = self._cache_hit_counters.get(command_code)
+        if counter is None:
+            counter = self._cache_hit_counters[command_code] = self.metrics.counter(
+                'hsm_response_cache_hits_total', 'Responses served from the response cache by command code',
+                command=command_code.decode('utf-8', 'replace'))
+        counter.inc()
+        response = OutgoingMessage(header=header, response_code=fields['Response Code'])
+        response.fields = dict(fields)
+        return response
+
+
+    def _injected_error(self, command_code, request_cls, header):
+        """
+        The response with the error injected by the simulation profile, or None
+        """
+        if self.profile is None or request_cls.response_code is None:
+            return None
+        error_code = self.profile.inject_error(command_code)
+        if error_code is None:
+            return None
+        response = OutgoingMessage(header=header, response_code=request_cls.response_code)
+        response.set_error_code(error_code)
+        return response
+
+
+    def _response_delay(self, data, response):
+        """
+        Seconds to hold the response for, according to the simulation profile
+        """
+        if self.profile is None or response is None:
+            return 0
+        return self.profile.delay(data[6:8])
+
+
+    def _count_response(self, command_code, error_code):
+        counter = self._response_counters.get((command_code, error_code))
+        if counter is None:
+            counter = self._response_counters[(command_code, error_code)] = self.metrics.counter(
+                'hsm_responses_total', 'Responses by command code and error code',
+                command=command_code.decode('utf-8', 'replace'), error_code=error_code.decode('utf-8', 'replace'))
+        counter.inc()
+
+
+    def _count(self, index):
+        with self._stats_lock:
+            self.stats[index] += 1
+
+
+    def _process_message(self, data, client_name=None):
+        """
+        Parse the incoming frame and build the response to it.
+        Returns None if the command is not supported
+        """
+        started = time.perf_counter()
+        self._count(STAT_REQUESTS)
         try:
-            # parse and build response
             header_bytes, command_code, command_data = parse_message(data)
-            # instantiate request using mapping
-            request_cls = self.COMMAND_CLASSES.get(command_code)
-            if not request_cls:
-                print(f"Unsupported command: {command_code.hex()}")
-                return
-            request = request_cls(command_data)
+            # instantiate request using the registry
+            command = self._commands.get(command_code)
+            if not command:
+                self._unsupported_commands.inc()
+                self.log.summary("Unsupported command: {}", command_code.hex())
+                return None
+            request_cls, handler = command
+            # A response computed under the LMK replaced in the meantime is not cached
+            generation = self.response_cache.generation
+            response = self._injected_error(command_code, request_cls, header_bytes)
+            if response is None:
+                response = self._cached_response(command_code, data, header_bytes)
+            if response is None:
+                request = request_cls(command_data)
+        except Exception:
+            self._parse_failures.inc()
+            raise
+
+        requests, duration = self._get_command_metrics(command_code)
+        requests.inc()
+        error_code = b'exception'
+        try:
+            if response is None:
+                self.log.full(request.trace)
+                response = handler(request, header_bytes)
+                if command_code in self.CACHEABLE_COMMANDS:
+                    self.response_cache.put(data[6:], dict(response.fields), generation)
+            error_code = response.get('Error Code') or b''
+            return response
+        finally:
+            duration.record(time.perf_counter() - started)
+            self._count_response(command_code, error_code)
 
-            # trace and select response handler
-            print(request.trace())
-            handler = self.RESPONSE_HANDLERS.get(command_code)
-            if handler:
-                response = handler(self, request, header_bytes)
-            else:
-                response = self.get_response(request, header_bytes)
-            self.send(conn, response, client_name)
+    def _handle_message(self, connection, data, client_name, seq):
+        self.log.full("[{}] Handling message from {}", threading.current_thread().name, client_name)
+        response = None
+        try:
+            response = self._process_message(data, client_name)
         except Exception as e:
-            print(f"Error processing async request from {client_name}: {e}")
+            self._count(STAT_ERRORS)
+            self.log.summary("Error processing async request from {}: {}", client_name, e)
+        finally:
+            delay = self._response_delay(data, response)
+            if delay > 0:
+                self.response_timer.call_at(time.monotonic() + delay, self._deliver, connection, seq, response)
+            else:
+                self._deliver(connection, seq, response)
+
+
+    def _deliver(self, connection, seq, response):
+        """
+        Hand the response over to the connection writer. The request stays in flight until
+        the response is sent, so a client that does not read its responses is held back
+        by the admission limits, and so are the responses held by the simulation profile
+        """
+        connection.put(seq, response, self._written)
+
+
+    def _written(self, connection):
+        self._in_flight.inc(-1)
+        self.admission.release(connection)
+
+
+    def _busy_response(self, data):
+        """
+        Response with the busy error code to the request rejected by the admission control,
+        None if the command is not supported
+        """
+        try:
+            header_bytes, command_code, _ = parse_message(data)
+        except (ValueError, struct.error):
+            return None
+        command = self._commands.get(command_code)
+        if not command or command[0].response_code is None:
+            return None
+        self.log.summary("Busy, rejected {} request", command_code.decode('utf-8', 'replace'))
+        self._count_response(command_code, self.busy_error_code)
+        response = OutgoingMessage(header=header_bytes, response_code=command[0].response_code)
+        response.set_error_code(self.busy_error_code)
+        return response
+
+    def start_metrics_server(self):
+        """
+        Expose the metrics on the local HTTP port, if configured
+        """
+        if not self.metrics_port or self.metrics_server:
+            return
+        try:
+            self.metrics_server = MetricsServer(self.metrics, self.metrics_port).start()
+            print('Metrics available at http://127.0.0.1:{}/metrics'.format(self.metrics_server.port))
+        except OSError as msg:
+            print('Error starting metrics server: {}'.format(msg))
+
 
     def run(self):
         self.init_connection()
+        self.start_metrics_server()
+        self.key_pool.start()
         print(self.info())
         try:
             # accept loop: spawn a thread for each incoming client
@@ -583,7 +1847,7 @@ class HSM():
                 try:
                     conn, (ip, port) = self.sock.accept()
                 except Exception as e:
-                    print(f"Error accepting connection: {e}")
+                    self.log.summary("Error accepting connection: {}", e)
                     continue
                 client_name = ip + ':' + str(port)
                 threading.Thread(target=self._client_thread,
@@ -597,28 +1861,192 @@ class HSM():
                 self.sock.close()
             except:
                 pass
+            self.log.flush(1)
 
     def _client_thread(self, conn, client_name):
         """
         Handle a client connection: receive messages and process them asynchronously 
-        while keeping the connection open.
+        while keeping the connection open. The responses are sent by the connection writer
         """
-        print(f'Connected client: {client_name}')
+        self.log.summary('Connected client: {}', client_name)
+        self._configure_client_socket(conn)
+        connection = ClientConnection(conn, client_name, self.send, ordered=not self.out_of_order, log=self.log, send_many=self.send_many)
+        reader = FrameReader(conn)
+        weight = self.connection_weights.get(client_name.rsplit(':', 1)[0], 1.0)
         try:
             # Process messages asynchronously in thread pool while keeping connection
             while True:
-                data = self.recv_message(conn, client_name)
-                self.thread_pool.submit(self._handle_message, conn, data, client_name)
+                for data in self._read_frames(reader, client_name):
+                    seq = connection.register()
+                    admitted = False
+                    try:
+                        admitted = self.admission.acquire(connection, block=self.busy_error_code is None)
+                        if not admitted:
+                            connection.put(seq, self._busy_response(data))
+                            continue
+                        self._in_flight.inc()
+                        # The command code follows the length prefix and the 4-byte header
+                        self.scheduler.submit(connection, weight, data[6:8], self._handle_message, connection, data, client_name, seq)
+                    except Exception:
+                        # Fill the gap in the sequence, or the writer waits for this response forever
+                        connection.put(seq, None, self._written if admitted else None)
+                        raise
         except IOError:
-            print(f"Connection lost: {client_name}")
+            self.log.summary("Connection lost: {}", client_name)
         except Exception as e:
-            print(f"Error processing request from {client_name}: {e}")
+            self.log.summary("Error processing request from {}: {}", client_name, e)
         finally:
-            try:
-                conn.close()
-            except:
-                pass
-            print(f"Closed connection: {client_name}")
+            connection.close()
+
+    async def _recv_message_async(self, reader, client_name=None):
+        """
+        Read a length-prefixed frame from the asyncio stream
+        """
+        try:
+            length_bytes = await reader.readexactly(2)
+            length = struct.unpack("!H", length_bytes)[0]
+            body = await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            self.log.summary("Client disconnected during recv: {}", client_name)
+            raise IOError("Connection closed while reading")
+        data = length_bytes + body
+        self.log.trace(data, '<< {} bytes received from {}: ', len(data), client_name)
+        return data
+
+    async def _client_async(self, reader, writer):
+        """
+        Handle a client connection on the event loop. As in the threads engine, the requests
+        go through the admission control and the scheduler to the thread pool, so a slow
+        command does not hold up the other connections. The writer task sends the responses
+        in the order of the requests, each once it is due (the simulation profile holds
+        some of them back), so no response overtakes the previous one
+        """
+        ip, port = writer.get_extra_info('peername')[:2]
+        client_name = ip + ':' + str(port)
+        self.log.summary('Connected client: {}', client_name)
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            self._configure_client_socket(sock)
+        loop = asyncio.get_running_loop()
+        connection = AsyncConnection(client_name)
+        weight = self.connection_weights.get(ip, 1.0)
+        writer_task = loop.create_task(self._writer_async(writer, connection))
+        try:
+            while True:
+                data = await self._recv_message_async(reader, client_name)
+                future = loop.create_future()
+                if not await self._admit_async(connection):
+                    future.set_result((self._busy_response(data), 0))
+                    connection.responses.put_nowait((future, None))
+                    continue
+                connection.responses.put_nowait((future, self._written))
+                self._in_flight.inc()
+                try:
+                    # The command code follows the length prefix and the 4-byte header
+                    self.scheduler.submit(connection, weight, data[6:8], self._handle_async, loop, future, data, client_name)
+                except Exception:
+                    future.set_result((None, 0))
+                    raise
+        except (IOError, ConnectionError):
+            self.log.summary("Connection lost: {}", client_name)
+        except Exception as e:
+            self.log.summary("Error processing request from {}: {}", client_name, e)
+        finally:
+            connection.responses.put_nowait(None)
+            await writer_task
+            self.log.summary("Closed connection: {}", client_name)
+
+    async def _admit_async(self, connection):
+        """
+        Admit the request without blocking the event loop. Over the limits the request is
+        rejected with the busy error code, if given, or the connection is not read until
+        a slot is free, waiting for it in an executor thread
+        """
+        if self.admission.try_acquire(connection):
+            return True
+        if self.busy_error_code is not None:
+            return self.admission.acquire(connection, block=False)
+        return await asyncio.get_running_loop().run_in_executor(None, self.admission.acquire, connection)
+
+    def _handle_async(self, loop, future, data, client_name):
+        """
+        Process the request in a pool worker, pass (response, due time) to the event loop
+        """
+        response = None
+        try:
+            response = self._process_message(data, client_name)
+        except Exception as e:
+            self._count(STAT_ERRORS)
+            self.log.summary("Error processing request from {}: {}", client_name, e)
+        finally:
+            due = time.monotonic() + self._response_delay(data, response)
+            loop.call_soon_threadsafe(_set_result, future, (response, due))
+
+    async def _writer_async(self, writer, connection):
+        """
+        Write the responses of the connection in the order of the requests, each once it is due.
+        The admission slot of a request is released when its response is written
+        """
+        broken = False
+        while True:
+            item = await connection.responses.get()
+            if item is None:
+                break
+            future, written = item
+            response, due = await future
+            if response is not None and not broken:
+                delay = due - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self._write_async(writer, response, connection.client_name)
+                try:
+                    await writer.drain()
+                except ConnectionError as e:
+                    broken = True
+                    self.log.summary("Error sending response to {}: {}", connection.client_name, e)
+            if written is not None:
+                written(connection)
+        writer.close()
+
+    def _write_async(self, writer, response, client_name):
+        if writer.is_closing():
+            return
+        response_buffers = response.buffers()
+        writer.writelines(response_buffers)
+        if self.log.level < LOG_SUMMARY:
+            return
+        response_data = b''.join(response_buffers) if self.log.level >= LOG_FULL else response_buffers
+        self.log.trace(response_data, '>> {} bytes sent to {}:', sum(map(len, response_buffers)), client_name)
+        self.log.full(response.trace)
+
+    async def serve_async(self):
+        """
+        Serve the clients on a single asyncio event loop
+        """
+        try:
+            # The buffer sizes must be set before listen() for the accepted connections to inherit them
+            server = await asyncio.start_server(self._client_async, sock=self._listen(reuse_address=True), backlog=self.backlog)
+        except OSError as msg:
+            print('Error starting server: {}'.format(msg))
+            sys.exit()
+        print('Listening on port {}'.format(self.port))
+        self.start_metrics_server()
+        self.key_pool.start()
+        print(self.info())
+        async with server:
+            await server.serve_forever()
+
+    def run_async(self):
+        """
+        asyncio-based alternative to run(): all the connections are served
+        by one event loop instead of a thread per client
+        """
+        try:
+            asyncio.run(self.serve_async())
+        except KeyboardInterrupt:
+            print("\nServer shutdown requested, exiting...")
+        finally:
+            self.log.flush(1)
 
     def info(self):
         """
@@ -629,41 +2057,83 @@ class HSM():
         return dump
 
 
-    def _debug_trace(self, data):
+    def _debug_trace(self, message, *args):
         """
+        Log the debug message, formatted with the args by the log writer thread
         """
         if self.debug:
-            print('\tDEBUG: {}\n'.format(data))
+            self.log.summary('\tDEBUG: ' + message + '\n', *args)
+
+
+    def _load_working_key(self, key):
+        return WorkingKey(self.cipher.decrypt(B2raw(key)))
+
+
+    def _working_key(self, key):
+        """
+        Get the working key encrypted under the LMK, cached
+        """
+        if key[0:1] in [b'U']:
+            key = key[1:]
+        return self.key_cache.get(key, self._load_working_key)
+
+
+    def _load_card_key(self, key):
+        issuer_key, pan_psn = key
+        return WorkingKey(derive_card_key(self._working_key(issuer_key).get_cipher(), pan_psn))
+
+
+    def _card_key(self, issuer_key, pan_psn):
+        """
+        Get the card master key derived from the issuer master key encrypted under the LMK, cached
+        """
+        if issuer_key[0:1] in [b'U']:
+            issuer_key = issuer_key[1:]
+        return self.card_key_cache.get((issuer_key, pan_psn), self._load_card_key)
+
+
+    def _generate_keys(self, count):
+        """
+        Generate random keys with odd parity, encrypted under the LMK and with the check values
+        """
+        clear_keys = os.urandom(16 * count).translate(PARITY_TABLE)
+        # ECB: all the keys are encrypted with one call, each independently
+        keys_under_lmk = self.cipher.encrypt(clear_keys)
+        keys = []
+        for i in range(0, len(clear_keys), 16):
+            clear_key = clear_keys[i:i + 16]
+            try:
+                check_value = key_CV(raw2B(clear_key), 6)
+            except ValueError:
+                # Degenerate key (the halves are equal)
+                continue
+            keys.append(GeneratedKey(clear_key, b'U' + raw2B(keys_under_lmk[i:i + 16]), check_value))
+        return keys
 
 
     def _decrypt_pinblock(self, encrypted_pinblock, encrypted_terminal_key):
         """
         Decrypt pin block
         """
-        if encrypted_terminal_key[0:1] in [b'U']:
-            clear_terminal_key = self.cipher.decrypt(B2raw(encrypted_terminal_key[1:]))
-        else:
-            clear_terminal_key = self.cipher.decrypt(B2raw(encrypted_terminal_key))
-
-        cipher = DES3.new(clear_terminal_key, DES3.MODE_ECB)
+        cipher = self._working_key(encrypted_terminal_key).get_cipher()
         decrypted_pinblock = cipher.decrypt(B2raw(encrypted_pinblock))
         return raw2B(decrypted_pinblock)
 
 
+    @hsm_command(b'CW', parser=CW)
     def generate_cvv(self, request, header):
         """
         Get response to CW command
         """
-        response =  OutgoingMessage(header=header)
-        response.set_response_code('CX')
+        response = OutgoingMessage(header=header, response_code=request.response_code)
 
         if not self.check_key_parity(self.cipher, request.get('CVK')):
             self._debug_trace('CVK parity error')
             if self.approve_all:
                 self._debug_trace('Forced approval as --approve-all option set')
-                response.set_error_code('00')
+                response.set_error_code(b'00')
             else:
-                response.set_error_code('10')
+                response.set_error_code(b'10')
             return response
 
         CVK = request.get('CVK')
@@ -671,21 +2141,21 @@ class HSM():
             CVK = CVK[1:]
         cvv = get_visa_cvv(request.get('Primary Account Number'), request.get('Expiration Date'), request.get('Service Code'), CVK)
 
-        response.set_error_code('00')
+        response.set_error_code(b'00')
         response.set('CVV', str2bytes(cvv))
         return response     
 
 
+    @hsm_command(b'CY', parser=CY)
     def verify_cvv(self, request, header):
         """
         Get response to CY command
         """
-        response =  OutgoingMessage(header=header)
-        response.set_response_code('CZ')
+        response = OutgoingMessage(header=header, response_code=request.response_code)
         
         if not self.check_key_parity(self.cipher, request.get('CVK')):
             self._debug_trace('CVK parity error')
-            response.set_error_code('10')
+            response.set_error_code(b'10')
             return response
 
         CVK = request.get('CVK')
@@ -694,42 +2164,40 @@ class HSM():
         cvv = get_visa_cvv(request.get('Primary Account Number'), request.get('Expiration Date'), request.get('Service Code'), CVK)
         
         if str2bytes(cvv) == request.get('CVV'):
-            response.set_error_code('00')
+            response.set_error_code(b'00')
         else:
-            self._debug_trace('CVV mismatch: {} != {}'.format(cvv, request.get('CVV').decode('utf-8')))
+            self._debug_trace('CVV mismatch: {} != {}', cvv, request.get('CVV').decode('utf-8'))
             if self.approve_all:
                 self._debug_trace('Forced approval as --approve-all option set')
-                response.set_error_code('00')
+                response.set_error_code(b'00')
             else:
-                response.set_error_code('01')
+                response.set_error_code(b'01')
             
         return response
 
 
+    @hsm_command(b'HC', parser=HC)
     def generate_key(self, request, header):
         """
         Get response to HC command
         TODO: generating keys for different schemes
         """
-        response =  OutgoingMessage(header=header)
-        response.set_response_code('HD')
-        response.set_error_code('00')
+        response = OutgoingMessage(header=header, response_code=request.response_code)
+        response.set_error_code(b'00')
 
-        new_clear_key = modify_key_parity(bytes(os.urandom(16)))
-        self._debug_trace('Generated key: {}'.format(raw2str(new_clear_key)))
+        new_key = self.key_pool.get()
+        self._debug_trace('Generated key: {}', raw2str(new_key.clear_key))
 
         current_key = request.get('Current Key')
         if current_key[0:1] in [b'U']:
             current_key = current_key[1:]
 
-        clear_current_key = self.cipher.decrypt(B2raw(current_key))
-        curr_key_cipher = DES3.new(clear_current_key, DES3.MODE_ECB)
+        curr_key_cipher = self._working_key(current_key).get_cipher()
 
-        new_key_under_current_key = curr_key_cipher.encrypt(new_clear_key)
-        new_key_under_lmk = self.cipher.encrypt(new_clear_key)
+        new_key_under_current_key = curr_key_cipher.encrypt(new_key.clear_key)
 
         response.set('New key under the current key', b'U' + raw2B(new_key_under_current_key))
-        response.set('New key under LMK', b'U' + raw2B(new_key_under_lmk))
+        response.set('New key under LMK', new_key.under_lmk)
 
         return response
 
@@ -740,85 +2208,87 @@ class HSM():
         if self.skip_parity_check:
             return True
         else:
+            if cipher is self.cipher:
+                return self._working_key(_key).parity
             key = _key[1:] if _key[0:1] in [b'U'] else _key
             return check_key_parity(cipher.decrypt(B2raw(key)))
 
 
+    @hsm_command(b'DC', parser=DC)
+    @hsm_command(b'EC', parser=EC)
     def verify_pin(self, request, header):
         """
         Get response to DC or EC command
         """
-        response =  OutgoingMessage(header=header)
+        response = OutgoingMessage(header=header, response_code=request.response_code)
         command_code = request.get_command_code()
 
         if command_code == b'DC':            
-            response.set_response_code('DD')
             key_type = 'TPK'
         elif command_code == b'EC':
-            response.set_response_code('ED')
             key_type = 'ZPK'
 
         if not self.check_key_parity(self.cipher, request.get(key_type)):
-            self._debug_trace(key_type + ' parity error')
+            self._debug_trace('{} parity error', key_type)
             if self.approve_all:
                 self._debug_trace('Forced approval as --approve-all option set')
-                response.set_error_code('00')
+                response.set_error_code(b'00')
             else:
-                response.set_error_code('10')
+                response.set_error_code(b'10')
             return response
 
         if not self.check_key_parity(self.cipher, request.get('PVK Pair')):
             self._debug_trace('PVK parity error')
             if self.approve_all:
                 self._debug_trace('Forced approval as --approve-all option set')
-                response.set_error_code('00')
+                response.set_error_code(b'00')
             else:
-                response.set_error_code('11')
+                response.set_error_code(b'11')
             return response     
 
         if len(request.get('PVK Pair')) != 32:
             self._debug_trace('PVK not double length')
             if self.approve_all:
                 self._debug_trace('Forced approval as --approve-all option set')
-                response.set_error_code('00')
+                response.set_error_code(b'00')
             else:
-                response.set_error_code('27')
+                response.set_error_code(b'27')
             return response
 
         decrypted_pinblock = self._decrypt_pinblock(request.get('PIN block'), request.get(key_type))
-        self._debug_trace('Decrypted pinblock: {}'.format(decrypted_pinblock.decode('utf-8')))
+        self._debug_trace('Decrypted pinblock: {}', decrypted_pinblock.decode('utf-8'))
         
         try:
             pin = get_clear_pin(decrypted_pinblock, request.get('Account Number'))
             pvv = get_visa_pvv(request.get('Account Number'), request.get('PVKI'), pin[:4], request.get('PVK Pair'))
             if pvv == request.get('PVV'):
-                response.set_error_code('00')
+                response.set_error_code(b'00')
             else:
-                self._debug_trace('PVV mismatch: {} != {}'.format(pvv.decode('utf-8'), request.get('PVV').decode('utf-8')))
+                self._debug_trace('PVV mismatch: {} != {}', pvv.decode('utf-8'), request.get('PVV').decode('utf-8'))
                 if self.approve_all:
                     self._debug_trace('Forced approval as --approve-all option set')
-                    response.set_error_code('00')
+                    response.set_error_code(b'00')
                 else:
-                    response.set_error_code('01')
+                    response.set_error_code(b'01')
 
             return response
 
         except ValueError as err:
-            self._debug_trace(err)
+            self._debug_trace('{}', err)
             if self.approve_all:
                 self._debug_trace('Forced approval as --approve-all option set')
-                response.set_error_code('00')
+                response.set_error_code(b'00')
             else:
-                response.set_error_code('01')
+                response.set_error_code(b'01')
             return response
 
 
+    @hsm_command(b'CA', parser=CA)
     def translate_pinblock(self, request, header):
         """
-        Get response to CA command (Translate PIN from TPK to ZPK)
+        Get response to CA command (Translate PIN from TPK to ZPK). Both keys come from the working key cache
         """
-        response = OutgoingMessage(header=header)
-        response.set_response_code('CB')
+        response = OutgoingMessage(header=header, response_code=request.response_code)
         pinblock_format = request.get('Destination PIN block format')
 
         if request.get('Destination PIN block format') != request.get('Source PIN block format'):
@@ -832,9 +2302,9 @@ class HSM():
             self._debug_trace('Source TPK parity error')
             if self.approve_all:
                 self._debug_trace('Forced approval as --approve-all option set')
-                response.set_error_code('00')
+                response.set_error_code(b'00')
             else:
-                response.set_error_code('10')
+                response.set_error_code(b'10')
             return response
 
         # Destination key parity check
@@ -842,50 +2312,190 @@ class HSM():
             self._debug_trace('Destination ZPK parity error')
             if self.approve_all:
                 self._debug_trace('Forced approval as --approve-all option set')
-                response.set_error_code('00')
+                response.set_error_code(b'00')
             else:
-                response.set_error_code('11')
+                response.set_error_code(b'11')
             return response
 
         decrypted_pinblock = self._decrypt_pinblock(request.get('Source PIN block'), request.get('TPK'))
-        self._debug_trace('Decrypted pinblock: {}'.format(decrypted_pinblock.decode('utf-8')))
+        self._debug_trace('Decrypted pinblock: {}', decrypted_pinblock.decode('utf-8'))
         
-        pin_length = decrypted_pinblock[0:2]
+        translated_pin_block = self._working_key(request.get('Destination Key')).get_cipher().encrypt(B2raw(decrypted_pinblock))
+
+        response.set_error_code(b'00')
+        response.set('PIN Length', decrypted_pinblock[0:2])
+        response.set('Destination PIN Block', raw2B(translated_pin_block))
+        response.set('Destination PIN Block format', pinblock_format)
+
+        return response
+
+
+    @hsm_command(b'CC', parser=CC)
+    def translate_pinblock_zpk(self, request, header):
+        """
+        Get response to CC command (Translate PIN from ZPK to ZPK). The clear ZPKs and
+        their ciphers come from the working key cache, so they are not rebuilt per request
+        """
+        response = OutgoingMessage(header=header, response_code=request.response_code)
+        pinblock_format = request.get('Destination PIN block format')
+
+        if pinblock_format != request.get('Source PIN block format'):
+            raise ValueError('Cannot translate PIN block from format {} to format {}'.format(request.get('Source PIN block format').decode('utf-8'), pinblock_format.decode('utf-8')))
+
+        for key_type, error_code in (('Source ZPK', b'10'), ('Destination ZPK', b'11')):
+            if not self.check_key_parity(self.cipher, request.get(key_type)):
+                self._debug_trace('{} parity error', key_type)
+                if self.approve_all:
+                    self._debug_trace('Forced approval as --approve-all option set')
+                    response.set_error_code(b'00')
+                else:
+                    response.set_error_code(error_code)
+                return response
+
+        decrypted_pinblock = self._decrypt_pinblock(request.get('Source PIN block'), request.get('Source ZPK'))
+        self._debug_trace('Decrypted pinblock: {}', decrypted_pinblock.decode('utf-8'))
 
-        destination_key = request.get('Destination Key')
-        if destination_key[0:1] in [b'U']:
-            destination_key = destination_key[1:]
-        cipher = DES3.new(B2raw(destination_key), DES3.MODE_ECB)
-        translated_pin_block = cipher.encrypt(B2raw(decrypted_pinblock))
+        translated_pin_block = self._working_key(request.get('Destination ZPK')).get_cipher().encrypt(B2raw(decrypted_pinblock))
 
-        response.set_error_code('00')
+        response.set_error_code(b'00')
         response.set('PIN Length', decrypted_pinblock[0:2])
         response.set('Destination PIN Block', raw2B(translated_pin_block))
         response.set('Destination PIN Block format', pinblock_format)
+        return response
+
+
+    @hsm_command(b'KQ', parser=KQ)
+    def verify_arqc(self, request, header):
+        """
+        Get response to KQ command (ARQC verification and/or ARPC generation).
+        The card master keys derived from the MK-AC are cached per PAN/PAN sequence number
+        """
+        response = OutgoingMessage(header=header, response_code=request.response_code)
+        mode = request.get('Mode Flag')
+        scheme = request.get('Scheme ID')
+        if mode not in (b'0', b'1', b'2'):
+            raise ValueError('Invalid mode flag: {}'.format(mode.decode('utf-8')))
+        if scheme not in (b'0', b'1'):
+            raise ValueError('Unsupported scheme ID: {}'.format(scheme.decode('utf-8')))
+
+        if not self.check_key_parity(self.cipher, request.get('MK-AC')):
+            self._debug_trace('MK-AC parity error')
+            if self.approve_all:
+                self._debug_trace('Forced approval as --approve-all option set')
+                response.set_error_code(b'00')
+            else:
+                response.set_error_code(b'10')
+            return response
+
+        card_key = self._card_key(request.get('MK-AC'), request.get('PAN/PAN Sequence Number'))
+        if scheme == b'0':
+            session_key = card_key.clear_key
+            session_cipher = card_key.get_cipher()
+        else:
+            session_key = derive_session_key(card_key.get_cipher(), request.get('ATC'))
+            session_cipher = DES3.new(session_key, DES3.MODE_ECB)
+
+        arqc = request.get('ARQC')
+        if mode != b'2':
+            expected = retail_mac(session_key, request.get('Transaction Data'), padding=1 if scheme == b'0' else 2)
+            if expected != arqc:
+                self._debug_trace('ARQC mismatch: {} != {}', expected.hex().upper(), arqc.hex().upper())
+                if not self.approve_all:
+                    response.set_error_code(b'01')
+                    return response
+                self._debug_trace('Forced approval as --approve-all option set')
+
+        response.set_error_code(b'00')
+        if mode != b'0':
+            response.set('ARPC', generate_arpc(session_cipher, arqc, request.get('ARC')))
+        return response
+
+
+    @hsm_command(b'M0', parser=M0)
+    @hsm_command(b'M2', parser=M2)
+    def translate_data_block(self, request, header):
+        """
+        Get response to M0 (encrypt) or M2 (decrypt) command.
+        The message is a memoryview of the request frame and goes to the cipher without a copy
+        """
+        response = OutgoingMessage(header=header, response_code=request.response_code)
+        mode = DATA_CIPHER_MODES.get(request.get('Mode Flag'))
+        if mode is None or request.get('Input Format Flag') not in (b'0', b'1') or request.get('Output Format Flag') not in (b'0', b'1'):
+            self._debug_trace('Invalid mode or format flag')
+            response.set_error_code(b'15')
+            return response
+
+        if request.get('Key Type') not in DATA_KEY_TYPES:
+            self._debug_trace('Invalid key type: {}', request.get('Key Type').decode('utf-8', 'replace'))
+            response.set_error_code(b'04')
+            return response
+
+        if not self.check_key_parity(self.cipher, request.get('Key')):
+            self._debug_trace('Key parity error')
+            response.set_error_code(b'10')
+            return response
+
+        message = request.get('Message')
+        try:
+            if len(message) != int(request.get('Message Length'), 16):
+                raise ValueError('Message shorter than its length')
+            if request.get('Input Format Flag') == b'1':
+                message = unhexlify(message)
+            iv = unhexlify(request.get('IV')) if mode == DES3.MODE_CBC else None
+        except ValueError as e:
+            # binascii.Error is a ValueError
+            self._debug_trace('Invalid message: {}', e)
+            response.set_error_code(b'15')
+            return response
+
+        if len(message) % 8:
+            self._debug_trace('Message length {} is not a multiple of 8', len(message))
+            response.set_error_code(b'80')
+            return response
 
+        key = self._working_key(request.get('Key'))
+        cipher = key.get_cipher() if iv is None else DES3.new(key.clear_key, DES3.MODE_CBC, iv)
+        encrypt = request.command_code == b'M0'
+        output = cipher.encrypt(message) if encrypt else cipher.decrypt(message)
+        if iv is not None:
+            # The IV to chain the next block with: the last ciphertext block
+            ciphertext = output if encrypt else message
+            iv = bytes(ciphertext[-8:]) if ciphertext else iv
+        if request.get('Output Format Flag') == b'1':
+            output = hexlify(output).upper()
+        if len(output) > MAX_DATA_LENGTH:
+            self._debug_trace('Output of {} bytes does not fit into the response', len(output))
+            response.set_error_code(b'80')
+            return response
+
+        response.set_error_code(b'00')
+        if iv is not None:
+            response.set('IV', raw2B(iv))
+        response.set('Message Length', b'%04X' % len(output))
+        response.set('Message', output)
         return response
 
 
-    def get_diagnostics_data(self, header):
+    @hsm_command(b'NC', parser=NC)
+    def get_diagnostics_data(self, request, header):
         """
         Get response to NC command
         """
-        response = OutgoingMessage(header=header)
-        response.set_response_code('ND')
-        response.set_error_code('00')
-        response.set('LMK Check Value', key_CV(raw2B(self.LMK), 16))
+        response = OutgoingMessage(header=header, response_code=request.response_code)
+        response.set_error_code(b'00')
+        response.set('LMK Check Value', self._lmk_check_value)
         response.set('Firmware Version', str2bytes(self.firmware_version))
         return response
 
 
+    @hsm_command(b'BU', parser=BU)
     def get_key_check_value(self, request, header):
         """
         Get response to BU command
         TODO: return different check values (length of 6 or length of 16)
         """
-        response = OutgoingMessage(header=header)
-        response.set_response_code('BV')
-        response.set_error_code('00')
+        response = OutgoingMessage(header=header, response_code=request.response_code)
+        response.set_error_code(b'00')
         
         key = request.get('Key')
         if key[0:1] in [b'U']:
@@ -893,64 +2503,62 @@ class HSM():
         response.set('Key Check Value', key_CV(key, 16))
         return response
 
+    @hsm_command(b'A0', parser=A0)
     def generate_key_a0(self, request, header):
         """
         Get response to A0 command
         """
-        response = OutgoingMessage(header=header)
-        response.set_response_code('A1')
-        response.set_error_code('00')
+        response = OutgoingMessage(header=header, response_code=request.response_code)
+        response.set_error_code(b'00')
 
-        new_clear_key = modify_key_parity(bytes(os.urandom(16)))
-        self._debug_trace('Generated key: {}'.format(raw2str(new_clear_key)))
-        new_key_under_lmk = self.cipher.encrypt(new_clear_key)
-        response.set('Key under LMK', b'U' + raw2B(new_key_under_lmk))
+        new_key = self.key_pool.get()
+        self._debug_trace('Generated key: {}', raw2str(new_key.clear_key))
+        response.set('Key under LMK', new_key.under_lmk)
 
         zmk_under_lmk = request.get('ZMK/TMK')[1:33]
         if zmk_under_lmk:
-            clear_zmk = self.cipher.decrypt(B2raw(zmk_under_lmk))
-            zmk_key_cipher = DES3.new(clear_zmk, DES3.MODE_ECB)
-            new_key_under_zmk = zmk_key_cipher.encrypt(new_clear_key)
+            zmk_key_cipher = self._working_key(zmk_under_lmk).get_cipher()
+            new_key_under_zmk = zmk_key_cipher.encrypt(new_key.clear_key)
 
             response.set('Key under ZMK', b'U' + raw2B(new_key_under_zmk))
-            response.set('Key Check Value', key_CV(raw2B(new_clear_key), 6))
+            response.set('Key Check Value', new_key.check_value)
 
         return response
 
 
+    @hsm_command(b'FA', parser=FA)
     def translate_zpk(self, request, header):
         """
         Get response to FA command
         """
-        response = OutgoingMessage(header=header)
-        response.set_response_code('FB')
-        response.set_error_code('00')
+        response = OutgoingMessage(header=header, response_code=request.response_code)
+        response.set_error_code(b'00')
 
         zmk_under_lmk = request.get('ZMK')[1:33]
         if zmk_under_lmk:
-            clear_zmk = self.cipher.decrypt(B2raw(zmk_under_lmk))
-            self._debug_trace('Clear ZMK: {}'.format(raw2str(clear_zmk)))
+            zmk = self._working_key(zmk_under_lmk)
+            self._debug_trace('Clear ZMK: {}', raw2str(zmk.clear_key))
 
-            zmk_key_cipher = DES3.new(clear_zmk, DES3.MODE_ECB)
+            zmk_key_cipher = zmk.get_cipher()
 
             zpk_under_zmk = request.get('ZPK')[1:33]
             if zpk_under_zmk:
                 clear_zpk = zmk_key_cipher.decrypt(B2raw(zpk_under_zmk))
-                self._debug_trace('Clear ZPK: {}'.format(raw2str(clear_zpk)))
+                self._debug_trace('Clear ZPK: {}', raw2str(clear_zpk))
                 
                 zpk_under_lmk = self.cipher.encrypt(clear_zpk)
 
                 response.set('ZPK under LMK', b'U' + raw2B(zpk_under_lmk))
                 response.set('Key Check Value', key_CV(raw2B(zpk_under_lmk), 6))
-                response.set_error_code('00')
+                response.set_error_code(b'00')
 
             else:
                 self._debug_trace('ERROR: Invalid ZPK')
-                response.set_error_code('01')
+                response.set_error_code(b'01')
 
         else:
             self._debug_trace('ERROR: Invalid ZMK')
-            response.set_error_code('01')
+            response.set_error_code(b'01')
 
         return response
 
@@ -959,30 +2567,103 @@ class HSM():
         """
         Legacy dispatcher - pass header to handlers
         """
-        rqst_command_code = request.get_command_code()
-        if rqst_command_code == b'A0':
-            return self.generate_key_a0(request, header)
-        elif rqst_command_code == b'BU':
-            return self.get_key_check_value(request, header)
-        elif rqst_command_code == b'NC':
-            return self.get_diagnostics_data(header)
-        elif rqst_command_code in [b'DC', b'EC']:
-            return self.verify_pin(request, header)
-        elif rqst_command_code == b'CA':
-            return self.translate_pinblock(request, header)
-        elif rqst_command_code == b'CW':
-            return self.generate_cvv(request, header)
-        elif rqst_command_code == b'CY':
-            return self.verify_cvv(request, header)
-        elif rqst_command_code == b'FA':
-            return self.translate_zpk(request, header)
-        elif rqst_command_code == b'HC':
-            return self.generate_key(request, header)
-        else:
-            response = OutgoingMessage(header=header)
-            response.set_response_code('ZZ')
-            response.set_error_code('00')
-            return response
+        command = self._commands.get(request.get_command_code())
+        if command:
+            return command[1](request, header)
+        response = OutgoingMessage(header=header, response_code=b'ZZ')
+        response.set_error_code(b'00')
+        return response
+
+
+def _run_worker(slot, shared_stats, engine, hsm_kwargs):
+    """
+    Worker process entry point: serve the clients with an own HSM instance
+    """
+    stats = memoryview(shared_stats).cast('B').cast('Q')[slot * STATS_SIZE:(slot + 1) * STATS_SIZE]
+    if hsm_kwargs.get('metrics_port'):
+        # Every worker exposes its metrics on its own port
+        hsm_kwargs = dict(hsm_kwargs, metrics_port=hsm_kwargs['metrics_port'] + slot)
+    hsm = HSM(reuse_port=True, stats=stats, **hsm_kwargs)
+    if engine == 'async':
+        hsm.run_async()
+    else:
+        hsm.run()
+
+
+class HSMWorkers():
+    """
+    Multi-process mode: fork a number of workers, each one listening on the same
+    port (SO_REUSEPORT) with its own HSM instance, so that the CPU-bound commands
+    are not serialized by a single interpreter lock
+    """
+    def __init__(self, workers=None, engine='threads', **hsm_kwargs):
+        self.workers = workers if workers else cpu_count()
+        self.engine = engine
+        self.hsm_kwargs = hsm_kwargs
+        self.restarts = 0
+        self.processes = [None] * self.workers
+        self.context = multiprocessing.get_context('fork')
+        # Every worker only writes to its own slot, so no lock is needed
+        self.shared_stats = self.context.RawArray('Q', self.workers * STATS_SIZE)
+
+
+    def _start_worker(self, slot):
+        process = self.context.Process(target=_run_worker,
+                                       args=(slot, self.shared_stats, self.engine, self.hsm_kwargs),
+                                       name=f'HSM-worker-{slot}',
+                                       daemon=True)
+        process.start()
+        self.processes[slot] = process
+
+
+    def start(self):
+        for slot in range(self.workers):
+            self._start_worker(slot)
+        print(f'Started {self.workers} HSM worker processes')
+
+
+    def check_workers(self):
+        """
+        Restart the workers that died
+        """
+        for slot, process in enumerate(self.processes):
+            if process is not None and not process.is_alive():
+                print(f'Worker {process.name} (pid {process.pid}) exited with code {process.exitcode}, restarting')
+                process.join()
+                self.restarts += 1
+                self._start_worker(slot)
+
+
+    def get_stats(self):
+        """
+        Sum up the counters of all the workers
+        """
+        totals = [0] * STATS_SIZE
+        for i, value in enumerate(self.shared_stats):
+            totals[i % STATS_SIZE] += value
+        return {'requests': totals[STAT_REQUESTS], 'errors': totals[STAT_ERRORS], 'restarts': self.restarts}
+
+
+    def stop(self):
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join()
+
+
+    def run(self, check_interval=1.0):
+        self.start()
+        try:
+            while True:
+                time.sleep(check_interval)
+                self.check_workers()
+        except KeyboardInterrupt:
+            print("\nServer shutdown requested, exiting...")
+        finally:
+            self.stop()
+            print('Workers stats: {}'.format(self.get_stats()))
 
 
 if __name__ == "__main__":
@@ -1001,11 +2682,94 @@ if __name__ == "__main__":
                         help='Skip key parity checks')
     parser.add_argument('-a', '--approve-all', action='store_true',
                         help='Approve all requests')
+    parser.add_argument('-e', '--engine', choices=['threads', 'async'], default='threads',
+                        help='Server engine: thread per client or asyncio event loop (the requests are processed by the thread pool with both), default threads')
+    parser.add_argument('-o', '--out-of-order', action='store_true',
+                        help='Send the responses as soon as they are ready instead of in the request order')
+    parser.add_argument('--key-cache-size', type=int, default=1024,
+                        help='Number of LMK-decrypted working keys to cache, 0 to disable, default 1024')
+    parser.add_argument('--key-cache-ttl', type=float, default=None,
+                        help='Seconds to keep a cached working key, default unlimited')
+    parser.add_argument('--key-pool-size', type=int, default=1024,
+                        help='Number of pre-generated keys for A0 and HC, 0 to disable, default 1024')
+    parser.add_argument('--key-pool-low-water', type=int, default=None,
+                        help='Refill the key pool when fewer keys are left, default a quarter of the pool size')
+    parser.add_argument('--card-key-cache-size', type=int, default=1024,
+                        help='Number of card master keys derived for KQ to cache, 0 to disable, default 1024')
+    parser.add_argument('--response-cache-size', type=int, default=0,
+                        help='Number of responses to BU, CW, CY and NC to cache, default 0 (disabled)')
+    parser.add_argument('--response-cache-ttl', type=float, default=None,
+                        help='Seconds to keep a cached response, default unlimited')
+    parser.add_argument('-l', '--log-level', choices=list(LOG_LEVELS), default='full',
+                        help='Log level: off, summary (one line per message) or full (hex dumps and fields), default full')
+    parser.add_argument('--log-queue-size', type=int, default=10000,
+                        help='Log records to buffer before dropping them, 0 to log synchronously, default 10000')
+    parser.add_argument('-m', '--metrics-port', type=int, default=None,
+                        help='Local HTTP port to expose the Prometheus metrics at /metrics (worker N uses port + N), default disabled')
+    parser.add_argument('--nodelay', action='store_true', default=None,
+                        help='Set TCP_NODELAY on the client connections')
+    parser.add_argument('--sndbuf', type=int, default=None,
+                        help='Socket send buffer size (SO_SNDBUF), default system')
+    parser.add_argument('--rcvbuf', type=int, default=None,
+                        help='Socket receive buffer size (SO_RCVBUF), default system')
+    parser.add_argument('--backlog', type=int, default=128,
+                        help='Listen backlog, default 128')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help='Maximum number of requests in flight, default unlimited')
+    parser.add_argument('--max-in-flight-per-connection', type=int, default=None,
+                        help='Maximum number of requests in flight per connection, default unlimited')
+    parser.add_argument('--busy-error-code', type=str, default=None,
+                        help='Reply with this error code over the in-flight limits, default stop reading the connection until a request completes')
+    parser.add_argument('--priority-class', type=str, action='append', default=[], metavar='NAME=CMD[,CMD...]',
+                        help='Priority class of the commands, repeated from the highest to the lowest priority. The other commands are '
+                             'in the "default" class, the lowest unless listed. Default: pin=CA,CC,DC,EC default keys=A0,HC')
+    parser.add_argument('--connection-weight', type=str, action='append', default=[], metavar='HOST=WEIGHT',
+                        help='Share of the pool workers for the clients from the host relative to the others (weight 1), repeated')
+    parser.add_argument('--profile', type=str, default=None,
+                        help='Simulation profile (JSON, or YAML with PyYAML installed): per-command latencies, '
+                             'licensed throughput and injected errors, default none (answer at once)')
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help='Number of worker processes sharing the port (SO_REUSEPORT), default 0 (single process)')
 
     args = parser.parse_args()
-    hsm = HSM(key=args.key,
-              debug=args.debug,
-              skip_parity=args.skip_parity,
-              port=args.port,
-              approve_all=args.approve_all)
-    hsm.run()
+    try:
+        priority_classes = parse_priority_classes(args.priority_class) if args.priority_class else None
+        connection_weights = parse_connection_weights(args.connection_weight)
+        simulation_profile = SimulationProfile.load(args.profile) if args.profile else None
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+    hsm_kwargs = dict(key=args.key,
+                      debug=args.debug,
+                      skip_parity=args.skip_parity,
+                      port=args.port,
+                      approve_all=args.approve_all,
+                      out_of_order=args.out_of_order,
+                      key_cache_size=args.key_cache_size,
+                      key_cache_ttl=args.key_cache_ttl,
+                      key_pool_size=args.key_pool_size,
+                      key_pool_low_water=args.key_pool_low_water,
+                      card_key_cache_size=args.card_key_cache_size,
+                      response_cache_size=args.response_cache_size,
+                      response_cache_ttl=args.response_cache_ttl,
+                      log_level=LOG_LEVELS[args.log_level],
+                      log_queue_size=args.log_queue_size,
+                      metrics_port=args.metrics_port,
+                      nodelay=args.nodelay,
+                      sndbuf=args.sndbuf,
+                      rcvbuf=args.rcvbuf,
+                      backlog=args.backlog,
+                      max_in_flight=args.max_in_flight,
+                      max_in_flight_per_connection=args.max_in_flight_per_connection,
+                      busy_error_code=args.busy_error_code,
+                      priority_classes=priority_classes,
+                      connection_weights=connection_weights,
+                      simulation_profile=simulation_profile)
+    if args.workers:
+        HSMWorkers(workers=args.workers, engine=args.engine, **hsm_kwargs).run()
+        sys.exit()
+
+    hsm = HSM(**hsm_kwargs)
+    if args.engine == 'async':
+        hsm.run_async()
+    else:
+        hsm.run()
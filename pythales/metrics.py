@@ -0,0 +1,272 @@
+"""
+In-process metrics: counters, gauges and latency histograms, exposed in the
+Prometheus text format on an optional local HTTP port.
+
+The counters and histograms are sharded per thread: every thread only updates
+its own shard, so no lock is taken on the request path, and the shards are
+summed up when the metrics are collected. The shard of a finished thread is
+merged into the retired totals, so short-lived threads leave nothing behind.
+"""
+
+import itertools
+import threading
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram precision: every power of two is split into SUB_BUCKETS linear buckets,
+# so the relative error of a recorded value is below 1 / SUB_BUCKETS
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+# Bucket boundaries (seconds) exported to Prometheus
+EXPORT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def bucket_index(value):
+    """
+    HDR-style bucket of a non-negative integer value
+    """
+    if value < 2 * SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift + 1) * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+
+def bucket_bounds(index):
+    """
+    Lowest value and the next after the highest value of the bucket
+    """
+    if index < 2 * SUB_BUCKETS:
+        return index, index + 1
+    shift = index // SUB_BUCKETS - 1
+    lower = (index % SUB_BUCKETS + SUB_BUCKETS) << shift
+    return lower, lower + (1 << shift)
+
+
+class _ShardOwner():
+    """
+    Kept in the thread-local storage only: collected when the thread finishes
+    """
+    __slots__ = ('__weakref__',)
+
+
+class ThreadShards():
+    """
+    Per-thread shards of a metric, created by factory() on the first use in a thread.
+    When the thread finishes, its shard is merged into the retired one with merge(retired, shard)
+    """
+    def __init__(self, factory, merge):
+        self._factory = factory
+        self._merge = merge
+        self._local = threading.local()
+        self._live = {}
+        self._retired = factory()
+        self._keys = itertools.count()
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Shard of the calling thread
+        """
+        try:
+            return self._local.shard
+        except AttributeError:
+            return self._add()
+
+    def _add(self):
+        shard = self._factory()
+        owner = _ShardOwner()
+        key = next(self._keys)
+        with self._lock:
+            self._live[key] = shard
+        weakref.finalize(owner, self._retire, key).atexit = False
+        self._local.shard = shard
+        self._local.owner = owner
+        return shard
+
+    def _retire(self, key):
+        with self._lock:
+            self._merge(self._retired, self._live.pop(key))
+
+    def __len__(self):
+        return len(self._live)
+
+    def all(self):
+        """
+        The retired shard and the shards of the running threads
+        """
+        with self._lock:
+            return [self._retired] + list(self._live.values())
+
+
+def _merge_counts(retired, shard):
+    retired[0] += shard[0]
+
+
+def _merge_histograms(retired, shard):
+    buckets = retired[0]
+    for index, value in list(shard[0].items()):
+        buckets[index] = buckets.get(index, 0) + value
+    retired[1] += shard[1]
+    retired[2] += shard[2]
+
+
+class Counter():
+    def __init__(self):
+        self._shards = ThreadShards(lambda: [0], _merge_counts)
+
+    def inc(self, value=1):
+        self._shards.get()[0] += value
+
+    def get(self):
+        return sum(shard[0] for shard in self._shards.all())
+
+
+class Histogram():
+    """
+    Latency histogram with the values recorded in microseconds
+    """
+    def __init__(self):
+        self._shards = ThreadShards(lambda: [{}, 0, 0.0], _merge_histograms)
+
+    def record(self, seconds):
+        shard = self._shards.get()
+        index = bucket_index(int(seconds * 1000000))
+        buckets = shard[0]
+        buckets[index] = buckets.get(index, 0) + 1
+        shard[1] += 1
+        shard[2] += seconds
+
+    def get(self):
+        """
+        Return (buckets, count, sum) of all the shards, the buckets are sorted by index
+        """
+        buckets = {}
+        count = 0
+        total = 0.0
+        for shard_buckets, shard_count, shard_sum in self._shards.all():
+            for index, value in list(shard_buckets.items()):
+                buckets[index] = buckets.get(index, 0) + value
+            count += shard_count
+            total += shard_sum
+        return sorted(buckets.items()), count, total
+
+    def percentile(self, p):
+        """
+        Value (seconds) below which p percent of the recorded values are
+        """
+        buckets, count, _ = self.get()
+        if not count:
+            return None
+        rank = p / 100.0 * count
+        seen = 0
+        for index, value in buckets:
+            seen += value
+            if seen >= rank:
+                return bucket_bounds(index)[1] / 1000000.0
+        return bucket_bounds(buckets[-1][0])[1] / 1000000.0
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in items) + '}'
+
+
+class MetricsRegistry():
+    """
+    Named metrics, each one may have a number of label sets
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name, help, kind, factory, labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = {'help': help, 'type': kind, 'series': {}}
+            elif metric['type'] != kind:
+                raise ValueError('Metric {} is a {}, not a {}'.format(name, metric['type'], kind))
+            series = metric['series'].get(key)
+            if series is None:
+                series = metric['series'][key] = factory()
+            return series
+
+    def counter(self, name, help='', **labels):
+        return self._get(name, help, 'counter', Counter, labels)
+
+    def histogram(self, name, help='', **labels):
+        return self._get(name, help, 'histogram', Histogram, labels)
+
+    def gauge(self, name, function, help='', kind='gauge', **labels):
+        """
+        Metric with the value returned by the function when the metrics are collected
+        """
+        return self._get(name, help, kind, lambda: function, labels)
+
+    def render(self):
+        """
+        Metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            metrics = [(name, metric['help'], metric['type'], list(metric['series'].items())) for name, metric in sorted(self._metrics.items())]
+
+        for name, help, kind, series in metrics:
+            if help:
+                lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, metric in sorted(series, key=lambda item: item[0]):
+                if isinstance(metric, Histogram):
+                    buckets, count, total = metric.get()
+                    cumulative = 0
+                    position = 0
+                    for le in EXPORT_BUCKETS:
+                        while position < len(buckets) and bucket_bounds(buckets[position][0])[1] <= le * 1000000:
+                            cumulative += buckets[position][1]
+                            position += 1
+                        lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, ('le', le)), cumulative))
+                    lines.append('{}_bucket{} {}'.format(name, _format_labels(labels, ('le', '+Inf')), count))
+                    lines.append('{}_sum{} {}'.format(name, _format_labels(labels), total))
+                    lines.append('{}_count{} {}'.format(name, _format_labels(labels), count))
+                elif isinstance(metric, Counter):
+                    lines.append('{}{} {}'.format(name, _format_labels(labels), metric.get()))
+                else:
+                    lines.append('{}{} {}'.format(name, _format_labels(labels), metric()))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer():
+    """
+    HTTP server exposing the registry at /metrics
+    """
+    def __init__(self, registry, port, host='127.0.0.1'):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True, name='HSM-metrics').start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
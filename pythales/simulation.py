@@ -0,0 +1,180 @@
+"""
+Service profile of a real HSM: per-command service times, the commands per
+second licence and the injected errors, loaded from a JSON (or YAML, if PyYAML
+is installed) file:
+
+    {
+        "throughput": 250,
+        "default": {"latency_ms": 2},
+        "commands": {
+            "EC": {"latency_ms": {"distribution": "normal", "mean": 4, "stddev": 1}, "errors": {"01": 0.02}},
+            "A0": {"latency_ms": {"distribution": "uniform", "min": 15, "max": 25}}
+        }
+    }
+
+The responses are delayed with timers, so the workers are free to process
+the next requests while thousands of responses are waiting to be sent.
+"""
+
+import json
+import heapq
+import random
+import threading
+import time
+import itertools
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+
+def _distribution(spec):
+    """
+    Function returning a random latency in milliseconds
+    """
+    if isinstance(spec, (int, float)):
+        return lambda: spec
+    if not isinstance(spec, dict):
+        raise ValueError('Invalid latency: {!r}'.format(spec))
+    kind = spec.get('distribution', 'fixed')
+    try:
+        if kind == 'fixed':
+            value = float(spec['value'])
+            return lambda: value
+        if kind == 'uniform':
+            low, high = float(spec['min']), float(spec['max'])
+            return lambda: random.uniform(low, high)
+        if kind == 'normal':
+            mean, stddev = float(spec['mean']), float(spec['stddev'])
+            return lambda: random.gauss(mean, stddev)
+        if kind == 'lognormal':
+            mu, sigma = float(spec['mu']), float(spec['sigma'])
+            return lambda: random.lognormvariate(mu, sigma)
+        if kind == 'exponential':
+            mean = float(spec['mean'])
+            return lambda: random.expovariate(1.0 / mean)
+    except KeyError as e:
+        raise ValueError('Missing {} for the {} latency distribution'.format(e, kind))
+    raise ValueError('Unsupported latency distribution: {}'.format(kind))
+
+
+class CommandProfile():
+    """
+    Latency and injected errors of a command
+    """
+    def __init__(self, spec):
+        self.latency = _distribution(spec.get('latency_ms', 0))
+        self.errors = []
+        total = 0.0
+        for error_code, rate in spec.get('errors', {}).items():
+            if len(error_code) != 2:
+                raise ValueError('Error code must be 2 characters long: {}'.format(error_code))
+            total += float(rate)
+            self.errors.append((total, error_code.encode()))
+        if total > 1:
+            raise ValueError('The error rates add up to more than 1')
+
+
+class SimulationProfile():
+    """
+    Per-command service profile. delay() gives the time to hold the response for:
+    the requests start no faster than the licensed throughput, and every one
+    takes the latency drawn for its command
+    """
+    def __init__(self, commands=None, default=None, throughput=None):
+        self.commands = {command_code.encode() if isinstance(command_code, str) else command_code: CommandProfile(spec)
+                         for command_code, spec in (commands or {}).items()}
+        self.default = CommandProfile(default or {})
+        if throughput is not None and throughput <= 0:
+            raise ValueError('Throughput must be positive')
+        self.throughput = throughput
+        self._next_start = 0.0
+        self._lock = threading.Lock()
+
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            if filename.endswith(('.yaml', '.yml')):
+                if yaml is None:
+                    raise ValueError('PyYAML is required for the YAML profiles (pip install pythales[yaml])')
+                try:
+                    spec = yaml.safe_load(f)
+                except yaml.YAMLError as e:
+                    raise ValueError('Invalid simulation profile {}: {}'.format(filename, e))
+            else:
+                spec = json.load(f)
+        if not isinstance(spec, dict):
+            raise ValueError('Invalid simulation profile: {}'.format(filename))
+        return cls(spec.get('commands'), spec.get('default'), spec.get('throughput'))
+
+
+    def get(self, command_code):
+        return self.commands.get(command_code, self.default)
+
+
+    def inject_error(self, command_code):
+        """
+        The error code to reply with instead of processing the request, or None
+        """
+        errors = self.get(command_code).errors
+        if not errors:
+            return None
+        draw = random.random()
+        for threshold, error_code in errors:
+            if draw < threshold:
+                return error_code
+        return None
+
+
+    def delay(self, command_code, now=None):
+        """
+        Seconds to hold the response to the request received now
+        """
+        start = now = now if now is not None else time.monotonic()
+        if self.throughput:
+            with self._lock:
+                start = max(now, self._next_start)
+                self._next_start = start + 1.0 / self.throughput
+        return start - now + max(self.get(command_code).latency(), 0.0) / 1000.0
+
+
+class ResponseTimer():
+    """
+    Calls the functions at the given (time.monotonic()) times from a single thread
+    """
+    def __init__(self):
+        self._heap = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+
+    def __len__(self):
+        return len(self._heap)
+
+
+    def call_at(self, due, function, *args):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name='HSM-response-timer')
+                self._thread.start()
+            order = next(self._order)
+            heapq.heappush(self._heap, (due, order, function, args))
+            # Wake the timer thread up only if it sleeps until a later time
+            if self._heap[0][1] == order:
+                self._condition.notify()
+
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._condition.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, function, args = heapq.heappop(self._heap)
+            try:
+                function(*args)
+            except Exception:
+                # The timer thread must survive a failing callback
+                pass
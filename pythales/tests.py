@@ -1,8 +1,29 @@
 #!/usr/bin/env python
 
 import unittest
-
-from pythales.hsm import HSM, OutgoingMessage, DummyMessage, A0, BU, CA, CW, CY, DC, EC, HC, NC, parse_message
+import unittest.mock
+import contextlib
+import io
+import os
+import tempfile
+import asyncio
+import socket
+import struct
+import time
+import urllib.request
+import threading
+import tracemalloc
+import gc
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from Crypto.Cipher import DES, DES3
+
+from pythales import bench, batch
+from pythales import hsm as hsm_module
+from pynblock.tools import get_visa_pvv, get_digits_from_string, modify_key_parity, check_key_parity, key_CV
+from pythales.simulation import SimulationProfile, ResponseTimer
+from pythales.metrics import MetricsRegistry, MetricsServer, Counter, Histogram, bucket_index, bucket_bounds
+from pythales.hsm import HSM, HSMWorkers, AdmissionControl, FairScheduler, parse_priority_classes, parse_connection_weights, ClientConnection, FrameReader, KeyCache, KeyPool, send_buffers, TraceLog, LOG_OFF, LOG_SUMMARY, LOG_FULL, compile_fields, hsm_command, Field, KeyField, Prefixed, Delimited, Skip, Marker, When, OutgoingMessage, DummyMessage, A0, BU, CA, CC, CW, KQ, M0, M2, CY, DC, EC, HC, NC, parse_message
 
 
 class TestDummyMessage(unittest.TestCase):
@@ -25,6 +46,12 @@ class TestDummyMessage(unittest.TestCase):
         self.message.set('IDDQD', b'00')
         self.assertEqual(self.message.trace(), '\t[IDDQD]: [00]\n')
 
+    def test_no_instance_dict(self):
+        for request_cls in HSM.COMMAND_CLASSES.values():
+            self.assertFalse(hasattr(request_cls(b''), '__dict__'), request_cls.__name__)
+        self.assertFalse(hasattr(OutgoingMessage(header=b'SSSS'), '__dict__'))
+        self.assertEqual(OutgoingMessage(header=b'SSSS').get_command_code(), None)
+
 class TestParseMessage(unittest.TestCase):
     """
     """
@@ -52,6 +79,55 @@ class TestParseMessage(unittest.TestCase):
         self.assertEqual(payload, b'YZ')
 
 
+class TestCompileFields(unittest.TestCase):
+    def setUp(self):
+        self.parse = compile_fields((
+            KeyField('Key', b'UT', default=4),
+            Marker(b'#', Field('Flag', 1)),
+            Delimited('Name', b';'),
+            Skip(1),
+            When('Flag', [b'1'], (Field('One', 2),), otherwise=(Field('Other', 3),)),
+        ))
+
+    def test_all_fields_present(self):
+        self.assertEqual(self.parse(b'U' + b'A' * 32 + b'#1JOHN;XAB'),
+                         {'Key': b'U' + b'A' * 32, 'Flag': b'1', 'Name': b'JOHN', 'One': b'AB'})
+
+    def test_optional_fields_absent(self):
+        self.assertEqual(self.parse(b'ABCDJOHN;XABC'),
+                         {'Key': b'ABCD', 'Name': b'JOHN', 'Other': b'ABC'})
+
+    def test_missing_delimiter_takes_the_rest(self):
+        self.assertEqual(self.parse(b'ABCDJOHN')['Name'], b'JOHN')
+
+    def test_unknown_specification(self):
+        with self.assertRaises(TypeError):
+            compile_fields((None,))
+
+
+class TestPrefixedField(unittest.TestCase):
+    def test_prefixed(self):
+        parse = compile_fields((Field('A', 1), Prefixed('Data', 2, length_name='Length'), Field('B', 1)))
+        self.assertEqual(parse(b'X0AHELLOWORLD!Y'), {'A': b'X', 'Length': b'0A', 'Data': b'HELLOWORLD', 'B': b'!'})
+
+    def test_invalid_length(self):
+        with self.assertRaises(ValueError):
+            compile_fields((Prefixed('Data'),))(b'ZZ')
+
+    def test_short_data(self):
+        parse = compile_fields((Prefixed('Data', 2, length_name='Length'), Field('B', 1)))
+        self.assertEqual(parse(b''), {'Length': b'', 'Data': b'', 'B': b''})
+        self.assertEqual(parse(b'0'), {'Length': b'0', 'Data': b'', 'B': b''})
+
+    def test_view(self):
+        data = b'04DATA!'
+        fields = compile_fields((Prefixed('Data', view=True), Field('B', 1)))(data)
+        self.assertIsInstance(fields['Data'], memoryview)
+        self.assertIs(fields['Data'].obj, data)
+        self.assertEqual(fields['Data'], b'DATA')
+        self.assertEqual(fields['B'], b'!')
+
+
 class TestOutgoingMessageClass(unittest.TestCase):
     """
     """
@@ -70,6 +146,22 @@ class TestOutgoingMessageClass(unittest.TestCase):
         m.fields['Data'] = b'7444321'
         self.assertEqual(m.build(), b'\x00\x0BNG007444321')
 
+    def test_outgoing_message_response_code(self):
+        m = OutgoingMessage(header=b'XXXX', response_code=b'ND')
+        m.set_error_code(b'00')
+        self.assertEqual(m.get_command_code(), b'ND')
+        self.assertEqual(m.build(), b'\x00\x08XXXXND00')
+
+    def test_outgoing_message_str_codes(self):
+        m = OutgoingMessage(header=b'XXXX')
+        m.set_response_code('ND')
+        m.set_error_code('00')
+        self.assertEqual(m.build(), b'\x00\x08XXXXND00')
+
+    def test_response_codes(self):
+        for command_code, request_cls in HSM.COMMAND_CLASSES.items():
+            self.assertEqual(request_cls.response_code, command_code[:1] + bytes([command_code[1] + 1]))
+
 
 class TestMessageGet(unittest.TestCase):
     def setUp(self):
@@ -348,6 +440,39 @@ class TestBU(unittest.TestCase):
 
 
 
+class TestParserAllocations(unittest.TestCase):
+    """
+    The parsers slice the fields at a running offset instead of copying the
+    rest of the payload after every field
+    """
+    data = b'UAE79D203F9640A93CFBA155E345953F67336D50C47128D710DF450BCB2C6461BC32F104A6846BD870140700000001012345' + b'X' * 65536
+
+    @staticmethod
+    def legacy_parse(data):
+        fields = {}
+        for name, field_size in (('ZPK', 33), ('PVK Pair', 32), ('PIN block', 16), ('PIN block format code', 2),
+                                 ('Account Number', 12), ('PVKI', 1), ('PVV', 4)):
+            fields[name] = data[0:field_size]
+            data = data[field_size:]
+        return fields
+
+    def _allocated(self, parse):
+        """
+        Bytes allocated on top of the baseline while parsing the message
+        """
+        tracemalloc.start()
+        try:
+            baseline = tracemalloc.get_traced_memory()[0]
+            parse(self.data)
+            return tracemalloc.get_traced_memory()[1] - baseline
+        finally:
+            tracemalloc.stop()
+
+    def test_payload_not_copied(self):
+        self.assertGreater(self._allocated(self.legacy_parse), len(self.data))
+        self.assertLess(self._allocated(EC), len(self.data) // 16)
+
+
 class TestHSMThread(unittest.TestCase):
     def setUp(self):
         self.hsm = HSM(header='SSSS', skip_parity=True)
@@ -531,5 +656,1451 @@ class TestHSMResponsesMapping(unittest.TestCase):
         self.assertEqual(response.get('Response Code'), b'ND')
         self.assertEqual(response.get('Error Code'), b'00')
 
+
+class TestKeyCache(unittest.TestCase):
+    def setUp(self):
+        self.loaded = []
+
+    def _load(self, key):
+        self.loaded.append(key)
+        return key.lower()
+
+    def test_hits_and_misses(self):
+        cache = KeyCache(size=2)
+        self.assertEqual(cache.get(b'AA', self._load), b'aa')
+        self.assertEqual(cache.get(b'AA', self._load), b'aa')
+        self.assertEqual(self.loaded, [b'AA'])
+        self.assertEqual(cache.get_stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_least_recently_used_evicted(self):
+        cache = KeyCache(size=2)
+        for key in (b'AA', b'BB', b'AA', b'CC', b'AA', b'BB'):
+            cache.get(key, self._load)
+        self.assertEqual(self.loaded, [b'AA', b'BB', b'CC', b'BB'])
+
+    def test_ttl_expired(self):
+        cache = KeyCache(size=2, ttl=0.01)
+        cache.get(b'AA', self._load)
+        time.sleep(0.02)
+        cache.get(b'AA', self._load)
+        self.assertEqual(self.loaded, [b'AA', b'AA'])
+
+    def test_disabled(self):
+        cache = KeyCache(size=0)
+        cache.get(b'AA', self._load)
+        cache.get(b'AA', self._load)
+        self.assertEqual(cache.get_stats()['size'], 0)
+
+    def test_cleared_during_load(self):
+        cache = KeyCache(size=2)
+        def load(key):
+            cache.clear()
+            return self._load(key)
+        self.assertEqual(cache.get(b'AA', load), b'aa')
+        self.assertEqual(cache.get_stats()['size'], 0)
+        cache.get(b'AA', self._load)
+        self.assertEqual(self.loaded, [b'AA', b'AA'])
+
+
+class TestHSMKeyCache(unittest.TestCase):
+    def setUp(self):
+        self.hsm = HSM()
+        # 0123456789ABCDEFFEDCBA9876543210 under the default LMK
+        self.tpk = b'U827E67B59A1D6B8F1E17D0BEA17FD101'
+
+    def test_pinblock_decrypted_with_cached_key(self):
+        for _ in range(3):
+            self.assertEqual(self.hsm._decrypt_pinblock(b'2B687AEFC34B1A89', self.tpk), b'A67243EE7961006F')
+        self.assertEqual(self.hsm.key_cache.get_stats(), {'hits': 2, 'misses': 1, 'size': 1})
+
+    def test_parity_cached(self):
+        self.hsm.check_key_parity(self.hsm.cipher, self.tpk)
+        self.assertEqual(self.hsm._working_key(self.tpk).parity, self.hsm.check_key_parity(self.hsm.cipher, self.tpk))
+        self.assertEqual(self.hsm.key_cache.get_stats()['misses'], 1)
+
+    def test_lmk_change_invalidates_cache(self):
+        self.hsm._working_key(self.tpk)
+        self.hsm.LMK = bytes.fromhex('0123456789ABCDEFFEDCBA9876543210')
+        self.assertEqual(self.hsm.key_cache.get_stats()['size'], 0)
+        self.assertEqual(self.hsm._working_key(self.tpk).clear_key.hex(), '767195294b9a14edbead9bb0ad94fe3c')
+
+    def test_ca_destination_key(self):
+        destination_zpk = b'UDD0212CA505034DADF6A534DE1E06385'
+        data = b'U613D213826396ED1C184D7DC81E484F7' + destination_zpk + b'126261A0F748F863FD0101552000000012'
+        for _ in range(2):
+            response = self.hsm.translate_pinblock(CA(data), b'SSSS')
+        clear_pinblock = DES3.new(bytes.fromhex('032447698BACCFF0FFDDBB9977553311'), DES3.MODE_ECB).decrypt(bytes.fromhex('6261A0F748F863FD'))
+        cipher = DES3.new(batch.decrypt_key(destination_zpk, skip_parity=True), DES3.MODE_ECB)
+        self.assertEqual(cipher.decrypt(bytes.fromhex(response.get('Destination PIN Block').decode())), clear_pinblock)
+        self.assertEqual(response.get('PIN Length'), b'04')
+        self.assertEqual(self.hsm.key_cache.get_stats()['misses'], 2)
+
+
+class TestKeyPool(unittest.TestCase):
+    def setUp(self):
+        self.generated = []
+
+    def _generate(self, count):
+        keys = list(range(len(self.generated), len(self.generated) + count))
+        self.generated.extend(keys)
+        return keys
+
+    def _wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_filled_in_background(self):
+        pool = KeyPool(self._generate, size=100)
+        pool.start()
+        self._wait_for(lambda: len(pool) == 100)
+        self.assertEqual([pool.get() for _ in range(3)], [0, 1, 2])
+        self.assertEqual((pool.hits, pool.misses), (3, 0))
+
+    def test_refilled_below_low_water(self):
+        pool = KeyPool(self._generate, size=10, low_water=5)
+        pool.start()
+        self._wait_for(lambda: len(pool) == 10)
+        for _ in range(5):
+            pool.get()
+        self.assertLessEqual(len(self.generated), 10)
+        pool.get()
+        self._wait_for(lambda: len(pool) == 10)
+        self.assertEqual(len(self.generated), 16)
+
+    def test_empty_pool_generates_inline(self):
+        pool = KeyPool(self._generate, size=0)
+        self.assertEqual([pool.get(), pool.get()], [0, 1])
+        self.assertEqual((pool.hits, pool.misses), (0, 2))
+        self.assertEqual(len(pool), 0)
+
+    def test_clear(self):
+        pool = KeyPool(self._generate, size=10)
+        pool.start()
+        self._wait_for(lambda: len(pool) == 10)
+        pool.clear()
+        self._wait_for(lambda: len(pool) == 10)
+        self.assertEqual(pool.get(), 10)
+
+
+class TestHSMKeyPool(unittest.TestCase):
+    def setUp(self):
+        self.hsm = HSM(log_level=LOG_OFF)
+
+    def test_parity_table(self):
+        data = bytes(range(256))
+        self.assertEqual(data.translate(hsm_module.PARITY_TABLE), modify_key_parity(data))
+
+    def test_generated_keys(self):
+        keys = self.hsm._generate_keys(50)
+        self.assertGreaterEqual(len(keys), 49)
+        for key in keys:
+            self.assertTrue(check_key_parity(key.clear_key))
+            self.assertEqual(self.hsm.cipher.decrypt(bytes.fromhex(key.under_lmk[1:].decode())), key.clear_key)
+            self.assertEqual(key.check_value, key_CV(key.clear_key.hex().upper().encode(), 6))
+
+    def test_a0_served_from_pool(self):
+        self.hsm.key_pool.start()
+        deadline = time.monotonic() + 5
+        while len(self.hsm.key_pool) < self.hsm.key_pool.size and time.monotonic() < deadline:
+            time.sleep(0.01)
+        response = self.hsm._process_message(b'\x00\x2eSSSSA01002U;1U613D213826396ED1C184D7DC81E484F7')
+        self.assertEqual(response.get('Error Code'), b'00')
+        self.assertEqual(self.hsm.key_pool.hits, 1)
+        clear_key = self.hsm.cipher.decrypt(bytes.fromhex(response.get('Key under LMK')[1:].decode()))
+        zmk = self.hsm._working_key(b'U613D213826396ED1C184D7DC81E484F7').get_cipher()
+        self.assertEqual(zmk.decrypt(bytes.fromhex(response.get('Key under ZMK')[1:].decode())), clear_key)
+        self.assertEqual(response.get('Key Check Value'), key_CV(clear_key.hex().upper().encode(), 6))
+
+    def test_lmk_change_clears_pool(self):
+        self.hsm.key_pool._keys.extend(self.hsm._generate_keys(5))
+        self.hsm.LMK = bytes.fromhex('0123456789ABCDEFFEDCBA9876543210')
+        self.assertEqual(len(self.hsm.key_pool), 0)
+
+
+class TestHSMResponseCache(unittest.TestCase):
+    BU = b'\x00\x2aSSSSBU021UA97831862E31CCC36E854FE184EE6453'
+
+    def setUp(self):
+        self.hsm = HSM(log_level=LOG_OFF, response_cache_size=10)
+
+    def test_cached_response_with_new_header(self):
+        first = self.hsm._process_message(self.BU)
+        second = self.hsm._process_message(b'\x00\x2aXXXX' + self.BU[6:])
+        self.assertEqual(second.build(), first.build()[:2] + b'XXXX' + first.build()[6:])
+        self.assertEqual(self.hsm.response_cache.get_stats(), {'hits': 1, 'misses': 1, 'size': 1})
+        self.assertIn('hsm_response_cache_hits_total{command="BU"} 1', self.hsm.metrics.render())
+        self.assertIn('hsm_requests_total{command="BU"} 2', self.hsm.metrics.render())
+
+    def test_cached_fields_not_shared(self):
+        self.hsm._process_message(self.BU)
+        self.hsm._process_message(self.BU).set('Key Check Value', b'XXXX')
+        self.assertNotEqual(self.hsm._process_message(self.BU).get('Key Check Value'), b'XXXX')
+
+    def test_random_commands_not_cached(self):
+        self.assertFalse({b'A0', b'HC'} & HSM.COMMAND_CLASSES.keys() & HSM.CACHEABLE_COMMANDS)
+        a0 = b'\x00\x2eSSSSA01002U;1U613D213826396ED1C184D7DC81E484F7'
+        self.assertNotEqual(self.hsm._process_message(a0).get('Key under LMK'), self.hsm._process_message(a0).get('Key under LMK'))
+        self.assertEqual(self.hsm.response_cache.get_stats()['size'], 0)
+
+    def test_ttl(self):
+        self.hsm.response_cache.ttl = 0.05
+        self.hsm._process_message(self.BU)
+        time.sleep(0.1)
+        self.hsm._process_message(self.BU)
+        self.assertEqual(self.hsm.response_cache.hits, 0)
+
+    def test_disabled_by_default(self):
+        hsm = HSM(log_level=LOG_OFF)
+        hsm._process_message(self.BU)
+        hsm._process_message(self.BU)
+        self.assertEqual(hsm.response_cache.get_stats(), {'hits': 0, 'misses': 0, 'size': 0})
+
+    def test_lmk_check_value(self):
+        nc = b'\x00\x06SSSSNC'
+        self.assertEqual(self.hsm._process_message(nc).get('LMK Check Value'), key_CV(b'DEAFBEEDEAFBEEDEAFBEEDEAFBEEDEAF', 16))
+        self.hsm.LMK = bytes.fromhex('0123456789ABCDEFFEDCBA9876543210')
+        self.assertEqual(self.hsm.response_cache.get_stats()['size'], 0)
+        self.assertEqual(self.hsm._process_message(nc).get('LMK Check Value'), key_CV(b'0123456789ABCDEFFEDCBA9876543210', 16))
+
+    def test_lmk_changed_during_request(self):
+        parser, handler = self.hsm._commands[b'NC']
+
+        def changing_lmk(request, header):
+            response = handler(request, header)
+            self.hsm.LMK = bytes.fromhex('0123456789ABCDEFFEDCBA9876543210')
+            return response
+
+        self.hsm._commands[b'NC'] = (parser, changing_lmk)
+        self.hsm._process_message(b'\x00\x06SSSSNC')
+        self.assertEqual(self.hsm.response_cache.get_stats()['size'], 0)
+
+
+class TestCommandRegistry(unittest.TestCase):
+    def tearDown(self):
+        for command_code in (b'X0', b'X2'):
+            hsm_module.COMMAND_CLASSES.pop(command_code, None)
+            hsm_module.COMMAND_HANDLERS.pop(command_code, None)
+
+    def test_builtin_handlers_bound_once(self):
+        hsm = HSM(log_level=LOG_OFF)
+        self.assertEqual(hsm._commands[b'BU'], (BU, hsm.get_key_check_value))
+        self.assertEqual(hsm._commands[b'EC'][1], hsm._commands[b'DC'][1])
+
+    def test_response_handlers_alias(self):
+        hsm = HSM(log_level=LOG_OFF)
+        self.assertIs(HSM.RESPONSE_HANDLERS[b'NC'], HSM.get_diagnostics_data)
+        self.assertEqual(HSM.RESPONSE_HANDLERS[b'NC'](hsm, NC(b''), b'SSSS').get('Error Code'), b'00')
+        with self.assertRaises(TypeError):
+            HSM.RESPONSE_HANDLERS[b'X0'] = None
+
+    def test_plugin_command(self):
+        @hsm_command(b'X0', parser=(Field('Data', 4),), response_code=b'X1')
+        def echo(hsm, request, header):
+            """
+            Echo the data
+            """
+            response = OutgoingMessage(header=header, response_code=request.response_code)
+            response.set_error_code(b'00')
+            response.set('Data', request.get('Data'))
+            return response
+
+        hsm = HSM(log_level=LOG_OFF)
+        self.assertEqual(hsm._process_message(b'\x00\x0aSSSSX0ABCD').build(), b'\x00\x0cSSSSX100ABCD')
+        self.assertEqual(HSM.COMMAND_CLASSES[b'X0'].description, 'Echo the data')
+
+    def test_shared_parser_not_changed(self):
+        hsm_command(b'X0', parser=NC, response_code=b'X1')(lambda hsm, request, header: None)
+        self.assertEqual(NC.response_code, b'ND')
+        self.assertEqual(HSM.COMMAND_CLASSES[b'X0'].response_code, b'X1')
+        self.assertTrue(issubclass(HSM.COMMAND_CLASSES[b'X0'], NC))
+
+    def test_plugin_method_named_as_hsm_method(self):
+        class Plugin():
+            @staticmethod
+            def get_key_check_value(hsm, request, header):
+                response = OutgoingMessage(header=header, response_code=request.response_code)
+                response.set_error_code(b'42')
+                return response
+
+        hsm_command(b'X0', parser=(), response_code=b'X1')(Plugin.get_key_check_value)
+        self.assertEqual(HSM(log_level=LOG_OFF)._process_message(b'\x00\x06SSSSX0').build(), b'\x00\x08SSSSX142')
+
+    def test_no_response_code(self):
+        with self.assertRaisesRegex(ValueError, 'No response code for command'):
+            hsm_command(b'X2')(lambda hsm, request, header: None)
+
+    def test_subclass_override(self):
+        class CustomHSM(HSM):
+            def get_key_check_value(self, request, header):
+                response = OutgoingMessage(header=header, response_code=request.response_code)
+                response.set_error_code(b'99')
+                return response
+
+        response = CustomHSM(log_level=LOG_OFF)._process_message(b'\x00\x2aSSSSBU021UA97831862E31CCC36E854FE184EE6453')
+        self.assertEqual(response.get('Error Code'), b'99')
+
+    def test_load_plugins(self):
+        class EntryPoint():
+            name = 'test'
+
+            def load(self):
+                hsm_command(b'X2', response_code=b'X3')(lambda hsm, request, header: None)
+
+        with unittest.mock.patch.object(hsm_module, '_plugins_loaded', False), \
+                unittest.mock.patch('importlib.metadata.entry_points', return_value=[EntryPoint()]) as entry_points:
+            hsm_module.load_plugins()
+            hsm_module.load_plugins()
+        entry_points.assert_called_once_with(group='pythales.commands')
+        self.assertIn(b'X2', HSM.COMMAND_CLASSES)
+
+
+class TestCC(unittest.TestCase):
+    # Clear keys 032447698BACCFF0FFDDBB9977553311 and 11223344556677888877665544332211 under the default LMK
+    source_zpk = b'U613D213826396ED1C184D7DC81E484F7'
+    destination_zpk = b'UDD0212CA505034DADF6A534DE1E06385'
+    # 0123456789ABCDEFFEDCBA9876543210, no odd parity
+    bad_parity_zpk = b'U827E67B59A1D6B8F1E17D0BEA17FD101'
+    # PIN block 041234FFFFFFFFFF under the source and destination ZPKs
+    source_pinblock = b'C4BE14B669F2854B'
+    destination_pinblock = b'9B8BF4736EAC474A'
+
+    def setUp(self):
+        self.hsm = HSM(log_level=LOG_OFF)
+
+    def _request(self, source_zpk=source_zpk, destination_zpk=destination_zpk, formats=b'0101'):
+        body = b'SSSSCC' + source_zpk + destination_zpk + b'12' + self.source_pinblock + formats + b'552000000012'
+        return self.hsm._process_message(struct.pack('!H', len(body)) + body)
+
+    def test_parse(self):
+        cc = CC(self.source_zpk + self.destination_zpk + b'12' + self.source_pinblock + b'0101552000000012')
+        self.assertEqual(cc.get('Source ZPK'), self.source_zpk)
+        self.assertEqual(cc.get('Destination ZPK'), self.destination_zpk)
+        self.assertEqual(cc.get('Source PIN block'), self.source_pinblock)
+        self.assertEqual(cc.get('Destination PIN block format'), b'01')
+        self.assertEqual(cc.get('Account Number'), b'552000000012')
+
+    def test_translate(self):
+        response = self._request()
+        self.assertEqual(response.build(), b'\x00\x1cSSSSCD0004' + self.destination_pinblock + b'01')
+
+    def test_key_ciphers_reused(self):
+        self._request()
+        cipher = self.hsm._working_key(self.destination_zpk).get_cipher()
+        self._request()
+        self.assertIs(self.hsm._working_key(self.destination_zpk).get_cipher(), cipher)
+        self.assertEqual(self.hsm.key_cache.get_stats()['misses'], 2)
+
+    def test_key_ciphers_dropped_with_threads(self):
+        key = self.hsm._working_key(self.destination_zpk)
+        ciphers = []
+        for _ in range(3):
+            thread = threading.Thread(target=lambda: ciphers.append(weakref.ref(key.get_cipher())))
+            thread.start()
+            thread.join()
+        gc.collect()
+        self.assertEqual([cipher() for cipher in ciphers], [None] * 3)
+
+    def test_source_key_parity(self):
+        self.assertEqual(self._request(source_zpk=self.bad_parity_zpk).get('Error Code'), b'10')
+
+    def test_destination_key_parity(self):
+        self.assertEqual(self._request(destination_zpk=self.bad_parity_zpk).get('Error Code'), b'11')
+
+    def test_different_formats(self):
+        with self.assertRaisesRegex(ValueError, 'Cannot translate PIN block from format 01 to format 03'):
+            self._request(formats=b'0103')
+
+
+class TestKQ(unittest.TestCase):
+    # Clear key 032447698BACCFF0FFDDBB9977553311 under the default LMK
+    mk_ac = b'U613D213826396ED1C184D7DC81E484F7'
+    pan_psn = bytes.fromhex('4575272222567101')
+    atc = b'\x00\x2A'
+    un = bytes.fromhex('9BADBCAB')
+    data = bytes.fromhex('0000000010000000000000000826000000000008261711010034BA5A2A5C00002A0300')
+
+    def setUp(self):
+        self.hsm = HSM(log_level=LOG_OFF)
+
+    def _card_key(self):
+        mk = DES3.new(bytes.fromhex('032447698BACCFF0FFDDBB9977553311'), DES3.MODE_ECB)
+        return modify_key_parity(mk.encrypt(self.pan_psn) + mk.encrypt(bytes(b ^ 0xFF for b in self.pan_psn)))
+
+    @staticmethod
+    def _mac(key, data):
+        left, right = DES.new(key[:8], DES.MODE_ECB), DES.new(key[8:], DES.MODE_ECB)
+        data += bytes(-len(data) % 8)
+        h = bytes(8)
+        for i in range(0, len(data), 8):
+            h = left.encrypt(bytes(a ^ b for a, b in zip(h, data[i:i + 8])))
+        return left.encrypt(right.decrypt(h))
+
+    def _request(self, mode=b'1', scheme=b'0', arqc=None, arc=b'00'):
+        arqc = arqc if arqc is not None else self._mac(self._card_key(), self.data)
+        body = (b'SSSSKQ' + mode + scheme + self.mk_ac + self.pan_psn + self.atc + self.un
+                + b'%02X' % len(self.data) + self.data + b';' + arqc + (arc if mode != b'0' else b''))
+        return self.hsm._process_message(struct.pack('!H', len(body)) + body)
+
+    def test_parse(self):
+        kq = KQ(b'10' + self.mk_ac + self.pan_psn + self.atc + self.un + b'04ABCD;' + bytes(8) + b'00')
+        self.assertEqual(kq.get('Transaction Data Length'), b'04')
+        self.assertEqual(kq.get('Transaction Data'), b'ABCD')
+        self.assertEqual(kq.get('ARQC'), bytes(8))
+        self.assertEqual(kq.get('ARC'), b'00')
+
+    def test_verify_arqc_and_generate_arpc(self):
+        arqc = self._mac(self._card_key(), self.data)
+        response = self._request(arqc=arqc)
+        self.assertEqual(response.get('Error Code'), b'00')
+        expected = DES3.new(self._card_key(), DES3.MODE_ECB).encrypt(bytes(a ^ b for a, b in zip(arqc, b'00' + bytes(6))))
+        self.assertEqual(response.get('ARPC'), expected)
+
+    def test_verify_only(self):
+        response = self._request(mode=b'0')
+        self.assertEqual(response.get('Error Code'), b'00')
+        self.assertIsNone(response.get('ARPC'))
+
+    def test_arqc_mismatch(self):
+        self.assertEqual(self._request(arqc=bytes(8)).get('Error Code'), b'01')
+
+    def test_generate_arpc_only(self):
+        self.assertEqual(self._request(mode=b'2', arqc=bytes(8)).get('Error Code'), b'00')
+
+    def test_common_session_key(self):
+        card_key = DES3.new(self._card_key(), DES3.MODE_ECB)
+        session_key = modify_key_parity(card_key.encrypt(self.atc + b'\xF0' + bytes(5)) + card_key.encrypt(self.atc + b'\x0F' + bytes(5)))
+        arqc = self._mac(session_key, self.data + b'\x80')
+        self.assertEqual(self._request(scheme=b'1', arqc=arqc).get('Error Code'), b'00')
+        self.assertEqual(self._request(scheme=b'1', arqc=self._mac(self._card_key(), self.data)).get('Error Code'), b'01')
+
+    def test_card_key_cached(self):
+        for _ in range(3):
+            self._request()
+        self.assertEqual(self.hsm.card_key_cache.get_stats(), {'hits': 2, 'misses': 1, 'size': 1})
+
+    def test_mk_ac_parity(self):
+        self.mk_ac = b'U827E67B59A1D6B8F1E17D0BEA17FD101'
+        self.assertEqual(self._request().get('Error Code'), b'10')
+
+    def test_bench_sample(self):
+        body = b'SSSSKQ' + bench.COMMANDS[b'KQ']
+        self.assertEqual(self.hsm._process_message(struct.pack('!H', len(body)) + body).get('Error Code'), b'00')
+
+    def test_cache_benchmark(self):
+        report = bench.kq_cache_benchmark(requests=20, cards=4)
+        self.assertEqual(report['cards'], 4)
+        self.assertGreater(report['cached']['throughput'], 0)
+        self.assertGreater(report['uncached']['throughput'], 0)
+
+
+class TestM0M2(unittest.TestCase):
+    # Clear key 032447698BACCFF0FFDDBB9977553311 under the default LMK
+    key = b'U613D213826396ED1C184D7DC81E484F7'
+    clear_key = bytes.fromhex('032447698BACCFF0FFDDBB9977553311')
+    message = bytes(range(32))
+
+    def setUp(self):
+        self.hsm = HSM(log_level=LOG_OFF)
+
+    def _request(self, command_code, flags, message, key_type=b'00A', iv=None, length=None):
+        body = (b'SSSS' + command_code + flags + key_type + self.key + (iv or b'')
+                + (length if length is not None else b'%04X' % len(message)) + message)
+        return self.hsm._process_message(struct.pack('!H', len(body)) + body)
+
+    def test_parse(self):
+        data = b'0100' + b'00A' + self.key + b'0000000000000000' + b'0020' + self.message
+        request = M0(data)
+        self.assertEqual(request.get('Mode Flag'), b'01')
+        self.assertEqual(request.get('IV'), b'0000000000000000')
+        self.assertEqual(request.get('Message Length'), b'0020')
+        self.assertIsInstance(request.get('Message'), memoryview)
+        self.assertEqual(request.get('Message'), self.message)
+
+    def test_encrypt_ecb(self):
+        response = self._request(b'M0', b'0000', self.message)
+        self.assertEqual(response.get('Response Code'), b'M1')
+        self.assertEqual(response.get('Error Code'), b'00')
+        self.assertIsNone(response.get('IV'))
+        self.assertEqual(response.get('Message Length'), b'0020')
+        self.assertEqual(response.get('Message'), DES3.new(self.clear_key, DES3.MODE_ECB).encrypt(self.message))
+
+    def test_encrypt_cbc_hex_output(self):
+        iv = b'0102030405060708'
+        expected = DES3.new(self.clear_key, DES3.MODE_CBC, bytes.fromhex(iv.decode())).encrypt(self.message)
+        response = self._request(b'M0', b'0101', self.message, iv=iv)
+        self.assertEqual(response.get('Error Code'), b'00')
+        self.assertEqual(response.get('Message'), expected.hex().upper().encode())
+        self.assertEqual(response.get('Message Length'), b'0040')
+        self.assertEqual(response.get('IV'), expected[-8:].hex().upper().encode())
+
+    def test_decrypt_cbc_chained(self):
+        ciphertext = DES3.new(self.clear_key, DES3.MODE_CBC, bytes(8)).encrypt(self.message)
+        first = self._request(b'M2', b'0110', ciphertext[:16].hex().upper().encode(), key_type=b'00B', iv=b'0000000000000000')
+        self.assertEqual(first.get('Response Code'), b'M3')
+        self.assertEqual(first.get('Message'), self.message[:16])
+        second = self._request(b'M2', b'0100', ciphertext[16:], key_type=b'00B', iv=first.get('IV'))
+        self.assertEqual(second.get('Message'), self.message[16:])
+
+    def test_length_not_multiple_of_8(self):
+        self.assertEqual(self._request(b'M0', b'0000', self.message[:7]).get('Error Code'), b'80')
+
+    def test_truncated_message(self):
+        self.assertEqual(self._request(b'M0', b'0000', self.message, length=b'0028').get('Error Code'), b'15')
+
+    def test_invalid_hex(self):
+        self.assertEqual(self._request(b'M0', b'0010', b'ZZZZZZZZZZZZZZZZ').get('Error Code'), b'15')
+
+    def test_invalid_mode(self):
+        self.assertEqual(self._request(b'M0', b'0300', self.message).get('Error Code'), b'15')
+
+    def test_invalid_key_type(self):
+        self.assertEqual(self._request(b'M0', b'0000', self.message, key_type=b'001').get('Error Code'), b'04')
+
+    def test_output_too_long(self):
+        self.assertEqual(self._request(b'M0', b'0001', bytes(40000)).get('Error Code'), b'80')
+
+    def test_trace(self):
+        self.assertIn('[Message', M0(b'0000' + b'00A' + self.key + b'0008' + b'ABCDEFGH').trace())
+
+
+class TestHSMConcurrency(unittest.TestCase):
+    """
+    Stress test: concurrent EC and CA requests must give the same results as
+    the requests processed one by one
+    """
+    zpk = b'U613D213826396ED1C184D7DC81E484F7'
+    destination_zpk = b'UDD0212CA505034DADF6A534DE1E06385'
+
+    def _frames(self, count):
+        frames = []
+        for i in range(count):
+            pinblock = '{:016X}'.format(i * 7919 + 1).encode()
+            if i % 2:
+                data = b'SSSSEC' + self.zpk + b'7336D50C47128D710DF450BCB2C6461B' + pinblock + b'01407000000010' + b'13843'
+            else:
+                data = b'SSSSCA' + self.zpk + self.destination_zpk + b'12' + pinblock + b'0101552000000012'
+            frames.append(struct.pack('!H', len(data)) + data)
+        return frames
+
+    def test_concurrent_results_match_reference(self):
+        frames = self._frames(2000)
+        with contextlib.redirect_stdout(io.StringIO()):
+            reference = [HSM()._process_message(frame).build() for frame in frames]
+            hsm = HSM()
+            with ThreadPoolExecutor(max_workers=16) as pool:
+                results = [response.build() for response in pool.map(hsm._process_message, frames)]
+        self.assertEqual(results, reference)
+        self.assertEqual(len(set(reference)), len(reference) // 2 + 1)
+        self.assertEqual(hsm.stats[hsm_module.STAT_REQUESTS], len(frames))
+
+
+class TestTraceLog(unittest.TestCase):
+    def setUp(self):
+        self.written = []
+        self.formatted = []
+
+    def _format(self, text):
+        self.formatted.append(text)
+        return text
+
+    def test_records_above_level_not_formatted(self):
+        log = TraceLog(level=LOG_SUMMARY, queue_size=0, writer=self.written.append)
+        log.full(self._format, 'fields')
+        log.summary('{} bytes', 10)
+        self.assertEqual(self.formatted, [])
+        self.assertEqual(self.written, ['10 bytes'])
+
+    def test_off(self):
+        log = TraceLog(level=LOG_OFF, queue_size=0, writer=self.written.append)
+        log.summary('message')
+        log.trace(b'\x00\x01', 'title')
+        self.assertEqual(self.written, [])
+
+    def test_hsm_debug_trace(self):
+        hsm = HSM(debug=True, log_level=LOG_OFF)
+        hsm.log = TraceLog(level=LOG_SUMMARY, queue_size=0, writer=self.written.append)
+        hsm._debug_trace('Invalid message: {}', ValueError('{x}'))
+        hsm.debug = False
+        hsm._debug_trace('Decrypted pinblock: {}', '0000')
+        self.assertEqual(self.written, ['\tDEBUG: Invalid message: {x}\n'])
+
+    def test_trace_summary_writes_title_only(self):
+        log = TraceLog(level=LOG_SUMMARY, queue_size=0, writer=self.written.append)
+        log.trace(b'\x00\x01', '<< {} bytes', 2)
+        self.assertEqual(self.written, ['<< 2 bytes'])
+
+    def test_trace_full_writes_dump(self):
+        log = TraceLog(level=LOG_FULL, writer=self.written.append)
+        log.trace(b'\x00\x01', '<< {} bytes', 2)
+        log.flush(5)
+        self.assertIn('<< 2 bytes\n\t00 01', self.written[0])
+
+    def test_overflow_dropped(self):
+        blocked = threading.Event()
+        log = TraceLog(level=LOG_FULL, queue_size=1, writer=lambda text: blocked.wait(5))
+        for i in range(5):
+            log.summary('message {}', i)
+        blocked.set()
+        log.flush(5)
+        self.assertGreaterEqual(log.dropped, 3)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_bucket_bounds_contain_value(self):
+        for value in (0, 1, 31, 32, 33, 63, 64, 1000, 123456, 10 ** 9):
+            lower, upper = bucket_bounds(bucket_index(value))
+            self.assertTrue(lower <= value < upper)
+            self.assertLessEqual(upper - lower, max(1, lower / 16))
+
+    def test_histogram_percentile(self):
+        histogram = Histogram()
+        for i in range(1, 1001):
+            histogram.record(i / 1000000.0)
+        self.assertAlmostEqual(histogram.percentile(50), 0.0005, delta=0.00005)
+        self.assertAlmostEqual(histogram.percentile(99), 0.00099, delta=0.0001)
+
+    def test_counter_from_threads(self):
+        counter = MetricsRegistry().counter('requests_total')
+        threads = [threading.Thread(target=lambda: [counter.inc() for _ in range(1000)]) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(counter.get(), 8000)
+
+    def test_finished_threads_are_retired(self):
+        counter = Counter()
+        histogram = Histogram()
+        def work():
+            counter.inc(2)
+            histogram.record(0.001)
+        for _ in range(50):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+        gc.collect()
+        self.assertEqual(len(counter._shards), 0)
+        self.assertEqual(len(histogram._shards), 0)
+        self.assertEqual(counter.get(), 100)
+        self.assertEqual(histogram.get()[1], 50)
+        self.assertAlmostEqual(histogram.get()[2], 0.05)
+
+    def test_hsm_queue_depth(self):
+        hsm = HSM(log_level=LOG_OFF)
+        self.assertIn('hsm_queue_depth 0\n', hsm.metrics.render())
+
+    def test_render(self):
+        registry = MetricsRegistry()
+        registry.counter('hsm_requests_total', 'Requests', command='NC').inc(2)
+        registry.histogram('hsm_request_duration_seconds', command='NC').record(0.0003)
+        registry.gauge('hsm_queue_depth', lambda: 5)
+        text = registry.render()
+        self.assertIn('# TYPE hsm_requests_total counter\nhsm_requests_total{command="NC"} 2\n', text)
+        self.assertIn('hsm_request_duration_seconds_bucket{command="NC",le="0.00025"} 0\n', text)
+        self.assertIn('hsm_request_duration_seconds_bucket{command="NC",le="0.0005"} 1\n', text)
+        self.assertIn('hsm_request_duration_seconds_count{command="NC"} 1\n', text)
+        self.assertIn('hsm_queue_depth 5\n', text)
+
+    def test_hsm_metrics_endpoint(self):
+        hsm = HSM(log_level=LOG_OFF)
+        hsm._process_message(b'\x00\x06SSSSNC')
+        hsm._process_message(b'\x00\x06SSSSXX')
+        with self.assertRaises(ValueError):
+            hsm._process_message(b'\x00\x07SSSSNC')
+        server = MetricsServer(hsm.metrics, 0).start()
+        try:
+            text = urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(server.port)).read().decode()
+        finally:
+            server.stop()
+        self.assertIn('hsm_requests_total{command="NC"} 1\n', text)
+        self.assertIn('hsm_responses_total{command="NC",error_code="00"} 1\n', text)
+        self.assertIn('hsm_unsupported_commands_total 1\n', text)
+        self.assertIn('hsm_parse_failures_total 1\n', text)
+
+
+class TestHSMAsync(unittest.TestCase):
+    def setUp(self):
+        self.hsm = HSM(skip_parity=True)
+
+    def _exchange(self, frames):
+        async def run():
+            server = await asyncio.start_server(self.hsm._client_async, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            for frame in frames:
+                writer.write(frame)
+            responses = []
+            for _ in frames:
+                length = await reader.readexactly(2)
+                responses.append(length + await reader.readexactly(int.from_bytes(length, 'big')))
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return responses
+        return asyncio.run(run())
+
+    def test_NC_response(self):
+        response = self._exchange([b'\x00\x06SSSSNC'])[0]
+        self.assertEqual(response[2:10], b'SSSSND00')
+
+    def test_no_trace_when_log_off(self):
+        hsm = HSM(log_level=LOG_OFF)
+        writer = unittest.mock.Mock()
+        writer.is_closing.return_value = False
+        with unittest.mock.patch.object(hsm.log, 'trace') as trace:
+            hsm._write_async(writer, hsm._process_message(b'\x00\x06SSSSNC'), 'test')
+        trace.assert_not_called()
+        writer.writelines.assert_called_once()
+
+    def test_pipelined_responses_keep_order(self):
+        responses = self._exchange([b'\x00\x06AAAANC', b'\x00\x06BBBBNC'])
+        self.assertEqual([r[2:6] for r in responses], [b'AAAA', b'BBBB'])
+
+    def test_delayed_responses_keep_order(self):
+        self.hsm.profile = SimulationProfile({'NC': {'latency_ms': 50}})
+        started = time.perf_counter()
+        responses = self._exchange([b'\x00\x06AAAANC', struct.pack('!H', 6 + len(bench.COMMANDS[b'BU'])) + b'BBBBBU' + bench.COMMANDS[b'BU'], b'\x00\x06CCCCNC'])
+        self.assertGreaterEqual(time.perf_counter() - started, 0.05)
+        self.assertEqual([r[2:6] for r in responses], [b'AAAA', b'BBBB', b'CCCC'])
+
+    def test_responses_pipelined_behind_delayed_keep_order(self):
+        self.hsm.profile = SimulationProfile({'NC': {'latency_ms': 50}})
+        headers = [b'AAAA'] + [b'%04d' % i for i in range(20)]
+        frames = [b'\x00\x06AAAANC'] + [struct.pack('!H', 6 + len(bench.COMMANDS[b'BU'])) + header + b'BU' + bench.COMMANDS[b'BU'] for header in headers[1:]]
+        self.assertEqual([r[2:6] for r in self._exchange(frames)], headers)
+
+    def _block_nc(self):
+        """
+        Hold the NC requests in the pool worker until self.proceed is set
+        """
+        self.proceed = threading.Event()
+        self.addCleanup(self.proceed.set)
+        parser, handler = self.hsm._commands[b'NC']
+
+        def blocked(request, header):
+            self.proceed.wait(5)
+            return handler(request, header)
+
+        self.hsm._commands[b'NC'] = (parser, blocked)
+
+    def test_slow_command_does_not_stall_other_connections(self):
+        # One worker for the blocked NC and one for the other connection, whatever the CPU count
+        self.hsm.scheduler.executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(self.hsm.scheduler.executor.shutdown)
+        self._block_nc()
+        bu = struct.pack('!H', 6 + len(bench.COMMANDS[b'BU'])) + b'BBBBBU' + bench.COMMANDS[b'BU']
+
+        async def run():
+            server = await asyncio.start_server(self.hsm._client_async, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            slow_reader, slow_writer = await asyncio.open_connection('127.0.0.1', port)
+            slow_writer.write(b'\x00\x06AAAANC')
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(bu)
+            length = await asyncio.wait_for(reader.readexactly(2), 5)
+            fast = await reader.readexactly(int.from_bytes(length, 'big'))
+            in_flight = self.hsm._in_flight.get()
+            self.proceed.set()
+            length = await asyncio.wait_for(slow_reader.readexactly(2), 5)
+            slow = await slow_reader.readexactly(int.from_bytes(length, 'big'))
+            for stream in (writer, slow_writer):
+                stream.close()
+            server.close()
+            return fast, slow, in_flight
+
+        fast, slow, in_flight = asyncio.run(run())
+        self.assertEqual(fast[:8], b'BBBBBV00')
+        self.assertEqual(slow[:8], b'AAAAND00')
+        self.assertEqual(in_flight, 1)
+
+    def test_admission_control(self):
+        self.hsm = HSM(log_level=LOG_OFF, max_in_flight_per_connection=1, busy_error_code='42')
+        self._block_nc()
+        frames = [b'\x00\x06AAAANC', b'\x00\x06BBBBNC']
+        threading.Timer(0.1, self.proceed.set).start()
+        responses = self._exchange(frames)
+        self.assertEqual([response[2:10] for response in responses], [b'AAAAND00', b'BBBBND42'])
+        self.assertEqual(self.hsm.admission.rejected, 1)
+
+
+class TestClientConnection(unittest.TestCase):
+    def setUp(self):
+        self.server_side, self.client_side = socket.socketpair()
+        self.sent = []
+
+    def tearDown(self):
+        self.client_side.close()
+
+    def _send(self, conn, response, client_name):
+        self.sent.append(response)
+
+    def _run(self, ordered, completion_order):
+        connection = ClientConnection(self.server_side, 'test', self._send, ordered=ordered)
+        seqs = [connection.register() for _ in completion_order]
+        for seq in completion_order:
+            connection.put(seqs[seq], None if seq == 1 else seq)
+        connection.close()
+        connection.join(5)
+        return self.sent
+
+    def test_fifo_order(self):
+        self.assertEqual(self._run(True, [3, 1, 0, 2]), [0, 2, 3])
+
+    def test_out_of_order(self):
+        self.assertEqual(self._run(False, [3, 1, 0, 2]), [3, 0, 2])
+
+    def test_socket_closed_after_pending_responses(self):
+        self._run(True, [0])
+        self.assertEqual(self.server_side.fileno(), -1)
+
+    def test_ready_responses_coalesced(self):
+        writes = []
+        connection = ClientConnection(self.server_side, 'test', self._send, send_many=lambda conn, responses, name: writes.append(responses))
+        seqs = [connection.register() for _ in range(4)]
+        # Nothing can be written before the first response is ready
+        for seq in (3, 2, 1):
+            connection.put(seqs[seq], seq)
+        time.sleep(0.05)
+        connection.put(seqs[0], 0)
+        connection.close()
+        connection.join(5)
+        self.assertEqual(writes, [[0, 1, 2, 3]])
+        self.assertEqual(self.sent, [])
+
+
+class TestAdmissionControl(unittest.TestCase):
+    def setUp(self):
+        self.connections = [unittest.mock.Mock(in_flight=0) for _ in range(2)]
+
+    def test_unlimited(self):
+        admission = AdmissionControl()
+        self.assertFalse(admission.enabled)
+        self.assertTrue(all(admission.acquire(self.connections[0], block=False) for _ in range(100)))
+
+    def test_per_connection_limit(self):
+        admission = AdmissionControl(max_per_connection=2)
+        self.assertTrue(admission.acquire(self.connections[0], block=False))
+        self.assertTrue(admission.acquire(self.connections[0], block=False))
+        self.assertFalse(admission.acquire(self.connections[0], block=False))
+        self.assertTrue(admission.acquire(self.connections[1], block=False))
+        self.assertEqual((admission.in_flight, admission.rejected), (3, 1))
+        admission.release(self.connections[0])
+        self.assertTrue(admission.acquire(self.connections[0], block=False))
+
+    def test_global_limit(self):
+        admission = AdmissionControl(max_in_flight=1)
+        self.assertTrue(admission.acquire(self.connections[0], block=False))
+        self.assertFalse(admission.acquire(self.connections[1], block=False))
+
+    def test_acquire_waits_for_release(self):
+        admission = AdmissionControl(max_in_flight=1)
+        admission.acquire(self.connections[0])
+        waiter = threading.Thread(target=admission.acquire, args=(self.connections[1],))
+        waiter.start()
+        time.sleep(0.05)
+        self.assertTrue(waiter.is_alive())
+        admission.release(self.connections[0])
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual((admission.waits, admission.in_flight, self.connections[1].in_flight), (1, 1, 1))
+
+
+class TestFairScheduler(unittest.TestCase):
+    class Executor():
+        def __init__(self):
+            self.tasks = []
+
+        def submit(self, function, *args):
+            self.tasks.append((function, args))
+
+        def run(self):
+            for function, args in self.tasks:
+                function(*args)
+            self.tasks = []
+
+    def setUp(self):
+        self.executor = self.Executor()
+        self.scheduler = FairScheduler(self.executor)
+        self.connections = [unittest.mock.Mock(), unittest.mock.Mock()]
+        self.done = []
+
+    def _submit(self, connection, command_code, name, weight=1.0):
+        self.scheduler.submit(self.connections[connection], weight, command_code, self.done.append, name)
+
+    def test_priority_classes(self):
+        self._submit(0, b'A0', 'A0')
+        self._submit(0, b'NC', 'NC')
+        self._submit(1, b'EC', 'EC')
+        self.assertEqual(self.scheduler.queued(self.scheduler.class_of(b'A0')), 1)
+        self.executor.run()
+        self.assertEqual(self.done, ['EC', 'NC', 'A0'])
+
+    def test_connections_interleaved(self):
+        for i in range(4):
+            self._submit(0, b'EC', 'a{}'.format(i))
+        for i in range(2):
+            self._submit(1, b'EC', 'b{}'.format(i))
+        self.executor.run()
+        self.assertEqual(self.done, ['a0', 'b0', 'a1', 'b1', 'a2', 'a3'])
+
+    def test_weights(self):
+        for i in range(4):
+            self._submit(0, b'EC', 'a{}'.format(i))
+        for i in range(4):
+            self._submit(1, b'EC', 'b{}'.format(i), weight=4.0)
+        self.executor.run()
+        self.assertEqual(self.done[:5], ['b0', 'b1', 'b2', 'a0', 'b3'])
+
+    def test_idle_connection_does_not_save_credit(self):
+        for i in range(3):
+            self._submit(0, b'EC', 'a{}'.format(i))
+        self.executor.run()
+        self._submit(0, b'EC', 'a3')
+        self._submit(1, b'EC', 'b0')
+        self._submit(1, b'EC', 'b1')
+        self.executor.run()
+        self.assertEqual(self.done[3:], ['a3', 'b0', 'b1'])
+
+    def test_wait_recorded_per_class(self):
+        self._submit(0, b'EC', 'EC')
+        self._submit(0, b'A0', 'A0')
+        self.executor.run()
+        self.assertEqual([histogram.get()[1] for histogram in self.scheduler.wait_histograms], [1, 0, 1])
+
+    def test_parse_priority_classes(self):
+        self.assertEqual(parse_priority_classes(['pin=ec, dc', 'keys=A0']), (('pin', (b'EC', b'DC')), ('keys', (b'A0',)), ('default', ())))
+        self.assertEqual(parse_priority_classes(['default', 'keys=A0']), (('default', ()), ('keys', (b'A0',))))
+        with self.assertRaises(ValueError):
+            parse_priority_classes(['pin=EC', 'pin=DC'])
+
+    def test_parse_connection_weights(self):
+        self.assertEqual(parse_connection_weights(['10.0.0.1=4']), {'10.0.0.1': 4.0})
+        for spec in ('10.0.0.1', '10.0.0.1=0'):
+            with self.assertRaises(ValueError):
+                parse_connection_weights([spec])
+
+    def test_hsm_metrics(self):
+        hsm = HSM(log_level=LOG_OFF, priority_classes=parse_priority_classes(['pin=EC']))
+        self.assertEqual(hsm.scheduler.classes, ['pin', 'default'])
+        metrics = hsm.metrics.render()
+        self.assertIn('hsm_queue_wait_seconds_count{class="pin"} 0', metrics)
+        self.assertIn('hsm_scheduler_queued{class="default"} 0', metrics)
+
+
+class TestSimulationProfile(unittest.TestCase):
+    def test_latency_distributions(self):
+        profile = SimulationProfile({
+            'A0': {'latency_ms': 20},
+            'EC': {'latency_ms': {'distribution': 'uniform', 'min': 4, 'max': 6}},
+            'CA': {'latency_ms': {'distribution': 'normal', 'mean': 5, 'stddev': 1}},
+            'HC': {'latency_ms': {'distribution': 'exponential', 'mean': 5}},
+        }, default={'latency_ms': {'distribution': 'fixed', 'value': 1}})
+        self.assertEqual(profile.delay(b'A0', now=0), 0.02)
+        self.assertEqual(profile.delay(b'NC', now=0), 0.001)
+        self.assertTrue(all(0.004 <= profile.delay(b'EC', now=0) <= 0.006 for _ in range(100)))
+        self.assertTrue(all(profile.delay(command, now=0) >= 0 for command in (b'CA', b'HC') for _ in range(100)))
+
+    def test_invalid_latency(self):
+        for latency in ({'distribution': 'poisson'}, {'distribution': 'uniform', 'min': 1}, 'fast'):
+            with self.assertRaises(ValueError):
+                SimulationProfile({'A0': {'latency_ms': latency}})
+
+    def test_throughput_cap(self):
+        profile = SimulationProfile(throughput=100)
+        self.assertEqual([round(profile.delay(b'NC', now=10.0), 6) for _ in range(3)], [0, 0.01, 0.02])
+        # Idle time is not saved up for a burst
+        self.assertEqual(profile.delay(b'NC', now=20.0), 0)
+
+    def test_injected_errors(self):
+        profile = SimulationProfile({'EC': {'errors': {'01': 0.2, '15': 0.1}}})
+        for draw, expected in ((0.1, b'01'), (0.25, b'15'), (0.5, None)):
+            with unittest.mock.patch('random.random', return_value=draw):
+                self.assertEqual(profile.inject_error(b'EC'), expected)
+        self.assertIsNone(profile.inject_error(b'NC'))
+        with self.assertRaises(ValueError):
+            SimulationProfile({'EC': {'errors': {'01': 0.6, '15': 0.6}}})
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            name = os.path.join(directory, 'profile.json')
+            with open(name, 'w') as f:
+                f.write('{"throughput": 250, "commands": {"EC": {"latency_ms": 4, "errors": {"01": 1}}}}')
+            profile = SimulationProfile.load(name)
+        self.assertEqual(profile.throughput, 250)
+        self.assertEqual(profile.inject_error(b'EC'), b'01')
+
+    def test_hsm_injected_error(self):
+        hsm = HSM(log_level=LOG_OFF, simulation_profile=SimulationProfile({'NC': {'errors': {'42': 1}}}))
+        response = hsm._process_message(b'\x00\x06SSSSNC')
+        self.assertEqual(response.build(), b'\x00\x08SSSSND42')
+        self.assertIn('hsm_responses_total{command="NC",error_code="42"} 1', hsm.metrics.render())
+
+    def test_hsm_delayed_response(self):
+        hsm = HSM(log_level=LOG_OFF, simulation_profile=SimulationProfile({'NC': {'latency_ms': 50}}))
+        server_side, client_side = socket.socketpair()
+        self.addCleanup(client_side.close)
+        threading.Thread(target=hsm._client_thread, args=(server_side, 'test'), daemon=True).start()
+        started = time.perf_counter()
+        client_side.sendall(b'\x00\x06AAAANC' + struct.pack('!H', 6 + len(bench.COMMANDS[b'BU'])) + b'BBBBBU' + bench.COMMANDS[b'BU'])
+        reader = FrameReader(client_side)
+        responses = [reader.read_frame()[2:8] for _ in range(2)]
+        self.assertGreaterEqual(time.perf_counter() - started, 0.05)
+        self.assertEqual(responses, [b'AAAAND', b'BBBBBV'])
+
+
+    def test_delayed_response_stays_in_flight(self):
+        hsm = HSM(log_level=LOG_OFF, max_in_flight_per_connection=1, simulation_profile=SimulationProfile({'NC': {'latency_ms': 100}}))
+        server_side, client_side = socket.socketpair()
+        self.addCleanup(client_side.close)
+        threading.Thread(target=hsm._client_thread, args=(server_side, 'test'), daemon=True).start()
+        client_side.sendall(b'\x00\x06AAAANC\x00\x06BBBBNC')
+        time.sleep(0.05)
+        self.assertEqual((hsm.admission.in_flight, hsm.admission.waits), (1, 1))
+        reader = FrameReader(client_side)
+        self.assertEqual([reader.read_frame()[2:6] for _ in range(2)], [b'AAAA', b'BBBB'])
+
+
+class TestResponseTimer(unittest.TestCase):
+    def test_calls_in_time_order(self):
+        timer = ResponseTimer()
+        called = []
+        done = threading.Event()
+        now = time.monotonic()
+        timer.call_at(now + 0.1, lambda: (called.append('late'), done.set()))
+        timer.call_at(now + 0.02, called.append, 'early')
+        timer.call_at(now - 1, called.append, 'overdue')
+        self.assertTrue(done.wait(5))
+        self.assertEqual(called, ['overdue', 'early', 'late'])
+        self.assertEqual(len(timer), 0)
+        self.assertGreaterEqual(time.monotonic() - now, 0.1)
+
+
+class TestHSMAdmission(unittest.TestCase):
+    def _serve(self, **kwargs):
+        """
+        Serve one connection with the NC handler blocked until self.proceed is set
+        """
+        self.hsm = HSM(log_level=LOG_OFF, max_in_flight_per_connection=1, **kwargs)
+        self.proceed = threading.Event()
+        parser, handler = self.hsm._commands[b'NC']
+
+        def blocked(request, header):
+            self.proceed.wait(5)
+            return handler(request, header)
+
+        self.hsm._commands[b'NC'] = (parser, blocked)
+        server_side, self.client_side = socket.socketpair()
+        self.addCleanup(self.client_side.close)
+        thread = threading.Thread(target=self.hsm._client_thread, args=(server_side, 'test'), daemon=True)
+        thread.start()
+
+    def _responses(self, count):
+        reader = FrameReader(self.client_side)
+        return [reader.read_frame()[2:] for _ in range(count)]
+
+    def test_busy_error(self):
+        self._serve(busy_error_code='42')
+        self.client_side.sendall(b'\x00\x06AAAANC\x00\x06BBBBNC')
+        time.sleep(0.05)
+        self.proceed.set()
+        responses = self._responses(2)
+        self.assertEqual(responses[0][:8], b'AAAAND00')
+        self.assertEqual(responses[1], b'BBBBND42')
+        self.assertEqual(self.hsm.admission.rejected, 1)
+
+    def test_backpressure(self):
+        self._serve()
+        self.client_side.sendall(b'\x00\x06AAAANC\x00\x06BBBBNC\x00\x06CCCCNC')
+        time.sleep(0.05)
+        self.assertEqual(self.hsm.admission.in_flight, 1)
+        self.assertEqual(self.hsm.admission.waits, 1)
+        self.proceed.set()
+        self.assertEqual([response[:8] for response in self._responses(3)], [b'AAAAND00', b'BBBBND00', b'CCCCND00'])
+        self.assertEqual(self.hsm.admission.rejected, 0)
+
+    def test_unread_responses_held_in_flight(self):
+        sending = threading.Event()
+        self.addCleanup(sending.set)
+        send_many = HSM.send_many
+
+        def blocked(hsm, conn, responses, client_name=None):
+            sending.wait(5)
+            send_many(hsm, conn, responses, client_name)
+
+        with unittest.mock.patch.object(HSM, 'send_many', blocked):
+            self._serve()
+        self.proceed.set()
+        self.client_side.sendall(b'\x00\x06AAAANC\x00\x06BBBBNC')
+        time.sleep(0.05)
+        self.assertEqual(self.hsm.admission.in_flight, 1)
+        self.assertEqual(self.hsm.admission.waits, 1)
+        sending.set()
+        self.assertEqual([response[:8] for response in self._responses(2)], [b'AAAAND00', b'BBBBND00'])
+
+    def test_submit_failure_closes_connection(self):
+        self._serve()
+        self.hsm.thread_pool.shutdown()
+        self.client_side.settimeout(5)
+        self.client_side.sendall(b'\x00\x06AAAANC')
+        self.assertEqual(self.client_side.recv(100), b'')
+        self.assertEqual(self.hsm.admission.in_flight, 0)
+
+    def test_invalid_busy_error_code(self):
+        with self.assertRaises(ValueError):
+            HSM(log_level=LOG_OFF, busy_error_code='4')
+
+
+class TestSendBuffers(unittest.TestCase):
+    class PartialSocket():
+        """
+        Accepts at most 3 bytes per sendmsg() call
+        """
+        def __init__(self):
+            self.data = b''
+            self.calls = 0
+
+        def sendmsg(self, buffers):
+            self.calls += 1
+            chunk = b''.join(bytes(buffer) for buffer in buffers)[:3]
+            self.data += chunk
+            return len(chunk)
+
+    def test_partial_writes(self):
+        conn = self.PartialSocket()
+        send_buffers(conn, [b'\x00\x06', b'SSSS', b'', b'NDA', b'00'])
+        self.assertEqual(conn.data, b'\x00\x06SSSSNDA00')
+        self.assertEqual(conn.calls, 4)
+
+    def test_iov_max(self):
+        for result in (-1, 0, ValueError('SC_IOV_MAX'), OSError()):
+            with unittest.mock.patch.object(os, 'sysconf', side_effect=result if isinstance(result, Exception) else None, return_value=result):
+                self.assertEqual(hsm_module.get_iov_max(), 1024)
+        with unittest.mock.patch.object(os, 'sysconf', return_value=16):
+            self.assertEqual(hsm_module.get_iov_max(), 16)
+
+    def test_single_call(self):
+        server_side, client_side = socket.socketpair()
+        with server_side, client_side:
+            response = OutgoingMessage(header=b'SSSS')
+            response.set_response_code('ND')
+            response.set_error_code('00')
+            self.assertEqual(response.buffers(), [b'\x00\x08', b'SSSS', b'ND', b'00'])
+            send_buffers(server_side, response.buffers() * 2)
+            self.assertEqual(client_side.recv(100), response.build() * 2)
+
+    def test_hsm_socket_options(self):
+        hsm = HSM(log_level=LOG_OFF, nodelay=True, rcvbuf=65536)
+        with socket.socket() as sock:
+            hsm._set_buffer_sizes(sock)
+            hsm._configure_client_socket(sock)
+            self.assertTrue(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+            self.assertGreaterEqual(sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), 65536)
+
+    def test_hsm_async_listening_socket(self):
+        hsm = HSM(log_level=LOG_OFF, rcvbuf=65536)
+        hsm.port = 0
+        async def accept():
+            accepted = asyncio.get_running_loop().create_future()
+            server = await asyncio.start_server(lambda reader, writer: accepted.set_result(writer), sock=hsm._listen(reuse_address=True))
+            async with server:
+                port = server.sockets[0].getsockname()[1]
+                _, writer = await asyncio.open_connection('127.0.0.1', port)
+                conn = (await accepted).get_extra_info('socket')
+                rcvbuf = conn.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+                writer.close()
+                return rcvbuf
+        self.assertGreaterEqual(asyncio.run(accept()), 65536)
+
+
+class TestFrameReader(unittest.TestCase):
+    class CountingSocket():
+        def __init__(self, conn):
+            self.conn = conn
+            self.reads = 0
+
+        def recv_into(self, buffer):
+            self.reads += 1
+            return self.conn.recv_into(buffer)
+
+    def setUp(self):
+        self.server_side, self.client_side = socket.socketpair()
+        self.conn = self.CountingSocket(self.server_side)
+
+    def tearDown(self):
+        self.server_side.close()
+        self.client_side.close()
+
+    def _frame(self, data):
+        return struct.pack('!H', len(data)) + data
+
+    def test_pipelined_burst_single_read(self):
+        frames = [self._frame(b'SSSSNC%04d' % i) for i in range(50)]
+        self.client_side.sendall(b''.join(frames))
+        self.assertEqual(FrameReader(self.conn).read_frames(), frames)
+        self.assertEqual(self.conn.reads, 1)
+
+    def test_frame_split_between_reads(self):
+        reader = FrameReader(self.conn)
+        frame = self._frame(b'SSSSNC')
+        self.client_side.sendall(frame[:1])
+        threading.Timer(0.05, self.client_side.sendall, args=(frame[1:] + frame[:3],)).start()
+        self.assertEqual(reader.read_frame(), frame)
+        self.client_side.sendall(frame[3:])
+        self.assertEqual(reader.read_frame(), frame)
+
+    def test_frame_bigger_than_buffer(self):
+        reader = FrameReader(self.conn, buffer_size=64)
+        frames = [self._frame(b'SSSSNC'), self._frame(b'X' * 60000), self._frame(b'SSSSBU')]
+        threading.Thread(target=self.client_side.sendall, args=(b''.join(frames),)).start()
+        received = []
+        while len(received) < 3:
+            received += reader.read_frames()
+        self.assertEqual(received, frames)
+
+    def test_closed_connection(self):
+        self.client_side.close()
+        self.assertEqual(FrameReader(self.conn).read_frames(), [])
+
+    def test_hsm_recv_and_recv_message_share_buffer(self):
+        hsm = HSM(log_level=LOG_OFF)
+        self.client_side.sendall(self._frame(b'SSSSNC') + self._frame(b'SSSSBU'))
+        self.assertEqual(hsm.recv_message(self.server_side), self._frame(b'SSSSNC'))
+        self.assertEqual(hsm.recv(self.server_side), self._frame(b'SSSSBU'))
+        self.client_side.close()
+        with self.assertRaises(IOError):
+            hsm.recv_message(self.server_side)
+
+
+class TestBatchCVV(unittest.TestCase):
+    # Clear CVK 0123456789ABCDEFFEDCBA9876543210 (no odd parity) under the default LMK
+    CVK = 'U827E67B59A1D6B8F1E17D0BEA17FD101'
+
+    def test_decrypt_key_parity(self):
+        with self.assertRaisesRegex(ValueError, 'Key parity error'):
+            batch.decrypt_key(self.CVK)
+        self.assertEqual(batch.decrypt_key(self.CVK, skip_parity=True).hex().upper(), '0123456789ABCDEFFEDCBA9876543210')
+
+    def test_visa_cvv(self):
+        generator = batch.CVVGenerator(batch.decrypt_key(self.CVK, skip_parity=True))
+        self.assertEqual(generator.cvv('4123456789012345', '8701', '101'), '561')
+
+    def test_cw_test_vector(self):
+        # The CVV that TestHSMThread.test_generate_cvv_proper_response_code expects from CW
+        [row] = batch.generate_cvvs([('4575272222567122', '2010', '000')], 'U1C1EB1090681CC9E6003E05217C7077E', workers=0)
+        self.assertEqual(row[3], '670')
+
+    def test_same_as_hsm(self):
+        cvk = 'U1C1EB1090681CC9E6003E05217C7077E'
+        hsm = HSM(log_level=LOG_OFF)
+        [row] = batch.generate_cvvs([('4575272222567122', '2010', '201')], cvk, workers=0)
+        for cvv, service_code in zip(row[3:], (b'201', b'000', b'999')):
+            request = CW(cvk.encode() + b'4575272222567122;2010' + service_code)
+            self.assertEqual(hsm.generate_cvv(request, b'').get('CVV'), cvv.encode())
+            self.assertEqual(hsm.verify_cvv(CY(cvk.encode() + cvv.encode() + b'4575272222567122;2010' + service_code), b'').get('Error Code'), b'00')
+
+    def test_decimalise(self):
+        self.assertEqual(batch.decimalise('ABCDEF1A', 4), '1012')
+        self.assertEqual(batch.decimalise('12345', 3), '123')
+
+    def test_read_records(self):
+        lines = ['PAN,Expiry,Service Code', '4123456789012345,8701,101', '', '4575272222567122, 2010, 201']
+        self.assertEqual(list(batch.read_cvv_records(lines)), [('4123456789012345', '8701', '101'), ('4575272222567122', '2010', '201')])
+        with self.assertRaisesRegex(ValueError, 'Line 2: invalid record'):
+            list(batch.read_cvv_records(['4123456789012345,8701,101', '4123456789012345,87,101']))
+
+    def test_worker_processes(self):
+        records = [('%016d' % (4000000000000000 + i), '2512', '201') for i in range(250)]
+        expected = list(batch.generate_cvvs(records, self.CVK, workers=0, skip_parity=True))
+        self.assertEqual(len(expected), 250)
+        self.assertEqual(list(batch.generate_cvvs(records, self.CVK, workers=2, chunk_size=16, skip_parity=True)), expected)
+
+    def test_input_read_lazily(self):
+        read = []
+
+        def records():
+            for i in range(100000):
+                read.append(i)
+                yield ('%016d' % (4000000000000000 + i), '2512', '201')
+
+        results = batch.generate_cvvs(records(), self.CVK, workers=2, chunk_size=10, skip_parity=True)
+        next(results)
+        self.assertLessEqual(len(read), 5 * 10)
+        results.close()
+
+
+class TestBatchPVV(unittest.TestCase):
+    PVK = b'1234567890ABCDEF1234567890ABCDEF'
+
+    def setUp(self):
+        self.accounts = [b'%016d' % (4000000000000000 + i * 7919) for i in range(2000)]
+        self.key_indexes = [b'%d' % (1 + i % 6) for i in range(2000)]
+        self.pins = [b'%04d' % (i * 37 % 10000) for i in range(2000)]
+
+    def _expected_pvvs(self):
+        return [get_visa_pvv(account, key_index, pin, self.PVK) for account, key_index, pin in zip(self.accounts, self.key_indexes, self.pins)]
+
+    def test_same_as_get_visa_pvv(self):
+        with unittest.mock.patch.object(batch, 'numpy', None):
+            self.assertEqual(batch.PVVGenerator(self.PVK).pvvs(self.accounts, self.key_indexes, self.pins), self._expected_pvvs())
+
+    def test_decimalise_blocks_without_numpy(self):
+        data = bytes(range(256)) * 8 + bytes.fromhex('abcdefabcdefabcd')
+        expected = [get_digits_from_string(data[i:i + 8].hex().upper()).encode() for i in range(0, len(data), 8)]
+        with unittest.mock.patch.object(batch, 'numpy', None):
+            self.assertEqual(batch.decimalise_blocks(data, 4), expected)
+        self.assertEqual(batch.decimalise_blocks(data, 4), expected)
+
+    def test_verify(self):
+        generator = batch.PVVGenerator(self.PVK)
+        pvvs = generator.pvvs(self.accounts[:2], self.key_indexes[:2], self.pins[:2])
+        self.assertEqual(generator.verify(self.accounts[:2], self.key_indexes[:2], self.pins[:2], [pvvs[0], b'0000' if pvvs[1] != b'0000' else b'1111']), [True, False])
+
+    def test_generate_pvvs_records(self):
+        pvv = get_visa_pvv(b'4000000000000000', b'1', b'1234', self.PVK).decode()
+        records = [('4000000000000000', '1', '1234', pvv), ('4000000000000000', '1', '1234', None), ('4000000000000000', '1', '1235', pvv)]
+        self.assertEqual([row[3:] for row in batch.generate_pvvs(records, self.PVK.decode(), workers=0)], [(pvv, 'Y'), (pvv, ''), (unittest.mock.ANY, 'N')])
+
+    def test_read_records(self):
+        self.assertEqual(list(batch.read_pvv_records(['PAN,PVKI,PIN,PVV', '4000000000000000,1,1234,5678', '4000000000000000,1,1234'])),
+                         [('4000000000000000', '1', '1234', '5678'), ('4000000000000000', '1', '1234', None)])
+        with self.assertRaisesRegex(ValueError, 'Line 1: invalid record'):
+            list(batch.read_pvv_records(['4000000000000000,12,1234']))
+
+    def test_invalid_key(self):
+        with self.assertRaisesRegex(ValueError, 'Incorrect key length'):
+            batch.generate_pvvs([], '1234')
+
+    @unittest.skipIf(batch.numpy is None, 'NumPy is not installed')
+    def test_numpy_same_as_get_visa_pvv(self):
+        self.assertEqual(batch.PVVGenerator(self.PVK).pvvs(self.accounts, self.key_indexes, self.pins), self._expected_pvvs())
+
+
+class TestBatchDataStream(unittest.TestCase):
+    key = b'U613D213826396ED1C184D7DC81E484F7'
+    clear_key = bytes.fromhex('032447698BACCFF0FFDDBB9977553311')
+
+    def _encrypt(self, data, **kwargs):
+        output = io.BytesIO()
+        self.assertEqual(batch.encrypt_stream(io.BytesIO(data), output, self.clear_key, **kwargs), len(data))
+        return output.getvalue()
+
+    def _decrypt(self, data, **kwargs):
+        output = io.BytesIO()
+        self.assertEqual(batch.decrypt_stream(io.BytesIO(data), output, self.clear_key, **kwargs), len(output.getvalue()))
+        return output.getvalue()
+
+    def test_same_as_one_shot_cbc(self):
+        iv = bytes.fromhex('0102030405060708')
+        for size in (0, 7, 8, 64, 65, 1000):
+            data = bytes(range(256)) * 4
+            data = data[:size]
+            expected = DES3.new(self.clear_key, DES3.MODE_CBC, iv).encrypt(data + bytes([8 - size % 8]) * (8 - size % 8))
+            self.assertEqual(self._encrypt(data, iv=iv, chunk_size=64), expected)
+            self.assertEqual(self._decrypt(expected, iv=iv, chunk_size=64), data)
+
+    def test_ecb(self):
+        data = b'track data ' * 100
+        self.assertEqual(self._decrypt(self._encrypt(data, mode='ecb', chunk_size=16), mode='ecb', chunk_size=24), data)
+
+    def test_invalid_ciphertext_length(self):
+        with self.assertRaises(ValueError):
+            self._decrypt(bytes(20))
+        with self.assertRaises(ValueError):
+            self._decrypt(b'')
+
+    def test_invalid_chunk_size(self):
+        with self.assertRaises(ValueError):
+            self._encrypt(b'data', chunk_size=4)
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            names = [os.path.join(directory, name) for name in ('plain', 'encrypted', 'decrypted')]
+            data = os.urandom(100003)
+            with open(names[0], 'wb') as f:
+                f.write(data)
+            self.assertEqual(batch.crypt_file(names[0], names[1], self.key, chunk_size=4096), len(data))
+            self.assertEqual(batch.crypt_file(names[1], names[2], self.key, decrypt=True), len(data))
+            with open(names[2], 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+
+class TestBench(unittest.TestCase):
+    def test_sample_commands_succeed(self):
+        hsm = HSM(log_level=LOG_OFF)
+        for command_code, data in bench.COMMANDS.items():
+            with self.subTest(command=command_code):
+                frame = b'SSSS' + command_code + data
+                response = hsm._process_message(struct.pack('!H', len(frame)) + frame)
+                self.assertEqual(response.get('Error Code'), b'00')
+
+    def test_parse_mix(self):
+        self.assertEqual(bench.parse_mix('ec=3, NC'), {b'EC': 3.0, b'NC': 1.0})
+
+    def test_parse_mix_unsupported(self):
+        with self.assertRaisesRegex(ValueError, 'Unsupported command in the mix: XX'):
+            bench.parse_mix('XX=1')
+
+    def test_percentile(self):
+        values = list(range(1, 1001))
+        self.assertEqual(bench.percentile(values, 50), 500)
+        self.assertEqual(bench.percentile(values, 99.9), 999)
+        self.assertEqual(bench.percentile([], 50), None)
+
+    def test_benchmark_against_simulator(self):
+        hsm = HSM(log_level=LOG_OFF)
+
+        async def run():
+            server = await asyncio.start_server(hsm._client_async, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            report = await bench.benchmark(port=port, connections=2, depth=4, requests=100, duration=None, mix='NC=1,BU=1')
+            server.close()
+            await server.wait_closed()
+            return report
+
+        report = asyncio.run(run())
+        self.assertEqual(report['sent'], 100)
+        self.assertEqual(report['responses'], 100)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(report['commands']['NC']['responses'] + report['commands']['BU']['responses'], 100)
+        self.assertIsNotNone(report['latency_ms']['p99.9'])
+
+
+class TestHSMWorkers(unittest.TestCase):
+    def setUp(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+        self.workers = HSMWorkers(workers=2, port=self.port, skip_parity=True)
+        self.workers.start()
+
+    def tearDown(self):
+        self.workers.stop()
+
+    def _request(self, frame):
+        for _ in range(50):
+            try:
+                conn = socket.create_connection(('127.0.0.1', self.port))
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.1)
+        with conn:
+            conn.sendall(frame)
+            length = struct.unpack('!H', conn.recv(2))[0]
+            return conn.recv(length)
+
+    def test_stats_aggregated(self):
+        self.assertEqual(self._request(b'\x00\x06SSSSNC')[:8], b'SSSSND00')
+        self.assertEqual(self.workers.get_stats()['requests'], 1)
+
+    def test_dead_worker_restarted(self):
+        self.workers.processes[0].kill()
+        self.workers.processes[0].join()
+        self.workers.check_workers()
+        self.assertTrue(self.workers.processes[0].is_alive())
+        self.assertEqual(self.workers.get_stats()['restarts'], 1)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file